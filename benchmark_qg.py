@@ -0,0 +1,842 @@
+#benchmark_qg.py
+import argparse
+import gc
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Callable, List, Mapping, Tuple
+import torch
+import transformers
+from transformers import AutoTokenizer
+from qg_backends import configure_threads, get_available_cpus, get_worker_cpus
+from qg_metrics import Metrics, get_memory_usage
+from questiongenerator import (
+    DECODING_PRESETS,
+    QG_PRETRAINED,
+    SENTENCE_PATTERN,
+    QuestionGenerator,
+    get_spacy_nlp,
+    split_sentences,
+)
+
+# how the workers of the memory benchmark get their models: each loading its own copy, or
+# forked from a process which loaded them, with their weights read into memory or memory-mapped
+MEMORY_MODES = ["copy", "preload", "preload_mmap"]
+
+# the text which reduced precision models are checked against float32 with by default
+REFERENCE_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference_corpus.txt")
+
+# article sizes of the pipeline benchmark, in characters
+ARTICLE_SIZES = {
+    "paragraph": 1_000,
+    "page": 5_000,
+    "chapter": 50_000,
+    "book": 500_000,
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline",
+        help="Time each stage of the pipeline, from segmenting the text to evaluating the questions, for articles of several sizes",
+    )
+    pipeline_parser.add_argument("--batch_size", type=int, default=16)
+    pipeline_parser.add_argument("--device", type=str, default="cpu")
+    pipeline_parser.add_argument("--evaluator_dir", type=str, default=None)
+    pipeline_parser.add_argument("--model_dir", type=str, default=None)
+    pipeline_parser.add_argument("--repeat", type=int, default=1)
+    pipeline_parser.add_argument(
+        "--sizes",
+        type=str,
+        nargs="+",
+        default=list(ARTICLE_SIZES),
+        help="Article sizes to time: {} or a number of characters. The text is repeated as needed".format(
+            ", ".join(ARTICLE_SIZES)
+        ),
+    )
+    pipeline_parser.add_argument("--text_file", type=str, required=True)
+    pipeline_parser.add_argument(
+        "--tiny",
+        dest="tiny",
+        action="store_true",
+        default=False,
+        help="Use tiny randomly initialised models instead of the pretrained ones, so that no download is needed",
+    )
+
+    context_parser = subparsers.add_parser(
+        "context",
+        help="Compare generating sentence questions with the full and shared context encodings",
+    )
+    context_parser.add_argument("--batch_size", type=int, default=16)
+    context_parser.add_argument("--device", type=str, default=None)
+    context_parser.add_argument("--model_dir", type=str, default=None)
+    context_parser.add_argument("--repeat", type=int, default=1)
+    context_parser.add_argument("--text_file", type=str, required=True)
+
+    decoding_parser = subparsers.add_parser(
+        "decoding", help="Compare the latency and length of questions of the decoding presets"
+    )
+    decoding_parser.add_argument("--batch_size", type=int, default=16)
+    decoding_parser.add_argument("--decoding", type=str, nargs="+", default=list(DECODING_PRESETS))
+    decoding_parser.add_argument("--device", type=str, default=None)
+    decoding_parser.add_argument("--model_dir", type=str, default=None)
+    decoding_parser.add_argument("--repeat", type=int, default=1)
+    decoding_parser.add_argument("--text_file", type=str, required=True)
+
+    dtype_parser = subparsers.add_parser(
+        "dtype",
+        help="Check reduced precision and int8 models against float32, and compare their speed and size",
+    )
+    dtype_parser.add_argument("--batch_size", type=int, default=16)
+    dtype_parser.add_argument("--device", type=str, default="cpu")
+    dtype_parser.add_argument("--dtypes", type=str, nargs="+", default=["bfloat16", "int8"])
+    dtype_parser.add_argument("--evaluator_dir", type=str, default=None)
+    dtype_parser.add_argument(
+        "--min_identical",
+        type=float,
+        default=None,
+        help="Exit with an error if fewer than this fraction of questions match float32",
+    )
+    dtype_parser.add_argument("--model_dir", type=str, default=None)
+    dtype_parser.add_argument("--repeat", type=int, default=1)
+    dtype_parser.add_argument(
+        "--text_file",
+        type=str,
+        default=REFERENCE_CORPUS,
+        help="Defaults to the reference corpus checked in next to this script",
+    )
+    dtype_parser.add_argument(
+        "--tiny",
+        dest="tiny",
+        action="store_true",
+        default=False,
+        help="Use tiny randomly initialised models instead of the pretrained ones, so that no download is needed",
+    )
+
+    memory_parser = subparsers.add_parser(
+        "memory",
+        help="Compare the memory of worker processes which load their own models with workers forked from a process which preloaded them",
+    )
+    memory_parser.add_argument("--batch_size", type=int, default=16)
+    memory_parser.add_argument("--evaluator_dir", type=str, default=None)
+    memory_parser.add_argument("--model_dir", type=str, default=None)
+    memory_parser.add_argument("--modes", type=str, nargs="+", default=MEMORY_MODES, choices=MEMORY_MODES)
+    memory_parser.add_argument("--repeat", type=int, default=1)
+    memory_parser.add_argument("--text_file", type=str, required=True)
+    memory_parser.add_argument("--workers", type=int, default=2)
+
+    split_parser = subparsers.add_parser(
+        "split", help="Time splitting a (book-length) text into sentences"
+    )
+    split_parser.add_argument("--repeat", type=int, default=1)
+    split_parser.add_argument("--runs", type=int, default=5)
+    split_parser.add_argument("--text_file", type=str, required=True)
+
+    threads_parser = subparsers.add_parser(
+        "threads",
+        help="Find the split of the cores into worker processes and threads with the best throughput",
+    )
+    threads_parser.add_argument("--batch_size", type=int, default=16)
+    threads_parser.add_argument("--model_dir", type=str, default=None)
+    threads_parser.add_argument(
+        "--pin", dest="pin", action="store_true", default=False, help="Pin each worker to its own cores"
+    )
+    threads_parser.add_argument("--repeat", type=int, default=1)
+    threads_parser.add_argument(
+        "--splits",
+        type=str,
+        nargs="+",
+        default=None,
+        help="workers x threads splits to try, e.g. 1x4 2x2 4x1. Defaults to every even split of the cores",
+    )
+    threads_parser.add_argument("--text_file", type=str, required=True)
+    threads_parser.add_argument(
+        "--tiny",
+        dest="tiny",
+        action="store_true",
+        default=False,
+        help="Use tiny randomly initialised models instead of the pretrained ones, so that no download is needed",
+    )
+
+    tokenizer_parser = subparsers.add_parser(
+        "tokenizer", help="Compare encoding and decoding the model inputs with the slow and fast tokenizers"
+    )
+    tokenizer_parser.add_argument("--model_dir", type=str, default=None)
+    tokenizer_parser.add_argument("--repeat", type=int, default=1)
+    tokenizer_parser.add_argument(
+        "--require_identical",
+        dest="require_identical",
+        action="store_true",
+        default=False,
+        help="Exit with an error if the fast tokenizer gives different ids for any input",
+    )
+    tokenizer_parser.add_argument("--runs", type=int, default=5)
+    tokenizer_parser.add_argument("--text_file", type=str, required=True)
+    return parser.parse_args()
+
+
+def read_text(text_file: str, repeat: int) -> str:
+    """Reads a text file, repeated repeat times to make a longer text."""
+    with open(text_file, 'r') as file:
+        return "\n".join([file.read()] * repeat)
+
+
+def time_call(fn: Callable[[], Any]) -> Tuple[Any, float]:
+    """Calls fn and returns its result and the number of seconds it took."""
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def benchmark_context_encoding(qg: QuestionGenerator, text: str) -> Mapping[str, Any]:
+    """Generates a question for every sentence answer of text, first encoding the full input of
+    each sentence, then encoding each segment once and sharing it between its sentences. Reports
+    the time taken by each, and how many of the shared-context questions are identical to the
+    full-context ones.
+    """
+    qg_inputs, _ = qg.generate_qg_inputs(text, "sentences")
+    results = {"num_inputs": len(qg_inputs)}
+    questions = {}
+
+    for context_encoding in ["full", "shared"]:
+        qg.context_encoding = context_encoding
+        questions[context_encoding], seconds = time_call(
+            lambda: qg.generate_questions_from_inputs(qg_inputs)
+        )
+        results[context_encoding] = {
+            "seconds": seconds,
+            "inputs_per_second": len(qg_inputs) / seconds if seconds else None,
+        }
+
+    num_identical = sum(
+        full == shared for full, shared in zip(questions["full"], questions["shared"])
+    )
+    results["speedup"] = results["full"]["seconds"] / results["shared"]["seconds"]
+    results["identical_questions"] = num_identical / len(qg_inputs) if qg_inputs else None
+    return results
+
+
+def benchmark_decoding(
+    qg: QuestionGenerator, text: str, decoding_presets: List[str]
+) -> Mapping[str, Any]:
+    """Generates a question for every sentence answer of text with each decoding preset, and
+    reports the decoding statistics of each, along with how many of its questions are identical
+    to those of the first preset.
+    """
+    qg_inputs, _ = qg.generate_qg_inputs(text, "sentences")
+    results = {"num_inputs": len(qg_inputs)}
+    questions = {}
+
+    for decoding in decoding_presets:
+        qg.decoding_stats.clear()
+        questions[decoding], seconds = time_call(
+            lambda: qg.generate_questions_from_inputs(qg_inputs, decoding=decoding)
+        )
+        num_identical = sum(
+            question == reference
+            for question, reference in zip(questions[decoding], questions[decoding_presets[0]])
+        )
+        results[decoding] = {
+            "seconds": seconds,
+            "identical_questions": num_identical / len(qg_inputs) if qg_inputs else None,
+            **qg.decoding_stats.stats().get(decoding, {}),
+        }
+
+    return results
+
+
+def benchmark_dtypes(
+    text: str,
+    dtypes: List[str],
+    model_dir: str = None,
+    device: str = "cpu",
+    batch_size: int = 16,
+    evaluator_dir: str = None
+) -> Mapping[str, Any]:
+    """Generates and scores a question for every sentence answer of text with float32 models,
+    then with models of each of dtypes. Reports the time taken and the size of the models of
+    each dtype relative to float32. For parity, reports how many questions are identical to the
+    float32 ones, and how far the scores given to the float32 questions move.
+    """
+    results = {}
+
+    for dtype in ["float32"] + dtypes:
+        qg = QuestionGenerator(
+            model_dir=model_dir,
+            evaluator_dir=evaluator_dir,
+            device=device,
+            dtype=dtype,
+            batch_size=batch_size,
+        )
+        qg_inputs, answers = qg.generate_qg_inputs(text, "sentences")
+        questions, generate_seconds = time_call(
+            lambda: qg.generate_questions_from_inputs(qg_inputs)
+        )
+
+        if dtype == "float32":
+            reference_questions = questions
+        (scores, _), score_seconds = time_call(
+            lambda: qg.qa_evaluator.score_qa_pairs(
+                reference_questions, answers, probabilities=True
+            )
+        )
+        if dtype == "float32":
+            reference_scores = scores
+
+        num_identical = sum(
+            question == reference for question, reference in zip(questions, reference_questions)
+        )
+        results[dtype] = {
+            "model_bytes": get_model_bytes(qg.qg_model) + get_model_bytes(qg.qa_evaluator.qae_model),
+            "generate_seconds": generate_seconds,
+            "score_seconds": score_seconds,
+            "identical_questions": num_identical / len(qg_inputs) if qg_inputs else None,
+            "max_score_difference": float(abs(scores - reference_scores).max(initial=0)),
+        }
+        del qg
+
+    reference = results["float32"]
+    for dtype in dtypes:
+        results[dtype]["generate_speedup"] = (
+            reference["generate_seconds"] / results[dtype]["generate_seconds"]
+        )
+        results[dtype]["score_speedup"] = reference["score_seconds"] / results[dtype]["score_seconds"]
+        results[dtype]["memory_reduction"] = 1 - results[dtype]["model_bytes"] / reference["model_bytes"]
+
+    results["num_inputs"] = len(qg_inputs)
+    return results
+
+
+def get_model_bytes(model: torch.nn.Module) -> int:
+    """Returns the size of a model's serialised weights, which includes packed int8 weights."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def benchmark_threads(
+    text: str,
+    splits: List[Tuple[int, int]],
+    model_dir: str = None,
+    batch_size: int = 16,
+    pin: bool = False,
+    evaluator_dir: str = None
+) -> Mapping[str, Any]:
+    """For each (workers, threads) split, starts that many worker processes using that many
+    torch threads each, which all generate a question for every sentence answer of text at the
+    same time, as they would when serving concurrent requests. Reports the total throughput of
+    each split, and the split with the best throughput. Only question generation is timed, so
+    evaluator_dir can be a tiny model (see create_tiny_models) to keep the workers from loading
+    the pretrained evaluator.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = {}
+
+    for num_workers, num_threads in splits:
+        barrier = context.Barrier(num_workers + 1)
+        queue = context.Queue()
+        workers = [
+            context.Process(
+                target=_run_threads_worker,
+                args=(
+                    slot, num_threads, pin, model_dir, evaluator_dir, batch_size, text, barrier,
+                    queue,
+                ),
+            )
+            for slot in range(num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        # wait for every worker to load its models before starting the clock
+        barrier.wait()
+        start = time.perf_counter()
+        num_inputs = sum(queue.get() for _ in workers)
+        seconds = time.perf_counter() - start
+
+        for worker in workers:
+            worker.join()
+
+        results[f"{num_workers}x{num_threads}"] = {
+            "workers": num_workers,
+            "threads": num_threads,
+            "seconds": seconds,
+            "inputs_per_second": num_inputs / seconds,
+        }
+
+    results["best"] = max(results, key=lambda split: results[split]["inputs_per_second"])
+    return results
+
+
+def _run_threads_worker(
+    slot: int,
+    num_threads: int,
+    pin: bool,
+    model_dir: str,
+    evaluator_dir: str,
+    batch_size: int,
+    text: str,
+    barrier: Any,
+    queue: Any
+) -> None:
+    if pin:
+        configure_threads(cpu_affinity=get_worker_cpus(slot, num_threads))
+
+    qg = QuestionGenerator(
+        model_dir=model_dir,
+        evaluator_dir=evaluator_dir,
+        device="cpu",
+        batch_size=batch_size,
+        num_threads=num_threads,
+    )
+    qg_inputs, _ = qg.generate_qg_inputs(text, "sentences")
+    qg.generate_questions_from_inputs(qg_inputs[:batch_size])
+
+    barrier.wait()
+    qg.generate_questions_from_inputs(qg_inputs)
+    queue.put(len(qg_inputs))
+
+
+def benchmark_memory(
+    text: str,
+    modes: List[str],
+    num_workers: int,
+    model_dir: str = None,
+    evaluator_dir: str = None,
+    batch_size: int = 16
+) -> Mapping[str, Any]:
+    """For each mode, starts num_workers worker processes as gunicorn would, which each
+    generate questions for text, and reports the rss and pss of every worker once they all
+    have. With "copy", each worker loads its own models. With "preload" and "preload_mmap",
+    the workers are forked from a process which loaded the models (with memory-mapped weights
+    for "preload_mmap"), as with QG_PRELOAD.
+
+    pss divides each shared page between the processes sharing it, so total_pss, the sum of the
+    pss of the workers and of the process they were forked from, is the memory they use.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = {}
+
+    for mode in modes:
+        queue = context.Queue()
+        # each mode runs in a new process, so that it doesn't reuse the models of another
+        master = context.Process(
+            target=_run_memory_master,
+            args=(mode, num_workers, model_dir, evaluator_dir, batch_size, text, queue),
+        )
+        master.start()
+        result = queue.get()
+        master.join()
+
+        result["total_pss"] = result["master"]["pss"] + sum(
+            worker["pss"] for worker in result["workers"]
+        )
+        results[mode] = result
+
+    return results
+
+
+def _run_memory_master(
+    mode: str,
+    num_workers: int,
+    model_dir: str,
+    evaluator_dir: str,
+    batch_size: int,
+    text: str,
+    queue: Any
+) -> None:
+    num_threads = max(1, len(get_available_cpus()) // num_workers)
+
+    def load_models():
+        return QuestionGenerator(
+            model_dir=model_dir,
+            evaluator_dir=evaluator_dir,
+            device="cpu",
+            batch_size=batch_size,
+            num_threads=num_threads,
+            backend_options={"mmap_weights": mode == "preload_mmap"},
+        )
+
+    qg = None
+    if mode != "copy":
+        qg = load_models()
+        gc.collect()
+        gc.freeze()
+
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(num_workers + 1)
+    worker_queue = context.Queue()
+    workers = [
+        context.Process(
+            target=_run_memory_worker, args=(qg, load_models, text, barrier, worker_queue)
+        )
+        for _ in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    barrier.wait()
+    usage = [worker_queue.get() for _ in workers]
+    master_usage = get_memory_usage()
+    barrier.wait()
+    for worker in workers:
+        worker.join()
+
+    queue.put({"master": master_usage, "workers": usage})
+
+
+def _run_memory_worker(
+    qg: QuestionGenerator,
+    load_models: Callable[[], QuestionGenerator],
+    text: str,
+    barrier: Any,
+    queue: Any
+) -> None:
+    if qg is None:
+        qg = load_models()
+    qg.generate(text, use_evaluator=True, num_questions=10, answer_style="sentences")
+
+    # measure once every worker has generated, so that they all share what they will share
+    barrier.wait()
+    queue.put(get_memory_usage())
+    barrier.wait()
+
+
+def get_even_splits(num_cpus: int) -> List[Tuple[int, int]]:
+    """Returns every (workers, threads) split which uses each of num_cpus cores exactly once."""
+    return [
+        (num_workers, num_cpus // num_workers)
+        for num_workers in range(1, num_cpus + 1)
+        if num_cpus % num_workers == 0
+    ]
+
+
+def benchmark_split(text: str, runs: int) -> Mapping[str, Any]:
+    """Splits text into sentences runs times, and reports the fastest run."""
+    seconds = []
+
+    for _ in range(runs):
+        sentences, run_seconds = time_call(lambda: split_sentences(text))
+        seconds.append(run_seconds)
+
+    return {
+        "num_characters": len(text),
+        "num_sentences": len(sentences),
+        "seconds": min(seconds),
+        "characters_per_second": len(text) / min(seconds) if min(seconds) else None,
+    }
+
+
+def benchmark_tokenizers(text: str, model_dir: str = None, runs: int = 5) -> Mapping[str, Any]:
+    """Encodes the model inputs for every answer of text with the slow and fast tokenizers of
+    the QG model, both with one call per input and in a single batch, and decodes their ids
+    again. Reports the fastest of runs runs of each, and the fraction of inputs for which the
+    fast tokenizer gives the same ids and decoded text as the slow one.
+    """
+    qg = QuestionGenerator(model_dir=model_dir, device="cpu", use_fast_tokenizer=False)
+    qg_inputs, _ = qg.generate_qg_inputs(text, "all")
+    results = {"num_inputs": len(qg_inputs)}
+    input_ids = {}
+    decoded = {}
+
+    for name, use_fast in [("slow", False), ("fast", True)]:
+        tokenizer = AutoTokenizer.from_pretrained(model_dir or QG_PRETRAINED, use_fast=use_fast)
+        calls = {
+            "per_input": lambda: [
+                tokenizer(qg_input, max_length=qg.SEQ_LENGTH, truncation=True)["input_ids"]
+                for qg_input in qg_inputs
+            ],
+            "batch": lambda: tokenizer(
+                qg_inputs, max_length=qg.SEQ_LENGTH, truncation=True
+            )["input_ids"],
+            "decode": lambda: tokenizer.batch_decode(
+                input_ids["slow"], skip_special_tokens=True
+            ),
+        }
+        results[name] = {"is_fast": tokenizer.is_fast}
+
+        for call_name, call in calls.items():
+            seconds = []
+            for _ in range(runs):
+                output, run_seconds = time_call(call)
+                seconds.append(run_seconds)
+            results[name][call_name + "_seconds"] = min(seconds)
+
+            if call_name == "batch":
+                input_ids[name] = output
+            elif call_name == "decode":
+                decoded[name] = output
+
+    num_identical = sum(
+        slow_ids == fast_ids and slow_text == fast_text
+        for slow_ids, fast_ids, slow_text, fast_text in zip(
+            input_ids["slow"], input_ids["fast"], decoded["slow"], decoded["fast"]
+        )
+    )
+    results["batch_speedup"] = results["slow"]["per_input_seconds"] / results["fast"]["batch_seconds"]
+    results["identical_inputs"] = num_identical / len(qg_inputs) if qg_inputs else None
+    return results
+
+
+def benchmark_pipeline(qg: QuestionGenerator, text: str, sizes: List[str]) -> Mapping[str, Any]:
+    """Generates questions with answer_style="all" for an article of each size, and reports the
+    seconds spent in each stage of the pipeline, as timed by the stage_seconds spans of the
+    generator's Metrics, along with the pipeline's counters. qg must report to a Metrics, and
+    have no result cache or memos, so that every sentence and entity goes through every stage.
+    Pre-ranking is left out, as without QG_EARLY_EXIT.
+    """
+    metrics = qg.instrumentation
+    # load the spaCy pipeline before any stage is timed
+    get_spacy_nlp()
+    results = {}
+
+    for size in sizes:
+        article = get_text_of_size(text, ARTICLE_SIZES.get(size) or int(size))
+        metrics.clear()
+        _, total_seconds = time_call(
+            lambda: qg.generate(article, use_evaluator=True, answer_style="all")
+        )
+
+        stages = {}
+        # generation spans are also labelled with their decoding preset
+        for labels, summary in metrics.summaries("stage_seconds"):
+            stage = stages.setdefault(labels["stage"], {"seconds": 0, "runs": 0})
+            stage["seconds"] += summary["sum"]
+            stage["runs"] += summary["count"]
+        for stage in stages.values():
+            stage["fraction"] = stage["seconds"] / total_seconds if total_seconds else None
+
+        results[size] = {
+            "num_characters": len(article),
+            "total_seconds": total_seconds,
+            "untimed_seconds": total_seconds - sum(stage["seconds"] for stage in stages.values()),
+            "stages": stages,
+            "counters": metrics.snapshot()["counters"],
+        }
+
+    return results
+
+
+def get_text_of_size(text: str, num_characters: int, seed: int = 0) -> str:
+    """Repeats text as many times as needed to make it num_characters long, and cuts it at the
+    last whitespace before that length. Repeated sentences would only be used once, so the
+    words of each sentence are shuffled in every copy after the first.
+    """
+    rng = random.Random(seed)
+    text = text.strip()
+    copies = [text]
+
+    while sum(len(copy) + 1 for copy in copies) <= num_characters:
+        copies.append(SENTENCE_PATTERN.sub(lambda match: _shuffle_words(match.group(), rng), text))
+
+    repeated = "\n".join(copies)
+    if len(repeated) <= num_characters:
+        return repeated
+
+    end = max(repeated.rfind(" ", 0, num_characters), repeated.rfind("\n", 0, num_characters))
+    return repeated[:end if end > 0 else num_characters]
+
+
+def _shuffle_words(sentence: str, rng: random.Random) -> str:
+    body = sentence.rstrip(".!?")
+    words = body.split()
+    rng.shuffle(words)
+    leading_space = body[:len(body) - len(body.lstrip())]
+    return leading_space + " ".join(words) + sentence[len(body):]
+
+
+def create_tiny_models(text: str, output_dir: str, seed: int = 0) -> Tuple[str, str]:
+    """Saves a randomly initialised T5 question generator and BERT QA evaluator with a few
+    small layers to output_dir/qg and output_dir/qae. They stand in for the pretrained models,
+    with the same architectures and tokenizer types, so the pipeline can be benchmarked without
+    downloading them. Their vocabularies are learned from text. Returns the two directories.
+    """
+    import sentencepiece
+
+    torch.manual_seed(seed)
+    qg_dir = os.path.join(output_dir, "qg")
+    qae_dir = os.path.join(output_dir, "qae")
+    lines = [line for line in text.splitlines() if line.strip()]
+
+    spiece_model = io.BytesIO()
+    sentencepiece.SentencePieceTrainer.train(
+        sentence_iterator=iter(lines),
+        model_writer=spiece_model,
+        vocab_size=1000,
+        hard_vocab_limit=False,
+        character_coverage=1.0,
+        pad_id=0,
+        eos_id=1,
+        unk_id=2,
+        bos_id=-1,
+        minloglevel=2,
+    )
+    os.makedirs(qg_dir, exist_ok=True)
+    spiece_path = os.path.join(output_dir, "spiece.model")
+    with open(spiece_path, "wb") as file:
+        file.write(spiece_model.getvalue())
+
+    qg_tokenizer = transformers.T5Tokenizer(
+        spiece_path, extra_ids=0, additional_special_tokens=["<answer>", "<context>"]
+    )
+    qg_model = transformers.T5ForConditionalGeneration(transformers.T5Config(
+        vocab_size=len(qg_tokenizer),
+        d_model=64,
+        d_kv=16,
+        d_ff=128,
+        num_layers=2,
+        num_heads=4,
+        decoder_start_token_id=qg_tokenizer.pad_token_id,
+        pad_token_id=qg_tokenizer.pad_token_id,
+        eos_token_id=qg_tokenizer.eos_token_id,
+    ))
+    qg_tokenizer.save_pretrained(qg_dir)
+    qg_model.save_pretrained(qg_dir)
+
+    words = Counter(re.findall(r"\w+|[^\w\s]", text))
+    characters = sorted(set("".join(words)))
+    vocab = (
+        ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+        + characters
+        + ["##" + character for character in characters]
+        + [word for word, _ in words.most_common(2000) if len(word) > 1]
+    )
+    os.makedirs(qae_dir, exist_ok=True)
+    vocab_path = os.path.join(output_dir, "vocab.txt")
+    with open(vocab_path, "w") as file:
+        file.write("\n".join(vocab) + "\n")
+
+    qae_tokenizer = transformers.BertTokenizerFast(vocab_path, do_lower_case=False)
+    qae_model = transformers.BertForSequenceClassification(transformers.BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=128,
+        num_labels=2,
+    ))
+    qae_tokenizer.save_pretrained(qae_dir)
+    qae_model.save_pretrained(qae_dir)
+
+    return qg_dir, qae_dir
+
+
+def get_environment() -> Mapping[str, Any]:
+    """Returns the commit and library versions a benchmark was run with, so that results from
+    different commits can be compared.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "num_threads": torch.get_num_threads(),
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    text = read_text(args.text_file, args.repeat)
+
+    if args.benchmark == "pipeline":
+        with tempfile.TemporaryDirectory() as tiny_dir:
+            model_dir, evaluator_dir = args.model_dir, args.evaluator_dir
+            if args.tiny:
+                model_dir, evaluator_dir = create_tiny_models(text, tiny_dir)
+
+            qg, load_seconds = time_call(lambda: QuestionGenerator(
+                model_dir=model_dir,
+                evaluator_dir=evaluator_dir,
+                device=args.device,
+                batch_size=args.batch_size,
+                seed=0,
+                instrumentation=Metrics(),
+            ))
+            results = {
+                "environment": get_environment(),
+                "models": "tiny" if args.tiny else {"qg": model_dir, "qae": evaluator_dir},
+                "load_seconds": load_seconds,
+                "sizes": benchmark_pipeline(qg, text, args.sizes),
+            }
+    elif args.benchmark == "context":
+        qg = QuestionGenerator(
+            model_dir=args.model_dir,
+            device=args.device,
+            batch_size=args.batch_size
+        )
+        results = benchmark_context_encoding(qg, text)
+    elif args.benchmark == "decoding":
+        qg = QuestionGenerator(
+            model_dir=args.model_dir,
+            device=args.device,
+            batch_size=args.batch_size
+        )
+        results = benchmark_decoding(qg, text, args.decoding)
+    elif args.benchmark == "dtype":
+        with tempfile.TemporaryDirectory() as tiny_dir:
+            model_dir, evaluator_dir = args.model_dir, args.evaluator_dir
+            if args.tiny:
+                model_dir, evaluator_dir = create_tiny_models(text, tiny_dir)
+
+            results = benchmark_dtypes(
+                text, args.dtypes, model_dir, args.device, args.batch_size, evaluator_dir
+            )
+            results["models"] = "tiny" if args.tiny else {"qg": model_dir, "qae": evaluator_dir}
+    elif args.benchmark == "memory":
+        results = benchmark_memory(
+            text, args.modes, args.workers, args.model_dir, args.evaluator_dir, args.batch_size
+        )
+    elif args.benchmark == "split":
+        results = benchmark_split(text, args.runs)
+    elif args.benchmark == "threads":
+        if args.splits:
+            splits = [tuple(int(n) for n in split.split("x")) for split in args.splits]
+        else:
+            splits = get_even_splits(len(get_available_cpus()))
+
+        # the workers never evaluate their questions, so they always load the tiny evaluator
+        with tempfile.TemporaryDirectory() as tiny_dir:
+            model_dir, evaluator_dir = create_tiny_models(text, tiny_dir)
+            if not args.tiny:
+                model_dir = args.model_dir
+
+            results = benchmark_threads(
+                text, splits, model_dir, args.batch_size, args.pin, evaluator_dir
+            )
+            results["models"] = "tiny" if args.tiny else {"qg": model_dir}
+    elif args.benchmark == "tokenizer":
+        results = benchmark_tokenizers(text, args.model_dir, args.runs)
+
+    print(json.dumps({"benchmark": args.benchmark, **results}, indent=2))
+
+    if args.benchmark == "dtype" and args.min_identical is not None:
+        if any(results[dtype]["identical_questions"] < args.min_identical for dtype in args.dtypes):
+            sys.exit(1)
+
+    if args.benchmark == "tokenizer" and args.require_identical:
+        if results["identical_inputs"] not in (None, 1):
+            sys.exit(1)
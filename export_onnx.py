@@ -0,0 +1,34 @@
+#export_onnx.py
+import argparse
+import os
+from transformers import AutoModelForSeq2SeqLM, AutoModelForSequenceClassification
+from qg_backends import export_onnx
+from questiongenerator import QAE_PRETRAINED, QG_PRETRAINED
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Export the question generator and QA evaluator to ONNX for the onnx backend"
+    )
+    parser.add_argument("--evaluator_dir", type=str, default=QAE_PRETRAINED)
+    parser.add_argument("--model_dir", type=str, default=QG_PRETRAINED)
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="The generator is exported to <output_dir>/qg and the evaluator to <output_dir>/qae",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    qg_dir = os.path.join(args.output_dir, "qg")
+    qae_dir = os.path.join(args.output_dir, "qae")
+    print(f"Exporting {args.model_dir} to {qg_dir}...")
+    export_onnx(AutoModelForSeq2SeqLM, args.model_dir, qg_dir)
+    print(f"Exporting {args.evaluator_dir} to {qae_dir}...")
+    export_onnx(AutoModelForSequenceClassification, args.evaluator_dir, qae_dir)
+    print(
+        "Done. Run with: python run_qg.py --backend onnx "
+        f"--model_dir {qg_dir} --evaluator_dir {qae_dir} --text_file <text_file>"
+    )
@@ -0,0 +1,67 @@
+#gunicorn.conf.py
+# Run with: gunicorn nlp_question_generation.wsgi
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+# generating questions for a long article can take longer than gunicorn's default 30s
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+# with QG_PRELOAD=1, the app and its models are loaded in the master, and the workers forked
+# from it share the models' memory (see QG_PRELOAD in settings.py). Nothing may run a model in
+# the master: torch's thread pools don't survive a fork.
+preload_app = os.environ.get("QG_PRELOAD") == "1"
+
+
+def when_ready(server):
+    if preload_app:
+        _log_memory_usage(server, "Master")
+
+
+def pre_fork(server, worker):
+    """Gives each worker the lowest slot which no other live worker is using, so that a worker
+    which replaces one that died takes over the CPUs of the one it replaces.
+    """
+    used_slots = {getattr(other, "qg_slot", None) for other in server.WORKERS.values()}
+    worker.qg_slot = next(slot for slot in range(server.num_workers + 1) if slot not in used_slots)
+
+
+def post_fork(server, worker):
+    """Limits the threads of each worker, so that the workers share the machine's cores instead
+    of each starting a thread per core. With QG_CPU_AFFINITY=auto, each worker is also pinned
+    to its own QG_NUM_THREADS cores (by default, an equal share of the cores).
+    """
+    from qg_backends import configure_threads, get_available_cpus, get_worker_cpus
+
+    num_threads = int(os.environ.get("QG_NUM_THREADS") or 0)
+    if not num_threads:
+        num_threads = max(1, len(get_available_cpus()) // server.num_workers)
+
+    cpu_affinity = None
+    if os.environ.get("QG_CPU_AFFINITY") == "auto":
+        cpu_affinity = get_worker_cpus(worker.qg_slot, num_threads)
+        server.log.info("Pinning worker %s to CPUs %s", worker.pid, cpu_affinity)
+
+    configure_threads(num_threads, cpu_affinity=cpu_affinity)
+
+
+def post_worker_init(worker):
+    _log_memory_usage(worker, "Worker")
+
+
+def _log_memory_usage(process, name):
+    """Logs the resident (rss) and proportional (pss) memory of a gunicorn process. pss divides
+    each page shared with other processes between them, so the sum of the workers' pss is the
+    memory they actually use.
+    """
+    from qg_metrics import get_memory_usage
+
+    usage = get_memory_usage()
+    if usage:
+        process.log.info(
+            "%s %s memory: rss %.0f MiB, pss %.0f MiB, shared %.0f MiB",
+            name,
+            os.getpid(),
+            usage["rss"] / 2**20,
+            usage["pss"] / 2**20,
+            usage["shared"] / 2**20,
+        )
@@ -69,6 +69,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # background generation jobs write to the database while requests are being served
+        'OPTIONS': {'timeout': 20},
     }
 }
 
@@ -119,3 +121,111 @@ STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles/")
 # Media Settings
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+
+# Question generation
+# The generator is loaded once per process and shared by all requests. QG_MODEL_DIR is the
+# question generation checkpoint (defaults to the Hugging Face hub model), QG_DEVICE e.g. "cpu"
+# or "cuda" and QG_DTYPE e.g. "float32" or "bfloat16", or "int8" for dynamically quantized models
+# on CPU. Set QG_WARMUP=1 to load the models when the app starts rather than on the first
+# request. QG_EARLY_EXIT=1 only generates questions for as many of the most promising answers as
+# are needed to fill the requested number of questions.
+QG_MODEL_DIR = os.environ.get('QG_MODEL_DIR')
+QG_DEVICE = os.environ.get('QG_DEVICE')
+QG_DTYPE = os.environ.get('QG_DTYPE')
+QG_WARMUP = os.environ.get('QG_WARMUP', '0') == '1'
+QG_EARLY_EXIT = os.environ.get('QG_EARLY_EXIT', '0') == '1'
+QG_EVALUATOR_DIR = os.environ.get('QG_EVALUATOR_DIR')
+
+# With QG_PRELOAD=1 (and gunicorn's preload_app, which gunicorn.conf.py turns on with the same
+# variable), the models are loaded once in gunicorn's master process, and the forked workers
+# share their weights instead of each loading a copy. QG_MMAP_WEIGHTS=1 (the default with
+# QG_PRELOAD) maps the weights from the checkpoint files instead of reading them into memory, so
+# that they stay shared, and are also shared with other processes loading the same files.
+# Weights stored as safetensors or as PyTorch zip files in the requested QG_DTYPE can be mapped.
+QG_PRELOAD = os.environ.get('QG_PRELOAD', '0') == '1'
+QG_MMAP_WEIGHTS = os.environ.get('QG_MMAP_WEIGHTS', '1' if QG_PRELOAD else '0') == '1'
+
+# QG_BACKEND=onnx runs the models with ONNX Runtime on CPU. Point QG_MODEL_DIR and
+# QG_EVALUATOR_DIR at the output of export_onnx.py, otherwise the models are exported every time
+# a worker starts. QG_ONNX_GRAPH_OPTIMIZATION is "disable", "basic", "extended" or "all", and the
+# thread counts default to ONNX Runtime's own choice (0).
+QG_BACKEND = os.environ.get('QG_BACKEND', 'torch')
+QG_ONNX_GRAPH_OPTIMIZATION = os.environ.get('QG_ONNX_GRAPH_OPTIMIZATION', 'all')
+QG_ONNX_INTRA_OP_THREADS = int(os.environ.get('QG_ONNX_INTRA_OP_THREADS', '0'))
+QG_ONNX_INTER_OP_THREADS = int(os.environ.get('QG_ONNX_INTER_OP_THREADS', '0'))
+
+# By default torch uses every core in each worker process, so several workers on one machine
+# oversubscribe it. QG_NUM_THREADS and QG_NUM_INTEROP_THREADS set the intra-op and inter-op
+# threads of each worker (0 keeps torch's defaults). QG_CPU_AFFINITY is a list of CPUs to pin
+# the process to (e.g. "0-3,8"), or "auto" to pin each gunicorn worker to its own QG_NUM_THREADS
+# CPUs (see gunicorn.conf.py). Use "python benchmark_qg.py threads" to find the best split.
+QG_NUM_THREADS = int(os.environ.get('QG_NUM_THREADS', '0'))
+QG_NUM_INTEROP_THREADS = int(os.environ.get('QG_NUM_INTEROP_THREADS', '0'))
+QG_CPU_AFFINITY = os.environ.get('QG_CPU_AFFINITY')
+
+# With QG_MICRO_BATCH_WAIT_MS > 0, the inputs of concurrent requests (or job worker threads) are
+# combined into shared batches. An input waits up to QG_MICRO_BATCH_WAIT_MS milliseconds for
+# others to join its batch, and at most QG_MICRO_BATCH_QUEUE_SIZE inputs can be waiting, after
+# which further requests wait for room. The scheduler's statistics are served at /stats/.
+# Shared batches hold up to QG_MICRO_BATCH_SIZE inputs (0 uses each model's own batch size, 16
+# for questions and 32 for scores). Each request already submits full batches of that size, so
+# only requests for short texts are merged unless QG_MICRO_BATCH_SIZE is larger.
+QG_MICRO_BATCH_WAIT_MS = float(os.environ.get('QG_MICRO_BATCH_WAIT_MS', '0'))
+QG_MICRO_BATCH_QUEUE_SIZE = int(os.environ.get('QG_MICRO_BATCH_QUEUE_SIZE', '1024'))
+QG_MICRO_BATCH_SIZE = int(os.environ.get('QG_MICRO_BATCH_SIZE', '0'))
+
+# The decoding preset used when a request doesn't choose one: "default" (the checkpoint's own
+# generation settings), "fast" (greedy, short questions), "balanced" or "quality" (beam search).
+QG_DECODING = os.environ.get('QG_DECODING', 'default')
+
+# Generated questions are cached by article and options. Up to QG_RESULT_CACHE_ENTRIES results
+# (0 disables the cache) taking up to QG_RESULT_CACHE_BYTES are kept in memory. If
+# QG_RESULT_CACHE_PATH is set, results are also stored in a SQLite database at that path, which
+# survives restarts and is shared between worker processes.
+QG_RESULT_CACHE_ENTRIES = int(os.environ.get('QG_RESULT_CACHE_ENTRIES', '256'))
+QG_RESULT_CACHE_BYTES = int(os.environ.get('QG_RESULT_CACHE_BYTES', str(64 * 1024 * 1024)))
+QG_RESULT_CACHE_PATH = os.environ.get('QG_RESULT_CACHE_PATH')
+
+# The question generated for each sentence or entity, and each evaluator score, is also memoized,
+# so that articles which share paragraphs only pay for their new content. Each of the two memos
+# holds up to QG_MEMO_ENTRIES entries (0 disables them) taking up to QG_MEMO_BYTES.
+QG_MEMO_ENTRIES = int(os.environ.get('QG_MEMO_ENTRIES', '100000'))
+QG_MEMO_BYTES = int(os.environ.get('QG_MEMO_BYTES', str(128 * 1024 * 1024)))
+
+# Questions can be generated in background jobs, which the dashboard polls for their results.
+# Jobs are queued in the database. Each web process runs QG_JOB_WORKERS worker threads, which
+# check for new jobs every QG_JOB_POLL_INTERVAL seconds. With QG_JOB_WORKERS=0, jobs are run by
+# "python manage.py run_generation_jobs" instead. A running job which hasn't been updated for
+# QG_JOB_TIMEOUT seconds is assumed to have lost its worker, and is run again. Workers refresh
+# their running jobs every third of QG_JOB_TIMEOUT, even in stages which report no progress.
+QG_JOB_WORKERS = int(os.environ.get('QG_JOB_WORKERS', '1'))
+QG_JOB_POLL_INTERVAL = float(os.environ.get('QG_JOB_POLL_INTERVAL', '1'))
+QG_JOB_TIMEOUT = int(os.environ.get('QG_JOB_TIMEOUT', '600'))
+
+# Requests to the async JSON API (/api/generate/) run the models in a pool of
+# QG_ASYNC_INFERENCE_THREADS threads shared by the whole process, so under an ASGI server (e.g.
+# "uvicorn nlp_question_generation.asgi:application") a process can hold many slow requests
+# at once without a thread for each of them.
+QG_ASYNC_INFERENCE_THREADS = int(os.environ.get('QG_ASYNC_INFERENCE_THREADS', '2'))
+
+# Clients of the JSON API authenticate with an "Authorization: Bearer <key>" header holding one of
+# the comma-separated QG_API_KEYS. The API rejects every request while no keys are set.
+QG_API_KEYS = [key.strip() for key in os.environ.get('QG_API_KEYS', '').split(',') if key.strip()]
+
+# The question generator counts and times each stage of the pipeline, which are served in the
+# Prometheus text format at /metrics/ (for the worker process which answers the request). Its
+# progress messages are logged to the console at QG_LOG_LEVEL, and with DEBUG, so are the
+# timings of every stage.
+QG_LOG_LEVEL = os.environ.get('QG_LOG_LEVEL', 'INFO')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        name: {'handlers': ['console'], 'level': QG_LOG_LEVEL}
+        for name in ['questiongenerator', 'qg_metrics', 'question_generationapp']
+    },
+}
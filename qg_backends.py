@@ -0,0 +1,368 @@
+#qg_backends.py
+import os
+import re
+import warnings
+from typing import Any, Callable, Dict, List, Mapping, Sequence
+
+import torch
+
+# dtype of models whose Linear layers are quantized to int8 after loading them in float32
+QUANTIZED_DTYPE = "int8"
+
+# names of the ONNX Runtime graph optimization levels, see onnxruntime.GraphOptimizationLevel
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+_backends: Dict[str, Callable[..., Any]] = {}
+
+
+def register_backend(name: str, loader: Callable[..., Any]) -> None:
+    """Registers a function which loads models for the backend called name. It is called as
+    loader(model_class, model_dir, device, dtype, **options), where model_class is the
+    transformers auto class of the model (e.g. AutoModelForSeq2SeqLM), and must return a model
+    in inference mode with the same generate and forward interface as the transformers model.
+    """
+    _backends[name] = loader
+
+
+def get_backends() -> List[str]:
+    return list(_backends)
+
+
+def load_model(
+    model_class: Any,
+    model_dir: str,
+    device: torch.device,
+    dtype: str = None,
+    backend: str = "torch",
+    **options: Any
+) -> Any:
+    """Loads a checkpoint for inference with the given backend. Any options are passed on to
+    the backend's loader.
+    """
+    if backend not in _backends:
+        raise ValueError(
+            "Invalid backend {}. Please choose from {}".format(backend, get_backends())
+        )
+
+    return _backends[backend](model_class, model_dir, device, dtype, **options)
+
+
+def load_torch_model(
+    model_class: Any,
+    model_dir: str,
+    device: torch.device,
+    dtype: str = None,
+    mmap_weights: bool = False
+) -> Any:
+    """Loads a checkpoint with model_class onto device, ready for inference. With dtype="int8",
+    the model is loaded in float32 and the weights of its Linear layers are then quantized to
+    int8, while activations are quantized on the fly. Quantized models can only run on CPU.
+
+    With mmap_weights, models on CPU whose weights don't need converting are loaded with
+    load_mmap_model, so that processes loading the same checkpoint share its weights.
+    """
+    if dtype == QUANTIZED_DTYPE:
+        if device.type != "cpu":
+            raise ValueError("int8 quantization is only supported on CPU, not {}".format(device))
+
+        model = model_class.from_pretrained(model_dir, torch_dtype=torch.float32)
+        model.eval()
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        model.is_quantized_int8 = True
+        return model
+
+    torch_dtype = get_torch_dtype(dtype)
+
+    if torch_dtype == torch.bfloat16 and not has_native_bfloat16(device):
+        warnings.warn(
+            "{} has no native bfloat16 support, so bfloat16 inference will be emulated and may "
+            "be slower than float32".format(device)
+        )
+
+    if mmap_weights and device.type == "cpu":
+        model = load_mmap_model(model_class, model_dir, torch_dtype)
+        if model is not None:
+            model.eval()
+            return model
+        warnings.warn("Could not memory-map the weights of {}, loading a copy".format(model_dir))
+
+    model = model_class.from_pretrained(model_dir, torch_dtype=torch_dtype)
+    model.to(device)
+    model.eval()
+    return model
+
+
+def load_mmap_model(model_class: Any, model_dir: str, torch_dtype: torch.dtype = None) -> Any:
+    """Loads a checkpoint on CPU with its parameters backed by a copy-on-write memory map of
+    the checkpoint file, rather than by a copy in the process's own memory. Weights are read
+    from disk as they are used, and every process mapping the same file, or forked from one
+    which has, shares them through the page cache for as long as they aren't written to.
+
+    Returns None if the checkpoint isn't a single safetensors or PyTorch (zip) file, if its
+    weights would have to be converted to torch_dtype, or if their names don't match the model.
+    """
+    from transformers import AutoConfig, GenerationConfig
+    from transformers.modeling_utils import no_init_weights
+    from transformers.utils import SAFE_WEIGHTS_NAME, WEIGHTS_NAME, cached_file
+
+    state_dict = None
+    for weights_name in [SAFE_WEIGHTS_NAME, WEIGHTS_NAME]:
+        path = cached_file(model_dir, weights_name, _raise_exceptions_for_missing_entries=False)
+        if path is not None:
+            state_dict = _mmap_state_dict(path)
+            break
+
+    if not state_dict:
+        return None
+
+    if torch_dtype is not None and any(
+        tensor.dtype != torch_dtype for tensor in state_dict.values() if tensor.is_floating_point()
+    ):
+        return None
+
+    config = AutoConfig.from_pretrained(model_dir)
+    with no_init_weights():
+        if hasattr(model_class, "from_config"):
+            # the Auto classes
+            model = model_class.from_config(config)
+        else:
+            model = model_class(config)
+
+    missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    # tied weights, such as T5's input and output embeddings, are only stored once
+    model.tie_weights()
+
+    loaded = {tensor.data_ptr() for tensor in state_dict.values()}
+    model_state = model.state_dict()
+    ignored = model._keys_to_ignore_on_load_unexpected or []
+    if any(model_state[key].data_ptr() not in loaded for key in missing) or any(
+        not any(re.search(pattern, key) for pattern in ignored) for key in unexpected
+    ):
+        return None
+
+    if model.can_generate():
+        try:
+            model.generation_config = GenerationConfig.from_pretrained(model_dir)
+        except OSError:
+            # like from_pretrained, keep the defaults derived from the model's config
+            pass
+
+    return model
+
+
+def _mmap_state_dict(path: str) -> Mapping[str, torch.Tensor]:
+    if path.endswith(".safetensors"):
+        from safetensors import safe_open
+
+        with safe_open(path, framework="pt") as checkpoint:
+            return {key: checkpoint.get_tensor(key) for key in checkpoint.keys()}
+
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except RuntimeError:
+        # checkpoints saved before torch 1.6 can't be memory-mapped
+        return None
+
+
+def load_onnx_model(
+    model_class: Any,
+    model_dir: str,
+    device: torch.device,
+    dtype: str = None,
+    graph_optimization_level: str = "all",
+    intra_op_num_threads: int = None,
+    inter_op_num_threads: int = None
+) -> Any:
+    """Loads a model exported to ONNX (see export_onnx.py) and runs it with ONNX Runtime on CPU.
+    If model_dir doesn't hold an exported model, the checkpoint is exported when it is loaded,
+    which is slow. Sequence-to-sequence models are run as an encoder and a decoder which reuses
+    its past key/values.
+
+    graph_optimization_level is one of GRAPH_OPTIMIZATION_LEVELS, and the thread counts default
+    to ONNX Runtime's own choice. Needs the optimum[onnxruntime] package.
+    """
+    try:
+        import onnxruntime
+        import optimum.onnxruntime
+    except ImportError as error:
+        raise ImportError(
+            "The onnx backend needs optimum and onnxruntime: pip install optimum[onnxruntime]"
+        ) from error
+
+    if device.type != "cpu":
+        raise ValueError("The onnx backend only runs on CPU, not {}".format(device))
+
+    if dtype not in (None, "float32"):
+        raise ValueError("The onnx backend only runs float32 models, not {}".format(dtype))
+
+    if graph_optimization_level not in GRAPH_OPTIMIZATION_LEVELS:
+        raise ValueError(
+            "Invalid graph optimization level {}. Please choose from {}".format(
+                graph_optimization_level, list(GRAPH_OPTIMIZATION_LEVELS)
+            )
+        )
+
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = getattr(
+        onnxruntime.GraphOptimizationLevel,
+        GRAPH_OPTIMIZATION_LEVELS[graph_optimization_level],
+    )
+    if intra_op_num_threads:
+        session_options.intra_op_num_threads = intra_op_num_threads
+    if inter_op_num_threads:
+        session_options.inter_op_num_threads = inter_op_num_threads
+
+    # e.g. AutoModelForSeq2SeqLM is run by ORTModelForSeq2SeqLM
+    ort_class = getattr(optimum.onnxruntime, model_class.__name__.replace("Auto", "ORT"))
+    return ort_class.from_pretrained(
+        model_dir,
+        export=not is_onnx_export(model_dir),
+        provider="CPUExecutionProvider",
+        session_options=session_options,
+    )
+
+
+def export_onnx(model_class: Any, model_dir: str, output_dir: str) -> None:
+    """Exports a checkpoint and its tokenizer to output_dir, from which the onnx backend can
+    load it without exporting it again.
+    """
+    from transformers import AutoTokenizer
+
+    model = load_onnx_model(model_class, model_dir, torch.device("cpu"))
+    model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(model_dir).save_pretrained(output_dir)
+
+
+def is_onnx_export(model_dir: str) -> bool:
+    """Returns True if model_dir is a local directory which holds an exported ONNX model."""
+    return os.path.isdir(model_dir) and any(
+        name.endswith(".onnx") for name in os.listdir(model_dir)
+    )
+
+
+def configure_threads(
+    num_threads: int = None,
+    num_interop_threads: int = None,
+    cpu_affinity: Sequence[int] = None
+) -> None:
+    """Sets the number of threads torch uses within an operation (num_threads) and to run
+    independent operations in parallel (num_interop_threads), and pins the process to the CPUs
+    in cpu_affinity. Each setting which isn't given is read from the QG_NUM_THREADS,
+    QG_NUM_INTEROP_THREADS and QG_CPU_AFFINITY (e.g. "0-3,8") environment variables, and is left
+    unchanged if that isn't set either. When the process is pinned, num_threads defaults to the
+    number of CPUs it is pinned to.
+
+    By default torch uses every core of the machine, so several worker processes on one machine
+    should each be given a share of the cores, see gunicorn.conf.py.
+    """
+    if num_threads is None:
+        num_threads = _get_int_env("QG_NUM_THREADS")
+    if num_interop_threads is None:
+        num_interop_threads = _get_int_env("QG_NUM_INTEROP_THREADS")
+    # "auto" pins each gunicorn worker to its own CPUs, which is done by gunicorn.conf.py
+    if cpu_affinity is None and os.environ.get("QG_CPU_AFFINITY", "auto") != "auto":
+        cpu_affinity = parse_cpu_list(os.environ["QG_CPU_AFFINITY"])
+
+    if cpu_affinity:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpu_affinity)
+            num_threads = num_threads or len(cpu_affinity)
+        else:
+            warnings.warn("CPU affinity is not supported on this platform, ignoring it")
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    if num_interop_threads and torch.get_num_interop_threads() != num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # torch only allows this before it has started any inter-op parallel work
+            warnings.warn(
+                "Could not set the number of inter-op threads to {}, keeping {}".format(
+                    num_interop_threads, torch.get_num_interop_threads()
+                )
+            )
+
+
+def get_worker_cpus(slot: int, num_threads: int, cpus: Sequence[int] = None) -> List[int]:
+    """Returns the num_threads CPUs which the worker process in slot (counting from 0) should be
+    pinned to, so that workers with consecutive slots get disjoint sets of CPUs. CPUs are taken
+    from cpus, or from the CPUs the current process may run on, and are shared out again from
+    the start once every one of them has been given out.
+    """
+    if cpus is None:
+        cpus = get_available_cpus()
+
+    start = slot * num_threads
+    return [cpus[(start + i) % len(cpus)] for i in range(min(num_threads, len(cpus)))]
+
+
+def get_available_cpus() -> List[int]:
+    """Returns the CPUs which the current process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cpu_list(cpu_list: str) -> List[int]:
+    """Parses a list of CPUs in the format used by taskset and Linux, e.g. "0-3,8,10-11"."""
+    cpus = []
+
+    for part in cpu_list.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+
+    return cpus
+
+
+def _get_int_env(name: str) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+def has_native_bfloat16(device: torch.device) -> bool:
+    """Returns True if device can do bfloat16 arithmetic in hardware: CUDA GPUs from Ampere on,
+    and CPUs with the AVX-512 BF16 or AMX instructions.
+    """
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            flags = set(cpuinfo.read().split())
+    except OSError:
+        return False
+
+    return bool(flags & {"avx512_bf16", "amx_bf16"})
+
+
+def get_torch_dtype(dtype: str = None) -> torch.dtype:
+    """Converts a dtype name such as "float32" or "bfloat16" into a torch dtype. Returns None
+    if no dtype is given, so that the dtype stored in the checkpoint is used.
+    """
+    if dtype is None:
+        return None
+
+    if dtype == QUANTIZED_DTYPE:
+        raise ValueError("int8 models must be loaded with load_model")
+
+    torch_dtype = getattr(torch, dtype, None)
+    if not isinstance(torch_dtype, torch.dtype):
+        raise ValueError("Invalid dtype {}".format(dtype))
+
+    return torch_dtype
+
+
+register_backend("torch", load_torch_model)
+register_backend("onnx", load_onnx_model)
@@ -0,0 +1,224 @@
+#qg_cache.py
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Mapping
+
+
+class LRUCache:
+    """A thread-safe, in-memory least recently used cache. Entries are evicted once there are more
+    than max_entries of them, or once their total size is more than max_bytes (if set). The size of
+    an entry is measured by calling sizeof with its key and value.
+
+    A single cache can be shared by several threads, e.g. to memoize the questions generated for
+    individual model inputs across requests.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = None,
+        sizeof: Callable[[Any, Any], int] = None
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or _sizeof_entry
+        self.hits = 0
+        self.misses = 0
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(key, value)
+
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.num_bytes += size
+
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self.num_bytes > self.max_bytes
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.num_bytes -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def stats(self) -> Mapping[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class ResultCache:
+    """Caches the QA pairs generated for an article. Results are addressed by a hash of the
+    normalised article text and of everything else that changes the output, such as the
+    generation options and the model revisions.
+
+    Results are kept in an in-memory LRU cache. If path is given, they are also stored in a SQLite
+    database at that path, which keeps them across restarts and is shared by every process using
+    the same file. The database holds at most max_disk_entries results. Like LRUCache, it can
+    be shared by several threads.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        max_bytes: int = 64 * 1024 * 1024,
+        path: str = None,
+        max_disk_entries: int = 10000
+    ) -> None:
+        self.memory = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+        if path is not None:
+            db = self._get_db()
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS qg_results "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS qg_results_accessed ON qg_results (accessed)"
+            )
+            db.commit()
+
+    def make_key(self, article: str, **options: Any) -> str:
+        """Returns the cache key of an article generated with the given options. Options must be
+        JSON serialisable.
+        """
+        payload = json.dumps(
+            {"article": normalise_text(article), "options": options},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> List[Mapping[str, Any]]:
+        """Returns the cached QA pairs for key, or None if they aren't cached."""
+        value = self.memory.get(key)
+
+        if value is None and self.path is not None:
+            with self._db_lock:
+                db = self._get_db()
+                row = db.execute(
+                    "SELECT value FROM qg_results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    db.execute(
+                        "UPDATE qg_results SET accessed = ? WHERE key = ?", (time.time(), key)
+                    )
+                    db.commit()
+
+            if row is not None:
+                value = row[0]
+                with self._lock:
+                    self.disk_hits += 1
+                self.memory.put(key, value)
+
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        return json.loads(value)
+
+    def put(self, key: str, qa_list: List[Mapping[str, Any]]) -> None:
+        value = json.dumps(qa_list)
+        self.memory.put(key, value)
+
+        if self.path is not None:
+            with self._db_lock:
+                db = self._get_db()
+                db.execute(
+                    "INSERT OR REPLACE INTO qg_results (key, value, accessed) VALUES (?, ?, ?)",
+                    (key, value, time.time()),
+                )
+                db.execute(
+                    "DELETE FROM qg_results WHERE key NOT IN "
+                    "(SELECT key FROM qg_results ORDER BY accessed DESC LIMIT ?)",
+                    (self.max_disk_entries,),
+                )
+                db.commit()
+
+    def clear(self) -> None:
+        self.memory.clear()
+
+        if self.path is not None:
+            with self._db_lock:
+                db = self._get_db()
+                db.execute("DELETE FROM qg_results")
+                db.commit()
+
+    def _get_db(self) -> sqlite3.Connection:
+        # a connection mustn't be used by a process forked from the one which opened it (e.g. a
+        # gunicorn worker of a preloaded app), so each process opens its own
+        if self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db_pid = os.getpid()
+        return self._db
+
+    def stats(self) -> Mapping[str, int]:
+        memory_stats = self.memory.stats()
+        with self._lock:
+            return {
+                "memory_entries": memory_stats["entries"],
+                "memory_bytes": memory_stats["bytes"],
+                "memory_hits": memory_stats["hits"],
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+def _sizeof_entry(key: Any, value: Any) -> int:
+    return _sizeof(key) + _sizeof(value)
+
+
+def _sizeof(obj: Any) -> int:
+    """Approximates the number of bytes taken by strings, numbers and tuples of them."""
+    if isinstance(obj, str):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        return sum(_sizeof(item) for item in obj)
+    return 8
+
+
+def normalise_text(text: str) -> str:
+    """Normalises line endings and whitespace, and drops empty lines, so that copies of a text
+    which only differ in their whitespace share a cache entry.
+    """
+    lines = [re.sub(r"[ \t\f\v]+", " ", line).strip() for line in text.splitlines()]
+    return "\n".join(line for line in lines if line)
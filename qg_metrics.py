@@ -0,0 +1,218 @@
+#qg_metrics.py
+import logging
+import math
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Mapping, Tuple
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Instrumentation:
+    """Receives the counts and timings of the question generation pipeline. This base class
+    discards them, and is what QuestionGenerator uses by default. Subclasses send them somewhere
+    by overriding count and observe, e.g. Metrics, which keeps them for a Prometheus endpoint.
+
+    Names are snake_case, and labels are keyword arguments with string values.
+    """
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        """Adds value to the counter called name."""
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Records one observation of name, such as the size of a batch."""
+
+    @contextmanager
+    def span(self, stage: str, **labels: str) -> Iterator[None]:
+        """Times the block as one run of a stage of the pipeline, which is observed as
+        stage_seconds with a stage label.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+
+class Metrics(Instrumentation):
+    """Keeps the total of each counter, and the count, sum and maximum of each observed value,
+    for every combination of labels. It is thread-safe, so one Metrics can be shared by every
+    generator and thread of a process. Observations are also logged to logger at log_level, if
+    that level is enabled.
+    """
+
+    def __init__(self, logger: logging.Logger = None, log_level: int = logging.DEBUG) -> None:
+        self.logger = logger or logging.getLogger(__name__)
+        self.log_level = log_level
+        self._counters: Dict[_Key, float] = {}
+        self._summaries: Dict[_Key, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                self._summaries[key] = [1, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                summary[2] = max(summary[2], value)
+
+        if self.logger.isEnabledFor(self.log_level):
+            self.logger.log(self.log_level, "%s%s %.6g", name, _format_labels(labels), value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+
+    def snapshot(self) -> Mapping[str, Any]:
+        """Returns the counters and summaries as plain dicts, with each name's label sets
+        formatted as in Prometheus (e.g. 'stage_seconds{stage="ner"}').
+        """
+        with self._lock:
+            counters = {
+                name + _format_labels(labels): value
+                for (name, labels), value in self._counters.items()
+            }
+            summaries = {
+                name + _format_labels(labels): {"count": count, "sum": total, "max": maximum}
+                for (name, labels), (count, total, maximum) in self._summaries.items()
+            }
+
+        return {"counters": counters, "summaries": summaries}
+
+    def summaries(self, name: str) -> List[Tuple[Mapping[str, str], Mapping[str, float]]]:
+        """Returns the labels of every label set observed for name, each with the count, sum and
+        maximum of its observations.
+        """
+        with self._lock:
+            return [
+                (dict(labels), {"count": count, "sum": total, "max": maximum})
+                for (summary_name, labels), (count, total, maximum) in self._summaries.items()
+                if summary_name == name
+            ]
+
+    def to_prometheus(self, prefix: str = "qg_") -> str:
+        """Formats the metrics in the Prometheus text exposition format. Counters are exported
+        with a _total suffix, and observed values as summaries (_count and _sum) with a gauge of
+        their maximum (_max).
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted(self._summaries.items())
+
+        lines = []
+        for name, samples in _group_by_name(counters):
+            name = prefix + name
+            if not name.endswith("_total"):
+                name += "_total"
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(
+                f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples
+            )
+
+        for name, samples in _group_by_name(summaries):
+            name = prefix + name
+            lines.append(f"# TYPE {name} summary")
+            for labels, (count, total, _) in samples:
+                lines.append(f"{name}_count{_format_labels(labels)} {_format_value(count)}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"# TYPE {name}_max gauge")
+            lines.extend(
+                f"{name}_max{_format_labels(labels)} {_format_value(maximum)}"
+                for labels, (_, _, maximum) in samples
+            )
+
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def format_prometheus_gauges(stats: Mapping[str, Any], prefix: str = "qg_") -> str:
+    """Formats the numbers in a nested dict of statistics (such as the stats of a cache or of a
+    MicroBatcher) as Prometheus gauges, named after their path through the dict. Values which
+    aren't numbers are skipped.
+    """
+    lines = []
+
+    def add(path, value):
+        if isinstance(value, Mapping):
+            for key, child in value.items():
+                add(path + [str(key)], child)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            name = prefix + _sanitize_name("_".join(path))
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+
+    add([], stats)
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def get_memory_usage() -> Mapping[str, int]:
+    """Returns the memory used by the current process in bytes: its resident set size (rss),
+    its proportional set size (pss, which divides each shared page between the processes
+    sharing it), and how much of its resident memory is shared with other processes or private
+    to it. Returns an empty dict where /proc/self/smaps_rollup isn't available (before Linux
+    4.14, or on other platforms).
+    """
+    fields = {
+        "Rss": "rss",
+        "Pss": "pss",
+        "Shared_Clean": "shared",
+        "Shared_Dirty": "shared",
+        "Private_Clean": "private",
+        "Private_Dirty": "private",
+    }
+    usage = {}
+
+    try:
+        with open("/proc/self/smaps_rollup") as smaps:
+            for line in smaps:
+                parts = line.split()
+                if parts[0].rstrip(":") in fields and parts[-1] == "kB":
+                    name = fields[parts[0].rstrip(":")]
+                    usage[name] = usage.get(name, 0) + int(parts[1]) * 1024
+    except OSError:
+        return {}
+
+    return usage
+
+
+def _group_by_name(items: List[Tuple[_Key, Any]]) -> Iterator[Tuple[str, List[Tuple[Any, Any]]]]:
+    groups: Dict[str, List[Tuple[Any, Any]]] = {}
+    for (name, labels), value in items:
+        groups.setdefault(name, []).append((labels, value))
+    return iter(groups.items())
+
+
+def _format_labels(labels: Any) -> str:
+    if isinstance(labels, Mapping):
+        labels = sorted(labels.items())
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, _escape_label(value)) for key, value in labels) + "}"
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _sanitize_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
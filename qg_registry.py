@@ -0,0 +1,70 @@
+#qg_registry.py
+import threading
+from typing import Any, Dict, Tuple
+
+_generators: Dict[Tuple[str, str, str, str], Any] = {}
+_registry_lock = threading.Lock()
+_loading_locks: Dict[Tuple[str, str, str, str], threading.Lock] = {}
+
+
+def get_question_generator(
+    model_dir: str = None,
+    device: str = None,
+    dtype: str = None,
+    backend: str = "torch",
+    **options: Any
+) -> Any:
+    """Returns the QuestionGenerator shared by the whole process for the given checkpoint, device,
+    dtype and backend, loading it the first time it is requested. Any other options are passed on to the
+    QuestionGenerator constructor when it is created, and are ignored once it has been loaded.
+
+    It is safe to call from several threads: each generator is only ever loaded once, and threads
+    asking for a generator that is still loading wait for it instead of loading their own copy.
+    """
+    key = _get_key(model_dir, device, dtype, backend)
+    generator = _generators.get(key)
+    if generator is not None:
+        return generator
+
+    with _registry_lock:
+        loading_lock = _loading_locks.setdefault(key, threading.Lock())
+
+    with loading_lock:
+        generator = _generators.get(key)
+        if generator is None:
+            from questiongenerator import QuestionGenerator
+            generator = QuestionGenerator(
+                model_dir=key[0], device=key[1], dtype=dtype, backend=backend, **options
+            )
+            _generators[key] = generator
+
+    return generator
+
+
+def find_question_generator(
+    model_dir: str = None,
+    device: str = None,
+    dtype: str = None,
+    backend: str = "torch"
+) -> Any:
+    """Returns the QuestionGenerator which get_question_generator has loaded for the given
+    checkpoint, device, dtype and backend, or None if it hasn't been loaded (yet). Never loads
+    a generator, nor imports the NLP stack while no generator has been loaded.
+    """
+    if not _generators:
+        return None
+
+    return _generators.get(_get_key(model_dir, device, dtype, backend))
+
+
+def clear_question_generators() -> None:
+    """Drops every loaded generator, so that the next request loads the models again."""
+    with _registry_lock:
+        _generators.clear()
+        _loading_locks.clear()
+
+
+def _get_key(model_dir: str, device: str, dtype: str, backend: str) -> Tuple[str, str, str, str]:
+    from questiongenerator import QG_PRETRAINED, get_device
+
+    return (model_dir or QG_PRETRAINED, str(get_device(device)), dtype, backend)
@@ -0,0 +1,161 @@
+#qg_scheduler.py
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, List, Mapping, Sequence
+
+
+class MicroBatcher:
+    """Combines the items submitted by concurrent threads into batches, so that many small
+    requests share each call to a model instead of each making their own small calls.
+
+    process_batch is called as process_batch(items, key) with items which were all submitted
+    with the same key (e.g. the decoding preset), and must return one result per item. A batch
+    is run as soon as max_batch_size items with the same key are waiting, or once the oldest
+    waiting item has waited for max_wait seconds. Batches are run one at a time by a single
+    background thread, and their results are routed back to the threads which submitted them.
+
+    At most max_queue_size items can be waiting at once. Beyond that, submitting threads block
+    until there is room again.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any], Hashable], Sequence[Any]],
+        max_batch_size: int = 16,
+        max_wait: float = 0.01,
+        max_queue_size: int = 1024,
+        name: str = "batcher"
+    ) -> None:
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.name = name
+        self._queues = OrderedDict()
+        self._num_waiting = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+        self._batches = 0
+        self._items = 0
+        self._errors = 0
+        self._max_queue_depth = 0
+        self._wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+        self._process_seconds = 0.0
+
+    def submit(self, items: Sequence[Any], key: Hashable = None) -> List[Any]:
+        """Queues items, waits until all of them have been processed, and returns their results
+        in the same order. If processing a batch fails, its exception is raised here.
+        """
+        futures = [self.submit_one(item, key) for item in items]
+        return [future.result() for future in futures]
+
+    def submit_one(self, item: Any, key: Hashable = None) -> Future:
+        """Queues one item, and returns a future which will hold its result."""
+        future = Future()
+
+        with self._condition:
+            self._start()
+
+            while self._num_waiting >= self.max_queue_size:
+                self._condition.wait()
+
+            self._queues.setdefault(key, deque()).append((item, future, time.perf_counter()))
+            self._num_waiting += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._num_waiting)
+            self._condition.notify_all()
+
+        return future
+
+    def stats(self) -> Mapping[str, float]:
+        """Returns the current queue depth, and totals of the batches run so far."""
+        with self._condition:
+            return {
+                "queue_depth": self._num_waiting,
+                "max_queue_depth": self._max_queue_depth,
+                "batches": self._batches,
+                "items": self._items,
+                "errors": self._errors,
+                "mean_batch_size": self._items / self._batches if self._batches else 0.0,
+                "mean_wait_seconds": self._wait_seconds / self._items if self._items else 0.0,
+                "max_wait_seconds": self._max_wait_seconds,
+                "process_seconds": self._process_seconds,
+            }
+
+    def _start(self) -> None:
+        # the thread doesn't survive a fork, so forked worker processes start their own
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="{}-micro-batcher".format(self.name), daemon=True
+            )
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                key, batch = self._take_batch()
+            self._run_batch(key, batch)
+
+    def _take_batch(self) -> Any:
+        """Waits until a batch is ready, and removes it from the queue. Must be called with the
+        condition held.
+        """
+        while True:
+            while not self._num_waiting:
+                self._condition.wait()
+
+            # None is a valid key, so full queues are found by their keys' presence
+            full_keys = [
+                key for key, queue in self._queues.items() if len(queue) >= self.max_batch_size
+            ]
+            if full_keys:
+                key = full_keys[0]
+                break
+
+            # otherwise the key whose oldest item has waited the longest
+            key = min(self._queues, key=lambda key: self._queues[key][0][2])
+            timeout = self._queues[key][0][2] + self.max_wait - time.perf_counter()
+            if timeout <= 0:
+                break
+            self._condition.wait(timeout)
+
+        queue = self._queues[key]
+        batch = [queue.popleft() for _ in range(min(len(queue), self.max_batch_size))]
+        if not queue:
+            del self._queues[key]
+
+        self._num_waiting -= len(batch)
+        self._condition.notify_all()
+        return key, batch
+
+    def _run_batch(self, key: Hashable, batch: List[Any]) -> None:
+        start = time.perf_counter()
+
+        try:
+            results = self.process_batch([item for item, _, _ in batch], key)
+            if len(results) != len(batch):
+                raise RuntimeError(
+                    "{} returned {} results for {} items".format(self.name, len(results), len(batch))
+                )
+        except Exception as error:
+            failed = True
+            for _, future, _ in batch:
+                future.set_exception(error)
+        else:
+            failed = False
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+        end = time.perf_counter()
+
+        with self._condition:
+            self._batches += 1
+            self._items += len(batch)
+            self._errors += failed
+            self._process_seconds += end - start
+            for _, _, submitted in batch:
+                self._wait_seconds += start - submitted
+                self._max_wait_seconds = max(self._max_wait_seconds, start - submitted)
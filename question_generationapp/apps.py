@@ -1,6 +1,20 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class QuestionGenerationappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'question_generationapp'
+
+    def ready(self):
+        # Load the models once, before gunicorn forks its workers, so that they share them
+        if settings.QG_PRELOAD:
+            from .generation import preload_shared_question_generator
+            preload_shared_question_generator()
+
+        # Load the models once at startup instead of on the first request
+        elif settings.QG_WARMUP:
+            from questiongenerator import get_spacy_nlp
+            from .generation import get_shared_question_generator
+            get_shared_question_generator()
+            get_spacy_nlp()
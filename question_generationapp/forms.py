@@ -72,3 +72,13 @@ from django import forms
 
 class TextContentForm(forms.Form):
     text_content = forms.CharField(widget=forms.Textarea, label='Text Content')
+    decoding = forms.ChoiceField(
+        choices=[
+            ('', 'Default'),
+            ('fast', 'Fast'),
+            ('balanced', 'Balanced'),
+            ('quality', 'Best quality'),
+        ],
+        required=False,
+        label='Speed / quality',
+    )
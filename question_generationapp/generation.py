@@ -0,0 +1,149 @@
+import gc
+import os
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from qg_cache import LRUCache, ResultCache
+from qg_metrics import Metrics, get_memory_usage
+from qg_registry import find_question_generator, get_question_generator
+
+
+def get_shared_question_generator():
+    """Returns the process-wide QuestionGenerator configured by the QG_* settings."""
+    return get_question_generator(
+        model_dir=settings.QG_MODEL_DIR,
+        device=settings.QG_DEVICE,
+        dtype=settings.QG_DTYPE,
+        backend=settings.QG_BACKEND,
+        backend_options=_get_backend_options(),
+        evaluator_dir=settings.QG_EVALUATOR_DIR,
+        num_threads=settings.QG_NUM_THREADS or None,
+        num_interop_threads=settings.QG_NUM_INTEROP_THREADS or None,
+        cpu_affinity=_get_cpu_affinity(),
+        micro_batch_wait=_get_micro_batch_wait(),
+        micro_batch_queue_size=settings.QG_MICRO_BATCH_QUEUE_SIZE,
+        micro_batch_size=settings.QG_MICRO_BATCH_SIZE or None,
+        result_cache=_get_result_cache(),
+        question_memo=_get_memo("questions"),
+        score_memo=_get_memo("scores"),
+        instrumentation=get_metrics(),
+    )
+
+
+def preload_shared_question_generator():
+    """Loads the shared generator and spaCy pipeline in a process which is about to fork its
+    workers (gunicorn's master with preload_app), so that the workers share one copy of them.
+
+    The models' weights are only shared until they are written to. With QG_MMAP_WEIGHTS they
+    are mapped from the checkpoint files rather than copied into memory, and every long-lived
+    object is moved out of the garbage collector's reach, since collections in the workers
+    would otherwise write to the objects' headers and copy the pages holding them.
+    """
+    if settings.QG_BACKEND != "torch":
+        # ONNX Runtime's thread pools don't survive a fork
+        raise ImproperlyConfigured("QG_PRELOAD requires QG_BACKEND=torch")
+
+    from questiongenerator import get_spacy_nlp
+
+    # checking the fast tokenizer when it is loaded starts its thread pool, which forked
+    # processes can't use
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    get_shared_question_generator()
+    get_spacy_nlp()
+    gc.collect()
+    gc.freeze()
+
+
+@lru_cache(maxsize=None)
+def get_metrics():
+    """Returns the Metrics which the shared generator reports its stage timings and counts to."""
+    return Metrics()
+
+
+def get_generation_stats():
+    """Returns the statistics of the shared generator's decoding presets, micro-batching
+    scheduler and caches, and the memory used by this worker process.
+
+    Scraping the statistics never loads the generator: until a request has loaded it, only the
+    stage metrics and memory usage are reported.
+    """
+    stats = {
+        "metrics": get_metrics().snapshot(),
+        "memory": get_memory_usage(),
+    }
+
+    qg = find_question_generator(
+        model_dir=settings.QG_MODEL_DIR,
+        device=settings.QG_DEVICE,
+        dtype=settings.QG_DTYPE,
+        backend=settings.QG_BACKEND,
+    )
+    if qg is None:
+        return stats
+
+    stats["decoding"] = qg.decoding_stats.stats()
+    if qg.question_batcher is not None:
+        stats["micro_batching"] = {
+            "questions": qg.question_batcher.stats(),
+            "scores": qg.qa_evaluator.batcher.stats(),
+        }
+    if _get_result_cache() is not None:
+        stats["result_cache"] = _get_result_cache().stats()
+    if _get_memo("questions") is not None:
+        stats["memo"] = {name: _get_memo(name).stats() for name in ["questions", "scores"]}
+
+    return stats
+
+
+def _get_micro_batch_wait():
+    if settings.QG_MICRO_BATCH_WAIT_MS <= 0:
+        return None
+    return settings.QG_MICRO_BATCH_WAIT_MS / 1000
+
+
+def _get_cpu_affinity():
+    # "auto" pins each gunicorn worker to its own CPUs, which gunicorn.conf.py does as it starts
+    if not settings.QG_CPU_AFFINITY or settings.QG_CPU_AFFINITY == "auto":
+        return None
+
+    from qg_backends import parse_cpu_list
+
+    return parse_cpu_list(settings.QG_CPU_AFFINITY)
+
+
+def _get_backend_options():
+    if settings.QG_BACKEND == "torch":
+        return {"mmap_weights": settings.QG_MMAP_WEIGHTS}
+    if settings.QG_BACKEND != "onnx":
+        return None
+
+    return {
+        "graph_optimization_level": settings.QG_ONNX_GRAPH_OPTIMIZATION,
+        "intra_op_num_threads": settings.QG_ONNX_INTRA_OP_THREADS or settings.QG_NUM_THREADS,
+        "inter_op_num_threads": settings.QG_ONNX_INTER_OP_THREADS,
+    }
+
+
+@lru_cache(maxsize=None)
+def _get_result_cache():
+    if not settings.QG_RESULT_CACHE_ENTRIES:
+        return None
+
+    return ResultCache(
+        max_entries=settings.QG_RESULT_CACHE_ENTRIES,
+        max_bytes=settings.QG_RESULT_CACHE_BYTES,
+        path=settings.QG_RESULT_CACHE_PATH,
+    )
+
+
+@lru_cache(maxsize=None)
+def _get_memo(name):
+    if not settings.QG_MEMO_ENTRIES:
+        return None
+
+    return LRUCache(
+        max_entries=settings.QG_MEMO_ENTRIES,
+        max_bytes=settings.QG_MEMO_BYTES,
+    )
@@ -0,0 +1,222 @@
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .generation import get_shared_question_generator
+from .models import GenerationJob
+
+logger = logging.getLogger(__name__)
+
+_job_submitted = threading.Event()
+_local_pool = None
+_local_pool_lock = threading.Lock()
+
+
+def submit_job(text, user=None, **options):
+    """Queues a job to generate questions for text. options are passed on to
+    QuestionGenerator.generate_stream (num_questions, answer_style, use_evaluator, decoding).
+    """
+    job = GenerationJob.objects.create(text=text, user=user, options=options)
+    start_local_workers()
+    _job_submitted.set()
+    return job
+
+
+def job_to_dict(job):
+    data = {
+        'id': str(job.id),
+        'status': job.status,
+        'progress': job.progress,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == GenerationJob.Status.SUCCEEDED:
+        data['result'] = job.result
+    if job.status == GenerationJob.Status.FAILED:
+        data['error'] = job.error
+    return data
+
+
+def claim_next_job(worker_id):
+    """Claims the oldest queued job for worker_id and marks it as running, or returns None if
+    there is nothing to do. Jobs whose worker hasn't updated them for QG_JOB_TIMEOUT seconds
+    (e.g. because its process was killed) are claimed again.
+
+    The claim is a single conditional UPDATE, so it is safe when several threads or processes
+    share the database: only one of them can move a job out of the claimable state.
+    """
+    now = timezone.now()
+    claimable = Q(status=GenerationJob.Status.QUEUED) | Q(
+        status=GenerationJob.Status.RUNNING,
+        updated_at__lt=now - timedelta(seconds=settings.QG_JOB_TIMEOUT),
+    )
+
+    for job_id in GenerationJob.objects.filter(claimable).values_list('id', flat=True)[:10]:
+        claimed = GenerationJob.objects.filter(claimable, id=job_id).update(
+            status=GenerationJob.Status.RUNNING,
+            worker=worker_id,
+            progress=0,
+            started_at=now,
+            updated_at=now,
+        )
+        if claimed:
+            return GenerationJob.objects.get(id=job_id)
+
+    return None
+
+
+def run_job(job):
+    """Generates the questions of a claimed job, recording its progress as batches of questions
+    are generated, and then its result or error. While it runs, the job is kept alive by a
+    JobHeartbeat, since stages such as NER and evaluation report no progress.
+    """
+    options = job.options
+    try:
+        qg = get_shared_question_generator()
+        qa_list = []
+
+        with JobHeartbeat(job, settings.QG_JOB_TIMEOUT / 3):
+            for event in qg.generate_stream(
+                job.text,
+                use_evaluator=options.get('use_evaluator', True),
+                num_questions=options.get('num_questions', 10),
+                answer_style=options.get('answer_style', 'all'),
+                early_exit=settings.QG_EARLY_EXIT,
+                decoding=options.get('decoding') or settings.QG_DECODING,
+            ):
+                if event['event'] == 'batch':
+                    _update_job(job, progress=event['completed'] / max(event['total'], 1))
+                else:
+                    qa_list = event['qa_pairs']
+
+    except Exception as error:
+        logger.exception('Generation job %s failed', job.id)
+        _update_job(
+            job,
+            status=GenerationJob.Status.FAILED,
+            error=str(error) or type(error).__name__,
+            finished_at=timezone.now(),
+        )
+    else:
+        _update_job(
+            job,
+            status=GenerationJob.Status.SUCCEEDED,
+            progress=1,
+            result=qa_list,
+            finished_at=timezone.now(),
+        )
+
+
+def _update_job(job, **fields):
+    """Updates a job if it still belongs to job.worker, and returns whether it did."""
+    # a job which was claimed again after timing out belongs to its new worker
+    return GenerationJob.objects.filter(id=job.id, worker=job.worker).update(
+        updated_at=timezone.now(), **fields
+    ) > 0
+
+
+class JobHeartbeat:
+    """Refreshes the updated_at of a running job every interval seconds from a background
+    thread, for as long as the with block runs, so that the job isn't claimed again by another
+    worker while it is busy in a long stage. Stops once the job belongs to another worker.
+    """
+
+    def __init__(self, job, interval):
+        self.job = job
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f'generation-job-heartbeat-{job.id}', daemon=True
+        )
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stopping.wait(self.interval):
+                if not _update_job(self.job):
+                    logger.warning('Generation job %s was claimed by another worker', self.job.id)
+                    return
+        finally:
+            # the thread has its own database connection
+            connection.close()
+
+
+class JobWorkerPool:
+    """Runs queued generation jobs in num_workers background threads. The threads share the
+    process's question generator, so the models are loaded once and stay loaded between jobs.
+
+    Jobs are queued in the database, so no separate broker is needed: a pool can run inside
+    each web worker process (see start_local_workers), or in its own process with the
+    run_generation_jobs management command, as long as it shares the web app's database.
+    """
+
+    def __init__(self, num_workers=1, poll_interval=1.0):
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            worker_id = f'{socket.gethostname()}:{os.getpid()}:{i}'
+            thread = threading.Thread(
+                target=self._run, args=(worker_id,), name=f'generation-job-worker-{i}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stops the threads once they have finished their current job."""
+        self._stopping.set()
+        _job_submitted.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, worker_id):
+        while not self._stopping.is_set():
+            close_old_connections()
+            job = claim_next_job(worker_id)
+
+            if job is None:
+                # woken early when a job is submitted by this process
+                _job_submitted.wait(self.poll_interval)
+                _job_submitted.clear()
+                continue
+
+            run_job(job)
+
+        connection.close()
+
+
+def start_local_workers():
+    """Starts the QG_JOB_WORKERS in-process worker threads of this process, if they haven't
+    been started yet. Does nothing when QG_JOB_WORKERS is 0, in which case jobs are left to
+    the run_generation_jobs management command.
+    """
+    global _local_pool
+
+    if settings.QG_JOB_WORKERS <= 0 or _local_pool is not None:
+        return
+
+    with _local_pool_lock:
+        if _local_pool is None:
+            _local_pool = JobWorkerPool(settings.QG_JOB_WORKERS, settings.QG_JOB_POLL_INTERVAL)
+            _local_pool.start()
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from question_generationapp.jobs import JobWorkerPool
+
+
+class Command(BaseCommand):
+    help = 'Runs queued question generation jobs until interrupted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Number of worker threads')
+        parser.add_argument(
+            '--poll_interval',
+            type=float,
+            default=settings.QG_JOB_POLL_INTERVAL,
+            help='Seconds to wait before checking for new jobs again',
+        )
+
+    def handle(self, *args, **options):
+        pool = JobWorkerPool(options['workers'], options['poll_interval'])
+        pool.start()
+        self.stdout.write(f"Running generation jobs with {options['workers']} worker(s)")
+
+        try:
+            pool.join()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping once the current jobs have finished...')
+            pool.stop()
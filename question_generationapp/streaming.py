@@ -0,0 +1,79 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+
+from .generation import get_shared_question_generator
+
+
+async def stream_generation(text, **options):
+    """Asynchronously yields the events of QuestionGenerator.generate_stream for text, with
+    options passed on to it (num_questions, answer_style, use_evaluator, decoding).
+
+    The generator is stepped one batch at a time in the inference executor, so the event loop
+    stays free while the model runs, and a request only occupies an executor thread while one
+    of its batches is being generated. If the caller stops iterating (e.g. because the task
+    serving a client which disconnected is cancelled), no further batches are generated.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_inference_executor()
+    # a generator can't be closed while another thread is running it, so closing it waits for
+    # the batch in progress
+    lock = threading.Lock()
+    stream = None
+
+    def start():
+        nonlocal stream
+        with lock:
+            stream = get_shared_question_generator().generate_stream(text, **options)
+
+    def step():
+        with lock:
+            return next(stream, None)
+
+    def close():
+        with lock:
+            if stream is not None:
+                stream.close()
+
+    try:
+        await loop.run_in_executor(executor, start)
+        while True:
+            event = await loop.run_in_executor(executor, step)
+            if event is None:
+                return
+            yield event
+    finally:
+        executor.submit(close)
+
+
+async def to_server_sent_events(events):
+    """Formats each event as a server-sent event named after its 'event' field. If generating
+    fails, an 'error' event is sent before the stream ends.
+    """
+    try:
+        async for event in events:
+            yield format_server_sent_event(event['event'], event)
+    except ValueError as error:
+        yield format_server_sent_event('error', {'error': str(error)})
+    except Exception:
+        yield format_server_sent_event('error', {'error': 'Question generation failed'})
+        raise
+
+
+def format_server_sent_event(name, data):
+    return f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+@lru_cache(maxsize=None)
+def get_inference_executor():
+    """Returns the thread pool which runs the models for async requests. Its
+    QG_ASYNC_INFERENCE_THREADS threads are shared by every request of the process, so waiting
+    requests cost no thread of their own.
+    """
+    return ThreadPoolExecutor(
+        max_workers=settings.QG_ASYNC_INFERENCE_THREADS, thread_name_prefix='qg-inference'
+    )
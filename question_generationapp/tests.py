@@ -1,3 +1,1153 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from functools import lru_cache
+from unittest import mock
 
-# Create your tests here.
+import spacy
+import torch
+from django.conf import settings
+from django.db.models.query import QuerySet
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from spacy.tokens import Span
+from transformers import AutoTokenizer, T5Config, T5ForConditionalGeneration
+
+from benchmark_qg import create_tiny_models, get_text_of_size
+from qg_backends import load_torch_model
+from qg_cache import LRUCache, ResultCache
+from qg_metrics import Metrics
+from qg_registry import clear_question_generators
+from qg_scheduler import MicroBatcher
+from questiongenerator import (
+    DECODING_PRESETS,
+    MAX_SENTENCE_LEN,
+    SENTENCE_LABEL,
+    TOKENIZER_PARITY_TEXTS,
+    DistractorIndex,
+    QAEvaluator,
+    QuestionGenerator,
+    get_tokenizer_mismatches,
+    load_qg_tokenizer,
+    split_sentences,
+)
+
+from .generation import get_generation_stats, get_shared_question_generator
+from .jobs import JobHeartbeat, _update_job, claim_next_job, run_job
+from .models import GenerationJob
+
+TINY_MODEL_TEXT = '''The Apollo program was the third United States human spaceflight program. It was
+carried out by NASA, and succeeded in landing the first humans on the Moon from 1969 to 1972.
+Apollo 11 launched from Florida on July 16, 1969, carrying Neil Armstrong, Buzz Aldrin and
+Michael Collins. Armstrong and Aldrin landed in the Sea of Tranquility four days later.
+Collins remained in lunar orbit aboard the command module Columbia.
+The program used the Saturn V rocket, which is still one of the most powerful rockets ever flown.
+Six missions landed on the Moon, and their crews brought back 382 kilograms of lunar rocks.
+Apollo 13 suffered an oxygen tank explosion, but its crew returned safely to Earth.
+The last mission, Apollo 17, left the Moon in December 1972.'''
+
+_tiny_models_dir = tempfile.TemporaryDirectory()
+
+
+@lru_cache(maxsize=None)
+def get_tiny_models():
+    """Creates tiny randomly initialised question generation and evaluator models, with
+    tokenizers learned from TINY_MODEL_TEXT, so that tests don't need the pretrained models.
+    Returns their directories.
+    """
+    return create_tiny_models(TINY_MODEL_TEXT, _tiny_models_dir.name)
+
+
+class QGTokenizerParityTests(SimpleTestCase):
+    """The tiny model's tokenizer is a SentencePiece T5 tokenizer with the <answer> and
+    <context> tokens, like the pretrained model's.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.model_dir, _ = get_tiny_models()
+        cls.slow_tokenizer = AutoTokenizer.from_pretrained(cls.model_dir, use_fast=False)
+        cls.fast_tokenizer = AutoTokenizer.from_pretrained(cls.model_dir, use_fast=True)
+
+    def test_fast_tokenizer_matches_slow_ids(self):
+        self.assertTrue(self.fast_tokenizer.is_fast)
+        self.assertEqual(get_tokenizer_mismatches(self.slow_tokenizer, self.fast_tokenizer), [])
+
+        for text in TOKENIZER_PARITY_TEXTS:
+            self.assertEqual(
+                self.fast_tokenizer(text)['input_ids'], self.slow_tokenizer(text)['input_ids']
+            )
+
+    def test_load_qg_tokenizer_prefers_fast_tokenizer(self):
+        self.assertTrue(load_qg_tokenizer(self.model_dir).is_fast)
+        self.assertFalse(load_qg_tokenizer(self.model_dir, use_fast=False).is_fast)
+
+    def test_load_qg_tokenizer_falls_back_to_slow_tokenizer(self):
+        mismatched_tokenizer = AutoTokenizer.from_pretrained(self.model_dir, use_fast=True)
+        mismatched_tokenizer.add_tokens(['Paris'])
+
+        with mock.patch(
+            'questiongenerator._load_fast_tokenizer', return_value=mismatched_tokenizer
+        ), self.assertWarns(UserWarning):
+            tokenizer = load_qg_tokenizer(self.model_dir)
+
+        self.assertFalse(tokenizer.is_fast)
+
+
+class SplitSentencesTests(SimpleTestCase):
+
+    LONG_SENTENCE = (
+        'In 1969, Apollo 11, the first crewed lunar landing mission, launched from Florida, USA, '
+        'carrying Armstrong, Aldrin, and Collins, on July 16.'
+    )
+
+    def assert_offsets(self, text, sentences):
+        for sentence, start, end in sentences:
+            self.assertEqual(text[start:end], sentence)
+
+    def test_keeps_order_and_offsets(self):
+        text = 'First sentence.  Second one?\nThird, on a new line!'
+        sentences = split_sentences(text)
+
+        self.assertEqual(
+            [sentence for sentence, _, _ in sentences],
+            ['First sentence.', 'Second one?', 'Third, on a new line!'],
+        )
+        self.assert_offsets(text, sentences)
+
+    def test_returns_repeated_sentences_once(self):
+        text = 'The Moon is far. It is big. The Moon is far.'
+
+        self.assertEqual(
+            [sentence for sentence, _, _ in split_sentences(text)],
+            ['The Moon is far.', 'It is big.'],
+        )
+
+    def test_ignores_unterminated_text(self):
+        text = 'A finished sentence. An unfinished one'
+
+        self.assertEqual(split_sentences(text), [('A finished sentence.', 0, 20)])
+        self.assertEqual(split_sentences('no terminator at all'), [])
+
+    def test_adds_fragments_of_long_sentences(self):
+        self.assertGreater(len(self.LONG_SENTENCE), MAX_SENTENCE_LEN)
+        text = f'Short one. {self.LONG_SENTENCE} The end.'
+        sentences = split_sentences(text)
+
+        self.assertEqual(
+            [sentence for sentence, _, _ in sentences],
+            [
+                'Short one.',
+                self.LONG_SENTENCE,
+                'the first crewed lunar landing mission',
+                'The end.',
+            ],
+        )
+        self.assert_offsets(text, sentences)
+
+    def test_keeps_long_sentences_whole_without_split_long(self):
+        self.assertEqual(
+            split_sentences(self.LONG_SENTENCE, split_long=False),
+            [(self.LONG_SENTENCE, 0, len(self.LONG_SENTENCE))],
+        )
+
+    def test_long_sentence_without_separators_is_kept_once(self):
+        sentence = ' '.join(['word'] * 40) + '.'
+        self.assertGreater(len(sentence), MAX_SENTENCE_LEN)
+
+        self.assertEqual(split_sentences(sentence), [(sentence, 0, len(sentence))])
+
+
+class SentenceInputTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        model_dir, evaluator_dir = get_tiny_models()
+        cls.qg = QuestionGenerator(model_dir=model_dir, evaluator_dir=evaluator_dir, device='cpu')
+        cls.text = get_text_of_size(TINY_MODEL_TEXT, 8000)
+
+    def test_input_ids_match_tokenized_inputs(self):
+        # one paragraph per line, and a single paragraph which has to be split into windows
+        for text in [self.text, self.text.replace('\n', ' ')]:
+            with self.subTest(paragraphs=text.count('\n') + 1):
+                inputs, _, _, input_ids = self.qg._generate_qg_candidates(text, 'sentences')
+                expected_ids = self.qg.qg_tokenizer(
+                    inputs, max_length=self.qg.SEQ_LENGTH, truncation=True
+                )['input_ids']
+
+                # segments cut inside a word fall back to tokenizing their inputs
+                reused = [i for i, ids in enumerate(input_ids) if ids is not None]
+
+                self.assertGreater(len(self.qg._get_segments(text)), 1)
+                self.assertGreater(len(reused), len(input_ids) // 2)
+                self.assertTrue(any(len(input_ids[i]) == self.qg.SEQ_LENGTH for i in reused))
+                for i in reused:
+                    self.assertEqual(input_ids[i], expected_ids[i])
+
+    def test_segments_start_with_first_word_of_paragraph(self):
+        segments = self.qg._get_segments(self.text)
+        paragraphs = [p for p in self.text.split('\n') if p]
+
+        self.assertTrue(segments[0].text.startswith(paragraphs[0].split()[0]))
+        for segment in segments[1:]:
+            self.assertTrue(any(segment.text.startswith(p.strip()) for p in paragraphs))
+
+    def test_contexts_are_not_tokenized_again(self):
+        inputs, _, _, input_ids = self.qg._generate_qg_candidates(self.text, 'sentences')
+
+        tokenizer_class = type(self.qg.qg_tokenizer)
+
+        with mock.patch.object(
+            tokenizer_class, '__call__', autospec=True, side_effect=tokenizer_class.__call__
+        ) as tokenize:
+            self.qg.generate_questions_from_inputs(inputs[:2])
+            tokenize.assert_called_once()
+            tokenize.reset_mock()
+
+            list(self.qg._generate_question_batches(inputs[:2], input_ids=input_ids[:2]))
+            tokenize.assert_not_called()
+
+    def test_sentence_splitting_is_timed_separately(self):
+        metrics = Metrics()
+        split_text = self.qg._split_text
+
+        def slow_split_text(text, *args, **kwargs):
+            time.sleep(0.05)
+            return split_text(text, *args, **kwargs)
+
+        with mock.patch.object(self.qg, 'instrumentation', metrics), mock.patch.object(
+            self.qg, '_split_text', side_effect=slow_split_text
+        ) as split:
+            self.qg._generate_qg_candidates(self.text, 'sentences')
+
+        stages = {
+            labels['stage']: summary['sum']
+            for labels, summary in metrics.summaries('stage_seconds')
+        }
+        split_seconds = 0.05 * split.call_count
+
+        self.assertEqual(
+            sorted(stages), ['sentence_inputs', 'split_into_segments', 'split_sentences']
+        )
+        self.assertGreaterEqual(stages['split_sentences'], split_seconds)
+        self.assertLess(stages['sentence_inputs'], split_seconds)
+
+
+class EarlyExitTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        model_dir, evaluator_dir = get_tiny_models()
+        # one round is enough for every candidate, so early exit doesn't prune any of them
+        cls.qg = QuestionGenerator(
+            model_dir=model_dir, evaluator_dir=evaluator_dir, device='cpu', batch_size=256
+        )
+
+    def test_early_exit_returns_same_questions_when_nothing_is_pruned(self):
+        options = {'num_questions': 5, 'answer_style': 'sentences', 'use_evaluator': True}
+
+        qa_pairs = self.qg.generate(TINY_MODEL_TEXT, early_exit=False, **options)
+        early_exit_qa_pairs = self.qg.generate(TINY_MODEL_TEXT, early_exit=True, **options)
+
+        self.assertEqual(len(qa_pairs), 5)
+        self.assertEqual(early_exit_qa_pairs, qa_pairs)
+
+    def test_prerank_candidates(self):
+        answers = [
+            'Too short.',
+            'A sentence of a moderate length, which makes for a good question.',
+            [{'answer': '1969', 'correct': True}, {'answer': '1972', 'correct': False}],
+            [{'answer': 'NASA', 'correct': True}, {'answer': 'Apollo', 'correct': False}],
+            'A sentence of a moderate length, which makes for a good question.',
+        ]
+        labels = [SENTENCE_LABEL, SENTENCE_LABEL, 'DATE', 'ORG', SENTENCE_LABEL]
+
+        # the repeated sentence is dropped, and the rest are ordered by priority
+        self.assertEqual(self.qg._prerank_candidates(answers, labels), [1, 3, 2, 0])
+
+
+class GenerateStreamTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        model_dir, evaluator_dir = get_tiny_models()
+        # a small batch size, so that the questions are streamed in several batches
+        cls.qg = QuestionGenerator(
+            model_dir=model_dir, evaluator_dir=evaluator_dir, device='cpu', batch_size=2
+        )
+
+    def assert_stream_matches_generate(self, **options):
+        options['answer_style'] = 'sentences'
+        events = list(self.qg.generate_stream(TINY_MODEL_TEXT, **options))
+        batches, final = events[:-1], events[-1]
+
+        self.assertEqual(final['event'], 'final')
+        self.assertEqual(final['qa_pairs'], self.qg.generate(TINY_MODEL_TEXT, **options))
+
+        self.assertGreater(len(batches), 1)
+        self.assertTrue(all(event['event'] == 'batch' for event in batches))
+        completed = [event['completed'] for event in batches]
+        self.assertEqual(completed, sorted(set(completed)))
+        self.assertEqual(completed[-1], sum(len(event['qa_pairs']) for event in batches))
+        self.assertEqual(len({event['total'] for event in batches}), 1)
+        self.assertLessEqual(completed[-1], batches[0]['total'])
+
+    def test_final_event_matches_generate(self):
+        self.assert_stream_matches_generate(num_questions=5)
+
+    def test_final_event_matches_generate_without_evaluator(self):
+        self.assert_stream_matches_generate(use_evaluator=False)
+
+    def test_final_event_matches_generate_with_early_exit(self):
+        self.assert_stream_matches_generate(num_questions=2, early_exit=True)
+
+
+class DecodingPresetTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.model_dir, cls.evaluator_dir = get_tiny_models()
+        cls.qg = QuestionGenerator(
+            model_dir=cls.model_dir,
+            evaluator_dir=cls.evaluator_dir,
+            device='cpu',
+            decoding_presets={'tiny': {'num_beams': 1, 'max_new_tokens': 4}},
+        )
+
+    def generate_kwargs(self, decoding):
+        """Returns the keyword arguments of each call to qg_model.generate for one request."""
+        self.qg.decoding_stats.clear()
+        with mock.patch.object(
+            self.qg.qg_model, 'generate', wraps=self.qg.qg_model.generate
+        ) as generate:
+            self.qg.generate(
+                TINY_MODEL_TEXT,
+                use_evaluator=False,
+                answer_style='sentences',
+                decoding=decoding,
+            )
+        self.assertTrue(generate.called)
+        return [call.kwargs for call in generate.call_args_list]
+
+    def test_unknown_preset_raises(self):
+        with self.assertRaises(ValueError):
+            QuestionGenerator(
+                model_dir=self.model_dir,
+                evaluator_dir=self.evaluator_dir,
+                device='cpu',
+                decoding='unknown',
+            )
+        with self.assertRaises(ValueError):
+            self.qg.generate(TINY_MODEL_TEXT, answer_style='sentences', decoding='unknown')
+
+    def test_presets_change_generation_kwargs(self):
+        for decoding in ['fast', 'quality', 'tiny']:
+            preset = self.qg.decoding_presets[decoding]
+            for kwargs in self.generate_kwargs(decoding):
+                self.assertEqual({key: kwargs.get(key) for key in preset}, preset)
+
+        # the default preset leaves the generation config of the checkpoint alone
+        for kwargs in self.generate_kwargs('default'):
+            self.assertFalse(set(kwargs) & set(DECODING_PRESETS['quality']))
+
+    def test_decoding_stats_are_recorded_per_preset(self):
+        self.generate_kwargs('tiny')
+        stats = self.qg.decoding_stats.stats()
+
+        self.assertEqual(list(stats), ['tiny'])
+        self.assertGreater(stats['tiny']['questions'], 0)
+        self.assertLessEqual(stats['tiny']['tokens_per_question'], 4)
+
+
+class DistractorIndexTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        model_dir, evaluator_dir = get_tiny_models()
+        cls.qg = QuestionGenerator(model_dir=model_dir, evaluator_dir=evaluator_dir, device='cpu')
+
+        nlp = spacy.blank('en')
+        doc = nlp('Armstrong , Aldrin , Collins and Cernan flew for NASA in 1969 and 1972 .')
+        doc.ents = [
+            Span(doc, 0, 1, 'PERSON'),
+            Span(doc, 2, 3, 'PERSON'),
+            Span(doc, 4, 5, 'PERSON'),
+            Span(doc, 6, 7, 'PERSON'),
+            Span(doc, 9, 10, 'ORG'),
+            Span(doc, 11, 12, 'DATE'),
+            Span(doc, 13, 14, 'DATE'),
+        ]
+        # the second doc repeats an entity, which is only added to the index once
+        repeat = nlp('Armstrong')
+        repeat.ents = [Span(repeat, 0, 1, 'PERSON')]
+        cls.docs = [doc, repeat]
+        cls.entities = list(doc.ents)
+
+    def test_entities_are_deduplicated_and_grouped_by_label(self):
+        index = DistractorIndex(self.docs)
+
+        by_label = {
+            label: [index.texts[i] for i in positions]
+            for label, positions in index.by_label.items()
+        }
+
+        self.assertEqual(len(index), 7)
+        self.assertEqual(
+            by_label,
+            {
+                'PERSON': ['Armstrong', 'Aldrin', 'Collins', 'Cernan'],
+                'ORG': ['NASA'],
+                'DATE': ['1969', '1972'],
+            },
+        )
+
+    def test_same_seed_gives_same_options(self):
+        for entity in self.entities:
+            options = self.qg._get_MC_answers(entity, DistractorIndex(self.docs, random.Random(7)))
+            same_seed_options = self.qg._get_MC_answers(
+                entity, DistractorIndex(self.docs, random.Random(7))
+            )
+            self.assertEqual(options, same_seed_options)
+
+    def test_correct_answer_is_never_a_distractor(self):
+        index = DistractorIndex(self.docs, random.Random(0))
+
+        for _ in range(50):
+            for entity in self.entities:
+                options = self.qg._get_MC_answers(entity, index)
+                answers = [option['answer'] for option in options]
+
+                self.assertEqual(len(options), 4)
+                self.assertEqual(len(set(answers)), 4)
+                self.assertEqual(
+                    [option['answer'] for option in options if option['correct']], [entity.text]
+                )
+
+    def test_same_label_is_preferred(self):
+        index = DistractorIndex(self.docs, random.Random(0))
+
+        for _ in range(20):
+            distractors = index.sample('Aldrin', 'PERSON', 3)
+            self.assertEqual(sorted(distractors), ['Armstrong', 'Cernan', 'Collins'])
+
+            # only one other date, so the remaining places are filled with other entities
+            distractors = index.sample('1969', 'DATE', 3)
+            self.assertEqual(distractors[0], '1972')
+            self.assertNotIn('1969', distractors)
+            self.assertEqual(len(set(distractors)), 3)
+
+
+class QuestionMemoTests(SimpleTestCase):
+
+    def test_memoized_questions_skip_generation(self):
+        model_dir, evaluator_dir = get_tiny_models()
+        metrics = Metrics()
+        qg = QuestionGenerator(
+            model_dir=model_dir, evaluator_dir=evaluator_dir, device='cpu',
+            question_memo=LRUCache(), instrumentation=metrics,
+        )
+        inputs, _ = qg.generate_qg_inputs(TINY_MODEL_TEXT, 'sentences')
+        questions = qg.generate_questions_from_inputs(inputs[:3])
+
+        with mock.patch.object(qg, '_generate_question_batch') as generate_question_batch:
+            memoized_questions = qg.generate_questions_from_inputs(inputs[:3])
+            generate_question_batch.assert_not_called()
+
+        # only the new input is generated
+        all_questions = qg.generate_questions_from_inputs(inputs[:4])
+
+        self.assertEqual(memoized_questions, questions)
+        self.assertEqual(all_questions[:3], questions)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['question_memo_hits'], 3 + 3)
+        self.assertEqual(counters['question_memo_misses'], 3 + 1)
+
+
+class ConcurrentGenerationTests(SimpleTestCase):
+
+    NUM_THREADS = 4
+    CALLS_PER_THREAD = 3
+
+    def test_threads_share_generator(self):
+        model_dir, evaluator_dir = get_tiny_models()
+        qg = QuestionGenerator(
+            model_dir=model_dir, evaluator_dir=evaluator_dir, device='cpu', batch_size=4
+        )
+        self.assertTrue(qg.qg_tokenizer.is_fast)
+        expected = qg.generate(TINY_MODEL_TEXT, num_questions=3, answer_style='sentences')
+        results = []
+        errors = []
+
+        def generate():
+            for _ in range(self.CALLS_PER_THREAD):
+                try:
+                    results.append(
+                        qg.generate(TINY_MODEL_TEXT, num_questions=3, answer_style='sentences')
+                    )
+                except Exception as error:
+                    errors.append(error)
+
+        threads = [threading.Thread(target=generate) for _ in range(self.NUM_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [expected] * self.NUM_THREADS * self.CALLS_PER_THREAD)
+
+
+class MicroBatcherTests(SimpleTestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def double(self, items, key):
+        self.batches.append((key, list(items)))
+        return [item * 2 for item in items]
+
+    def test_items_from_several_threads_share_a_batch(self):
+        batcher = MicroBatcher(self.double, max_batch_size=4, max_wait=10)
+        results = {}
+
+        def submit(item):
+            results[item] = batcher.submit([item])
+
+        threads = [threading.Thread(target=submit, args=(item,)) for item in range(4)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        # a full batch doesn't wait for max_wait
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual(results, {item: [item * 2] for item in range(4)})
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(sorted(self.batches[0][1]), [0, 1, 2, 3])
+
+    def test_partial_batch_runs_after_max_wait(self):
+        batcher = MicroBatcher(self.double, max_batch_size=4, max_wait=0.05)
+
+        start = time.perf_counter()
+        self.assertEqual(batcher.submit([1, 2]), [2, 4])
+
+        self.assertGreaterEqual(time.perf_counter() - start, 0.05)
+        self.assertEqual(self.batches, [(None, [1, 2])])
+
+    def test_keys_are_batched_separately(self):
+        batcher = MicroBatcher(self.double, max_batch_size=4, max_wait=0.05)
+
+        futures = [batcher.submit_one(1, key='fast'), batcher.submit_one(2, key='quality')]
+
+        self.assertEqual([future.result(5) for future in futures], [2, 4])
+        self.assertEqual(sorted(self.batches), [('fast', [1]), ('quality', [2])])
+
+    def test_items_past_queue_limit_wait_for_room(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def process_batch(items, key):
+            started.set()
+            release.wait(5)
+            return items
+
+        batcher = MicroBatcher(process_batch, max_batch_size=1, max_wait=0, max_queue_size=2)
+        futures = [batcher.submit_one('running')]
+        started.wait(5)
+        futures += [batcher.submit_one('queued'), batcher.submit_one('queued')]
+
+        blocked = threading.Thread(target=lambda: futures.append(batcher.submit_one('blocked')))
+        blocked.start()
+        blocked.join(0.1)
+
+        self.assertTrue(blocked.is_alive())
+        self.assertEqual(batcher.stats()['queue_depth'], 2)
+
+        release.set()
+        blocked.join(5)
+        self.assertEqual([future.result(5) for future in futures], [
+            'running', 'queued', 'queued', 'blocked'
+        ])
+        self.assertEqual(batcher.stats()['max_queue_depth'], 2)
+
+    def test_exception_is_raised_in_every_waiter(self):
+        def fail(items, key):
+            raise ValueError('Model failed')
+
+        batcher = MicroBatcher(fail, max_batch_size=3, max_wait=10)
+        futures = [batcher.submit_one(item) for item in range(3)]
+
+        for future in futures:
+            with self.assertRaisesRegex(ValueError, 'Model failed'):
+                future.result(5)
+        self.assertEqual(batcher.stats()['errors'], 1)
+
+
+class LRUCacheTests(SimpleTestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+    def test_entries_are_evicted_by_size(self):
+        cache = LRUCache(max_entries=10, max_bytes=10, sizeof=lambda key, value: len(value))
+        cache.put('a', 'xxxx')
+        cache.put('b', 'xxxx')
+        cache.put('c', 'xxxx')
+        cache.put('d', 'x' * 11)
+
+        self.assertEqual([cache.get(key) is not None for key in 'abcd'], [False, True, True, False])
+        self.assertEqual(cache.stats()['bytes'], 8)
+
+
+class ResultCacheTests(SimpleTestCase):
+
+    QA_PAIRS = [{'question': 'When did Apollo 11 land?', 'answer': '1969'}]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'results.sqlite3')
+
+    def test_keys_depend_on_options_and_models(self):
+        cache = ResultCache()
+        options = {'decoding': {'num_beams': 1}, 'seed': 0, 'models': ['t5@a', 'bert@b']}
+        key = cache.make_key('Some  article.\n\n', **options)
+
+        self.assertEqual(key, cache.make_key('Some article.', **options))
+        for changed in [
+            {'decoding': {'num_beams': 4}}, {'seed': 1}, {'models': ['t5@c', 'bert@b']}
+        ]:
+            with self.subTest(changed=changed):
+                self.assertNotEqual(key, cache.make_key('Some article.', **{**options, **changed}))
+
+    def test_results_are_promoted_from_disk(self):
+        ResultCache(path=self.path).put('key', self.QA_PAIRS)
+        cache = ResultCache(path=self.path)
+
+        self.assertEqual(cache.get('key'), self.QA_PAIRS)
+        self.assertEqual(cache.get('key'), self.QA_PAIRS)
+        self.assertIsNone(cache.get('other'))
+        stats = cache.stats()
+        self.assertEqual((stats['disk_hits'], stats['memory_hits'], stats['misses']), (1, 1, 1))
+
+    def test_disk_holds_at_most_max_disk_entries(self):
+        cache = ResultCache(path=self.path, max_disk_entries=2)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, self.QA_PAIRS)
+        cache.memory.clear()
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), self.QA_PAIRS)
+
+    def test_database_is_reopened_in_forked_process(self):
+        cache = ResultCache(path=self.path)
+        cache.put('key', self.QA_PAIRS)
+        db = cache._db
+        cache.memory.clear()
+
+        with mock.patch('qg_cache.os.getpid', return_value=os.getpid() + 1):
+            self.assertEqual(cache.get('key'), self.QA_PAIRS)
+        self.assertIsNot(cache._db, db)
+
+    def test_counters_are_thread_safe(self):
+        cache = ResultCache()
+        threads = [
+            threading.Thread(target=lambda: [cache.get(str(i)) for i in range(1000)])
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(cache.stats()['misses'], 4000)
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_summaries_by_labels(self):
+        metrics = Metrics()
+        with metrics.span('generation', decoding='fast'):
+            pass
+        metrics.observe('stage_seconds', 2.0, stage='ner')
+        metrics.observe('stage_seconds', 1.0, stage='ner')
+        metrics.observe('question_batch_size', 4)
+
+        summaries = {
+            labels['stage']: summary for labels, summary in metrics.summaries('stage_seconds')
+        }
+
+        self.assertEqual(sorted(summaries), ['generation', 'ner'])
+        self.assertEqual(summaries['ner'], {'count': 2, 'sum': 3.0, 'max': 2.0})
+        self.assertEqual(summaries['generation']['count'], 1)
+
+
+class ImportTimeTests(SimpleTestCase):
+    """Loading the web app must not import the NLP stack or the training code, so that
+    manage.py commands such as migrate start quickly. The models are imported on first use.
+    """
+
+    IMPORT_TIME_BUDGET_SECONDS = 1.5
+    HEAVY_MODULES = [
+        'datasets', 'en_core_web_sm', 'pandas', 'questiongenerator', 'sklearn', 'spacy',
+        'torch', 'training', 'transformers',
+    ]
+
+    def test_url_conf_imports_within_budget(self):
+        result = subprocess.run(
+            [
+                sys.executable, '-X', 'importtime', '-c',
+                f'import django; django.setup(); import {settings.ROOT_URLCONF}',
+            ],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+        imported = set()
+        total_microseconds = 0
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line.split('|')
+            imported.add(name.strip().split('.')[0])
+            # nested imports are indented, and are already part of their parent's time
+            if not name.startswith('  '):
+                total_microseconds += int(cumulative)
+
+        self.assertEqual(sorted(imported & set(self.HEAVY_MODULES)), [])
+        self.assertLess(total_microseconds / 1e6, self.IMPORT_TIME_BUDGET_SECONDS)
+
+
+class StatsEndpointTests(SimpleTestCase):
+    """Scraping the statistics must not load the models, or even import the NLP stack."""
+
+    SCRAPE = """
+import sys
+import django
+django.setup()
+from django.test import Client
+from django.test.utils import setup_test_environment
+setup_test_environment()
+client = Client()
+for url in ['/stats/', '/metrics/']:
+    assert client.get(url).status_code == 200, url
+print(' '.join(sorted(name.split('.')[0] for name in sys.modules)))
+"""
+
+    def test_scraping_does_not_load_generator(self):
+        result = subprocess.run(
+            [sys.executable, '-c', self.SCRAPE],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        imported = set(result.stdout.split())
+
+        self.assertEqual(sorted(imported & set(ImportTimeTests.HEAVY_MODULES)), [])
+
+    def test_stats_of_loaded_generator(self):
+        model_dir, evaluator_dir = get_tiny_models()
+        self.addCleanup(clear_question_generators)
+
+        with self.settings(
+            QG_MODEL_DIR=model_dir, QG_EVALUATOR_DIR=evaluator_dir, QG_DEVICE='cpu',
+            QG_BACKEND='torch', QG_DTYPE=None,
+        ):
+            self.assertNotIn('decoding', get_generation_stats())
+            get_shared_question_generator()
+            self.assertIn('decoding', get_generation_stats())
+
+
+class SharedGeneratorSettingsTests(SimpleTestCase):
+
+    def get_options(self, **settings):
+        with self.settings(**settings), mock.patch(
+            'question_generationapp.generation.get_question_generator'
+        ) as get_question_generator:
+            get_shared_question_generator()
+        return get_question_generator.call_args.kwargs
+
+    def test_cpu_affinity_is_passed_to_generator(self):
+        self.assertEqual(self.get_options(QG_CPU_AFFINITY='0-2,5')['cpu_affinity'], [0, 1, 2, 5])
+
+    def test_auto_cpu_affinity_is_left_to_gunicorn(self):
+        for cpu_affinity in [None, 'auto']:
+            with self.subTest(cpu_affinity=cpu_affinity):
+                self.assertIsNone(self.get_options(QG_CPU_AFFINITY=cpu_affinity)['cpu_affinity'])
+
+
+class ApiKeyTests(SimpleTestCase):
+    """The JSON API is exempt from CSRF protection, so it must authenticate every request."""
+
+    URL = '/api/generate/'
+
+    def post(self, **headers):
+        # an empty text is rejected before the models are needed
+        return self.client.post(self.URL, {'text': ''}, content_type='application/json', **headers)
+
+    def test_requests_without_a_valid_key_are_rejected(self):
+        with self.settings(QG_API_KEYS=['secret']):
+            for headers in [
+                {}, {'HTTP_AUTHORIZATION': 'Bearer wrong'}, {'HTTP_AUTHORIZATION': 'secret'}
+            ]:
+                with self.subTest(headers=headers):
+                    response = self.post(**headers)
+                    self.assertEqual(response.status_code, 401)
+                    self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+
+    def test_requests_with_a_key_are_accepted(self):
+        with self.settings(QG_API_KEYS=['other', 'secret']):
+            self.assertEqual(self.post(HTTP_AUTHORIZATION='Bearer secret').status_code, 400)
+
+    def test_api_is_closed_without_keys(self):
+        with self.settings(QG_API_KEYS=[]):
+            self.assertEqual(self.post(HTTP_AUTHORIZATION='Bearer ').status_code, 401)
+
+
+class GenerationJobTests(TestCase):
+
+    def create_running_job(self, worker, seconds_ago):
+        job = GenerationJob.objects.create(text='text', status=GenerationJob.Status.RUNNING)
+        # update() bypasses auto_now, so the job can be made to look stale
+        GenerationJob.objects.filter(id=job.id).update(
+            worker=worker, updated_at=timezone.now() - timedelta(seconds=seconds_ago)
+        )
+        return GenerationJob.objects.get(id=job.id)
+
+    def run_job(self, job, qg):
+        with mock.patch(
+            'question_generationapp.jobs.get_shared_question_generator', return_value=qg
+        ):
+            run_job(job)
+        job.refresh_from_db()
+
+    def test_job_is_claimed_once(self):
+        job = GenerationJob.objects.create(text='text')
+
+        claimed = claim_next_job('a')
+
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, GenerationJob.Status.RUNNING)
+        self.assertEqual(claimed.worker, 'a')
+        self.assertIsNone(claim_next_job('b'))
+
+    def test_job_claimed_by_another_worker_in_between_is_skipped(self):
+        job = GenerationJob.objects.create(text='text')
+        values_list = QuerySet.values_list
+
+        def list_then_lose_race(queryset, *args, **kwargs):
+            job_ids = list(values_list(queryset, *args, **kwargs))
+            GenerationJob.objects.filter(id=job.id).update(
+                status=GenerationJob.Status.RUNNING, worker='b'
+            )
+            return job_ids
+
+        with mock.patch.object(
+            QuerySet, 'values_list', autospec=True, side_effect=list_then_lose_race
+        ):
+            self.assertIsNone(claim_next_job('a'))
+        self.assertEqual(GenerationJob.objects.get(id=job.id).worker, 'b')
+
+    def test_stale_job_is_claimed_again(self):
+        with self.settings(QG_JOB_TIMEOUT=60):
+            self.create_running_job('a', seconds_ago=30)
+            self.assertIsNone(claim_next_job('b'))
+
+            job = self.create_running_job('a', seconds_ago=120)
+            self.assertEqual(claim_next_job('b').id, job.id)
+            self.assertEqual(GenerationJob.objects.get(id=job.id).worker, 'b')
+
+    def test_old_worker_cannot_update_reclaimed_job(self):
+        with self.settings(QG_JOB_TIMEOUT=60):
+            old_job = self.create_running_job('a', seconds_ago=120)
+            claim_next_job('b')
+
+        self.assertFalse(_update_job(old_job, status=GenerationJob.Status.SUCCEEDED, progress=1))
+        job = GenerationJob.objects.get(id=old_job.id)
+        self.assertEqual(job.status, GenerationJob.Status.RUNNING)
+        self.assertEqual(job.progress, 0)
+
+    def test_failure_is_recorded(self):
+        GenerationJob.objects.create(text='text')
+        job = claim_next_job('a')
+        qg = mock.Mock()
+        qg.generate_stream.side_effect = ValueError('Invalid answer style')
+
+        with self.assertLogs('question_generationapp.jobs', 'ERROR'):
+            self.run_job(job, qg)
+
+        self.assertEqual(job.status, GenerationJob.Status.FAILED)
+        self.assertEqual(job.error, 'Invalid answer style')
+        self.assertIsNotNone(job.finished_at)
+
+    def test_result_is_recorded(self):
+        GenerationJob.objects.create(text='text')
+        job = claim_next_job('a')
+        qa_pairs = [{'question': 'Q?', 'answer': 'A'}]
+        qg = mock.Mock()
+        qg.generate_stream.return_value = iter([
+            {'event': 'batch', 'qa_pairs': qa_pairs, 'completed': 1, 'total': 2},
+            {'event': 'final', 'qa_pairs': qa_pairs},
+        ])
+
+        self.run_job(job, qg)
+
+        self.assertEqual(job.status, GenerationJob.Status.SUCCEEDED)
+        self.assertEqual(job.result, qa_pairs)
+        self.assertEqual(job.progress, 1)
+
+
+class JobHeartbeatTests(TransactionTestCase):
+    """The heartbeat writes from its own thread, and so its own database connection, which
+    wouldn't see the job inside a TestCase's transaction.
+    """
+
+    def test_heartbeat_keeps_job_from_going_stale(self):
+        GenerationJob.objects.create(text='text')
+        job = claim_next_job('a')
+
+        with JobHeartbeat(job, interval=0.05):
+            time.sleep(0.3)
+
+        self.assertGreater(GenerationJob.objects.get(id=job.id).updated_at, job.updated_at)
+
+    def test_heartbeat_stops_once_job_is_claimed_again(self):
+        GenerationJob.objects.create(text='text')
+        job = claim_next_job('a')
+        GenerationJob.objects.filter(id=job.id).update(worker='b')
+
+        with self.assertLogs('question_generationapp.jobs', 'WARNING'):
+            with JobHeartbeat(job, interval=0.05) as heartbeat:
+                time.sleep(0.3)
+                self.assertFalse(heartbeat._thread.is_alive())
+
+
+class FakeQuestionGenerator:
+    """Stands in for the shared generator in API tests, yielding num_batches batch events and
+    then a final event, with step_seconds between them.
+    """
+
+    QA_PAIR = {'question': 'When did Apollo 11 land on the Moon?', 'answer': '1969'}
+
+    def __init__(self, num_batches=2, step_seconds=0, error=None):
+        self.num_batches = num_batches
+        self.step_seconds = step_seconds
+        self.error = error
+        self.batches_generated = 0
+        self.closed = threading.Event()
+
+    def generate_stream(self, text, **options):
+        try:
+            if self.error is not None:
+                raise self.error
+            for i in range(self.num_batches):
+                time.sleep(self.step_seconds)
+                self.batches_generated += 1
+                yield {
+                    'event': 'batch', 'qa_pairs': [self.QA_PAIR],
+                    'completed': i + 1, 'total': self.num_batches,
+                }
+            yield {'event': 'final', 'qa_pairs': [self.QA_PAIR] * self.num_batches}
+        finally:
+            self.closed.set()
+
+
+@override_settings(QG_API_KEYS=['secret'])
+class GenerationApiTests(SimpleTestCase):
+
+    URL = '/api/generate/'
+    HEADERS = {'Authorization': 'Bearer secret'}
+
+    def setUp(self):
+        self.qg = FakeQuestionGenerator()
+        # streamed responses start generating only once their content is read
+        patcher = mock.patch(
+            'question_generationapp.streaming.get_shared_question_generator',
+            side_effect=lambda: self.qg,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def post(self, data, headers=None, body=None):
+        return await self.async_client.post(
+            self.URL,
+            body if body is not None else data,
+            content_type='application/json',
+            headers={**self.HEADERS, **(headers or {})},
+        )
+
+    async def read_events(self, response):
+        content = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        events = []
+        for message in content.split('\n\n')[:-1]:
+            name, data = message.split('\n')
+            self.assertTrue(name.startswith('event: ') and data.startswith('data: '))
+            events.append((name[len('event: '):], json.loads(data[len('data: '):])))
+        return events
+
+    async def test_json_response(self):
+        response = await self.post({'text': TINY_MODEL_TEXT})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'qa_pairs': [FakeQuestionGenerator.QA_PAIR] * 2})
+
+    async def test_invalid_requests(self):
+        for body in [
+            'not json', '[]', '{}', '{"text": "  "}', '{"text": "Text.", "num_questions": 0}',
+            '{"text": "Text.", "num_questions": "5"}', '{"text": "Text.", "num_questions": true}',
+        ]:
+            with self.subTest(body=body):
+                response = await self.post(None, body=body)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+
+    async def test_generation_error(self):
+        self.qg = FakeQuestionGenerator(error=ValueError('Invalid answer style'))
+        response = await self.post({'text': 'Text.', 'answer_style': 'essay'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Invalid answer style'})
+
+    async def test_server_sent_events(self):
+        for data, headers in [
+            ({'text': 'Text.', 'stream': True}, None),
+            ({'text': 'Text.'}, {'Accept': 'text/event-stream'}),
+        ]:
+            with self.subTest(data=data, headers=headers):
+                response = await self.post(data, headers=headers)
+                self.assertEqual(response['Content-Type'], 'text/event-stream')
+                self.assertEqual(response['Cache-Control'], 'no-cache')
+
+                events = await self.read_events(response)
+
+                self.assertEqual([name for name, _ in events], ['batch', 'batch', 'final'])
+                self.assertEqual([event['completed'] for _, event in events[:2]], [1, 2])
+                self.assertEqual(len(events[2][1]['qa_pairs']), 2)
+
+    async def test_error_event(self):
+        self.qg = FakeQuestionGenerator(error=ValueError('Invalid answer style'))
+        response = await self.post({'text': 'Text.', 'stream': True})
+
+        self.assertEqual(
+            await self.read_events(response), [('error', {'error': 'Invalid answer style'})]
+        )
+
+    async def test_disconnect_stops_generation(self):
+        qg = self.qg = FakeQuestionGenerator(num_batches=20, step_seconds=0.05)
+        response = await self.post({'text': 'Text.', 'stream': True})
+        first_event = asyncio.Event()
+
+        async def read_events():
+            async for _ in response.streaming_content:
+                first_event.set()
+
+        # a client disconnecting cancels the task serving its response
+        task = asyncio.ensure_future(read_events())
+        await asyncio.wait_for(first_event.wait(), 5)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        self.assertTrue(await asyncio.to_thread(qg.closed.wait, 5))
+        self.assertLess(qg.batches_generated, qg.num_batches)
+
+
+class MmapWeightsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.model_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.model_dir)
+        config = T5Config(
+            vocab_size=64, d_model=16, d_ff=32, d_kv=4, num_layers=2, num_heads=2,
+            decoder_start_token_id=0,
+        )
+        torch.manual_seed(0)
+        self.model = T5ForConditionalGeneration(config).eval()
+
+    def assert_same_model(self, model):
+        self.assertFalse(model.training)
+        self.assertEqual(model.lm_head.weight.data_ptr(), model.shared.weight.data_ptr())
+        expected = self.model.state_dict()
+        for name, tensor in model.state_dict().items():
+            self.assertTrue(torch.equal(tensor, expected[name]), name)
+
+        input_ids = torch.tensor([[5, 6, 7, 1]])
+        self.assertTrue(torch.equal(
+            model.generate(input_ids, max_new_tokens=4),
+            self.model.generate(input_ids, max_new_tokens=4),
+        ))
+
+    def test_loads_mapped_safetensors(self):
+        self.model.save_pretrained(self.model_dir)
+        model = load_torch_model(
+            T5ForConditionalGeneration, self.model_dir, torch.device('cpu'), mmap_weights=True
+        )
+        self.assert_same_model(model)
+
+    def test_loads_mapped_pytorch_checkpoint(self):
+        self.model.save_pretrained(self.model_dir, safe_serialization=False)
+        model = load_torch_model(
+            T5ForConditionalGeneration, self.model_dir, torch.device('cpu'), mmap_weights=True
+        )
+        self.assert_same_model(model)
+
+    def test_copies_weights_which_need_converting(self):
+        self.model.save_pretrained(self.model_dir)
+        with self.assertWarns(UserWarning):
+            model = load_torch_model(
+                T5ForConditionalGeneration, self.model_dir, torch.device('cpu'), 'bfloat16',
+                mmap_weights=True,
+            )
+        self.assertEqual(model.dtype, torch.bfloat16)
+
+
+class QAEvaluatorTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        _, evaluator_dir = get_tiny_models()
+        cls.qa_evaluator = QAEvaluator(model_dir=evaluator_dir, device='cpu', batch_size=2)
+
+    def test_get_scores_ranks_pairs(self):
+        questions = ['Who landed on the Moon?', 'When did Apollo 17 leave?', 'What is Saturn V?']
+        answers = [
+            'Armstrong and Aldrin landed in the Sea of Tranquility.',
+            [{'answer': 'December 1972', 'correct': True}, {'answer': '1969', 'correct': False}],
+            'The Saturn V is a rocket.',
+        ]
+        encoded_qa_pairs = self.qa_evaluator.encode_qa_pairs(questions, answers)
+
+        ranking = self.qa_evaluator.get_scores(encoded_qa_pairs)
+        scores = self.qa_evaluator.score_encoded_qa_pairs(encoded_qa_pairs)
+
+        self.assertEqual(sorted(ranking), [0, 1, 2])
+        self.assertEqual(ranking, sorted(range(3), key=lambda i: -scores[i]))
+        self.assertEqual(
+            ranking, self.qa_evaluator.score_qa_pairs(questions, answers)[1].tolist()
+        )
@@ -3,6 +3,11 @@ from . import views
 
 urlpatterns = [
     path('generate_question/', views.generate_questions_view, name='generate_question'),
+    path('jobs/', views.submit_generation_job, name='submit_generation_job'),
+    path('jobs/<uuid:job_id>/', views.generation_job_status, name='generation_job_status'),
+    path('stats/', views.generation_stats, name='generation_stats'),
+    path('metrics/', views.generation_metrics, name='generation_metrics'),
+    path('api/generate/', views.generate_questions_api, name='generate_questions_api'),
     # path('generate_question/', views.generate_questions, name='generate_question'),
     path('',views.home, name='home'),
     path('register/',views.userregister, name='register'),
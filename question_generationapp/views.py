@@ -1,25 +1,38 @@
 
+from django.conf import settings
 from django.shortcuts import render
-from questiongenerator import QuestionGenerator
-from training import qa_eval_train
-from training.dataset import QAEvalDataset
+from qg_metrics import format_prometheus_gauges
 
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponseBadRequest
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 from django.contrib import messages
 from datetime import date
 from .forms import *
+from .generation import get_generation_stats, get_metrics, get_shared_question_generator
+from .jobs import job_to_dict, start_local_workers, submit_job
+from .streaming import stream_generation, to_server_sent_events
 from .models import ( User,
     Account,
+    GenerationJob,
 )
 from django.contrib import messages, auth
 import datetime
+import hmac
+import json
 from re import split
 from django.http import FileResponse
 import io
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render
-from questiongenerator import QuestionGenerator
 
 
 
@@ -108,13 +121,18 @@ def dashboard(request):
 def generate_questions(request):
     if request.method == 'POST':
         text_content = request.POST.get('text_content', '')
-        qg = QuestionGenerator()
-        qa_list = qg.generate(
-            text_content,
-            num_questions=10,
-            answer_style='all',
-            use_evaluator=True
-        )
+        qg = get_shared_question_generator()
+        try:
+            qa_list = qg.generate(
+                text_content,
+                num_questions=10,
+                answer_style='all',
+                use_evaluator=True,
+                early_exit=settings.QG_EARLY_EXIT,
+                decoding=request.POST.get('decoding') or settings.QG_DECODING
+            )
+        except ValueError as error:
+            return HttpResponseBadRequest(str(error))
         questions_with_answers = [qa for qa in qa_list if 'answer' in qa]
         open_ended_questions = [qa for qa in qa_list if 'answer' not in qa]
         context = {
@@ -131,16 +149,13 @@ def generate_questions(request):
 
 from django.shortcuts import render
 from .forms import TextContentForm
-from questiongenerator import QuestionGenerator  # Ensure this import is correct based on your project structure
 
 from django.shortcuts import render
 from .forms import TextContentForm
-from questiongenerator import QuestionGenerator  # Ensure this import is correct based on your project structure
 
 
 from django.shortcuts import render
 from .forms import TextContentForm
-from questiongenerator import QuestionGenerator
 
 def generate_questions_view(request):
     if request.method == 'POST':
@@ -149,12 +164,14 @@ def generate_questions_view(request):
             text_content = form.cleaned_data['text_content']
             question_type = request.POST.get('question_type', '')
 
-            qg = QuestionGenerator()
+            qg = get_shared_question_generator()
             qa_list = qg.generate(
                 text_content,
                 num_questions=10,
                 answer_style='all',
-                use_evaluator=True
+                use_evaluator=True,
+                early_exit=settings.QG_EARLY_EXIT,
+                decoding=form.cleaned_data['decoding'] or settings.QG_DECODING
             )
 
             simple_answer_questions = []
@@ -181,6 +198,135 @@ def generate_questions_view(request):
         form = TextContentForm()
     return render(request, 'users/user_dashboard.html', {'form': form})
 
+@require_POST
+def submit_generation_job(request):
+    form = TextContentForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    job = submit_job(
+        form.cleaned_data['text_content'],
+        user=request.user if request.user.is_authenticated else None,
+        num_questions=10,
+        answer_style='all',
+        use_evaluator=True,
+        decoding=form.cleaned_data['decoding'] or settings.QG_DECODING,
+    )
+    data = job_to_dict(job)
+    data['url'] = reverse('generation_job_status', args=[job.id])
+    return JsonResponse(data, status=202)
+
+
+@require_GET
+def generation_job_status(request, job_id):
+    job = get_object_or_404(GenerationJob, id=job_id)
+    if job.user_id is not None and job.user_id != request.user.id:
+        raise Http404
+    # pick up jobs left queued by a previous run of this process
+    start_local_workers()
+    return JsonResponse(job_to_dict(job))
+
+
+@require_GET
+def generation_stats(request):
+    return JsonResponse(get_generation_stats())
+
+
+@require_GET
+def generation_metrics(request):
+    stats = get_generation_stats()
+    # the stage timings and counts are exported as counters and summaries, the rest as gauges
+    stats.pop('metrics')
+    return HttpResponse(
+        get_metrics().to_prometheus() + format_prometheus_gauges(stats),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
+
+
+# Clients authenticate with an API key in the Authorization header rather than a session cookie.
+# Browsers never attach that header to cross-site requests, so CSRF protection isn't needed
+@csrf_exempt
+@require_POST
+async def generate_questions_api(request):
+    """Generates questions for the 'text' of a JSON request body, which may also set
+    'num_questions', 'answer_style', 'use_evaluator' and 'decoding'. Requests must carry an
+    "Authorization: Bearer <key>" header with one of the QG_API_KEYS.
+
+    Returns {"qa_pairs": [...]} once generation is done, or with "stream": true (or an
+    Accept: text/event-stream header), streams a server-sent 'batch' event as each batch of
+    questions is generated, then a 'final' event with the questions. Generation stops when a
+    streaming client disconnects. Serve the app with an ASGI server (see asgi.py) so that
+    waiting requests don't each hold a thread.
+    """
+    if not _has_api_key(request):
+        response = JsonResponse({'error': 'A valid API key is required'}, status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+
+    try:
+        text, options, stream = _parse_generation_request(request)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    events = stream_generation(text, **options)
+
+    if stream:
+        response = StreamingHttpResponse(
+            to_server_sent_events(events), content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        # stops proxies such as nginx from buffering the events
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    try:
+        async for event in events:
+            if event['event'] == 'final':
+                return JsonResponse({'qa_pairs': event['qa_pairs']})
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    finally:
+        await events.aclose()
+
+
+def _has_api_key(request):
+    scheme, _, key = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not key:
+        return False
+    # compares every key in constant time, so timing doesn't reveal how much of a key matched
+    return any(
+        hmac.compare_digest(key.strip().encode(), api_key.encode())
+        for api_key in settings.QG_API_KEYS
+    )
+
+
+def _parse_generation_request(request):
+    try:
+        data = json.loads(request.body or b'{}')
+    except json.JSONDecodeError as error:
+        raise ValueError(f'Invalid JSON: {error}')
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+
+    text = data.get('text')
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("'text' is required")
+
+    num_questions = data.get('num_questions', 10)
+    if not isinstance(num_questions, int) or isinstance(num_questions, bool) or num_questions < 1:
+        raise ValueError("'num_questions' must be a positive integer")
+
+    # answer_style and decoding are checked by the generator
+    options = {
+        'num_questions': num_questions,
+        'answer_style': data.get('answer_style', 'all'),
+        'use_evaluator': bool(data.get('use_evaluator', True)),
+        'early_exit': settings.QG_EARLY_EXIT,
+        'decoding': data.get('decoding') or settings.QG_DECODING,
+    }
+    stream = bool(data.get('stream')) or 'text/event-stream' in request.headers.get('Accept', '')
+    return text, options, stream
+
 # def generate_questions_view(request):
 #     if request.method == 'POST':
 #         form = TextContentForm(request.POST)
@@ -1,16 +1,93 @@
 #questiongenerator.py
-import en_core_web_sm
-import json
+from bisect import bisect_left
+import logging
 import numpy as np
+import os
 import random
 import re
+import threading
+import time
 import torch
+import warnings
 from transformers import (
     AutoTokenizer,
     AutoModelForSeq2SeqLM,
     AutoModelForSequenceClassification,
 )
-from typing import Any, List, Mapping, Tuple
+from transformers.modeling_outputs import BaseModelOutput
+from qg_backends import configure_threads, load_model
+from qg_metrics import Instrumentation
+from qg_scheduler import MicroBatcher
+from typing import (
+    Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Set, Tuple
+)
+
+logger = logging.getLogger(__name__)
+
+QG_PRETRAINED = "iarfmoose/t5-base-question-generator"
+QAE_PRETRAINED = "iarfmoose/bert-base-cased-qa-evaluator"
+
+# NER only needs the tokenizer, tok2vec and ner components of en_core_web_sm
+SPACY_EXCLUDE = ["tagger", "parser", "attribute_ruler", "lemmatizer"]
+# below this many sentences, starting extra NER processes costs more than it saves
+NER_PARALLEL_MIN_SENTENCES = 2000
+
+# answers from named entities with these labels tend to make better questions than numbers do
+ENTITY_LABEL_PRIORITIES = {
+    "PERSON": 1.0, "ORG": 1.0, "GPE": 1.0, "LOC": 1.0, "EVENT": 1.0, "WORK_OF_ART": 1.0,
+    "NORP": 0.9, "FAC": 0.9, "PRODUCT": 0.9, "LAW": 0.9, "LANGUAGE": 0.9,
+    "DATE": 0.7, "TIME": 0.6,
+    "CARDINAL": 0.4, "ORDINAL": 0.4, "QUANTITY": 0.4, "PERCENT": 0.4, "MONEY": 0.4,
+}
+SENTENCE_LABEL = "SENTENCE"
+
+# a sentence is a run of text up to a terminal punctuation mark on one line; runs which aren't
+# terminated are matched by the second alternative, so scanning never backtracks over them
+SENTENCE_PATTERN = re.compile(r"[^.!?\n]*[.!?]|[^.!?\n]+")
+FRAGMENT_SEPARATOR_PATTERN = re.compile(r"[,;:)]")
+MAX_SENTENCE_LEN = 128
+MIN_FRAGMENT_WORDS = 6
+
+# keyword arguments of qg_model.generate for each named decoding preset. "default" keeps the
+# generation config stored in the checkpoint, "fast" is greedy with a tight length limit and
+# "quality" uses beam search. All of them reuse the decoder's key/value cache between steps.
+DECODING_PRESETS = {
+    "default": {},
+    "fast": {"num_beams": 1, "do_sample": False, "max_new_tokens": 32, "use_cache": True},
+    "balanced": {
+        "num_beams": 2, "do_sample": False, "max_new_tokens": 48, "early_stopping": True,
+        "use_cache": True,
+    },
+    "quality": {
+        "num_beams": 4, "do_sample": False, "max_new_tokens": 64, "early_stopping": True,
+        "no_repeat_ngram_size": 3, "use_cache": True,
+    },
+}
+
+# texts which the fast QG tokenizer must encode and decode exactly like the slow SentencePiece
+# tokenizer the model was trained with, before it is used in its place
+TOKENIZER_PARITY_TEXTS = [
+    "<answer> Paris <context> Alice moved to Paris in 1999.",
+    "<answer>  spaced   answer<context>no space before the context<answer>",
+    "<answer> Ça coûte 3,50 € — voilà! <context> Naïve café, Zürich and 東京.",
+    "Tabs\tand\nnewlines, (brackets) and \"quotes\"; also don't, U.S.A. and e-mail.",
+    "",
+]
+
+_spacy_nlp = None
+_spacy_lock = threading.Lock()
+
+
+class Segment(NamedTuple):
+    """A span of a text which is short enough to be used as the context for question generation.
+    start and end are character offsets into the text, and input_ids are the segment's tokens,
+    which are reused as the context of the model inputs. input_ids is None if the segment was
+    tokenized by a different tokenizer from the model's, or was cut inside a word.
+    """
+    text: str
+    start: int
+    end: int
+    input_ids: Optional[List[int]]
 
 
 class QuestionGenerator:
@@ -21,69 +98,343 @@ class QuestionGenerator:
     To filter out low quality questions, questions are assigned a score and ranked once they have
     been generated. Only the top k questions will be returned. This behaviour can be turned off
     by setting use_evaluator=False.
+
+    Questions are generated in batches of batch_size inputs. Inputs are grouped by token length
+    so that each batch is only padded to the length of its longest member. If pad_to_multiple_of
+    is set, padded lengths are rounded up to a multiple of it (e.g. 8 or 16), which suits the
+    kernels of some hardware better.
+
+    model_dir is the question generation checkpoint to load (defaults to QG_PRETRAINED). device
+    defaults to CUDA when it is available, and dtype (e.g. "float32" or "bfloat16") to the dtype
+    stored in the checkpoint. On CPU, dtype="int8" applies dynamic int8 quantization to the Linear
+    layers of both models, which makes them smaller and usually faster at a small cost in
+    quality. Use qg_registry.get_question_generator to share one instance across a process
+    instead of loading the models again.
+
+    backend chooses how the models are run (see qg_backends): "torch", or "onnx" to run models
+    exported by export_onnx.py with ONNX Runtime on CPU. backend_options are passed on to the
+    backend, e.g. the graph optimization level and thread counts of ONNX Runtime. evaluator_dir
+    is the checkpoint of the QA evaluator (defaults to QAE_PRETRAINED).
+
+    num_threads and num_interop_threads limit the threads torch uses in this process, and
+    cpu_affinity is a list of CPUs to pin it to (see qg_backends.configure_threads). They default
+    to the QG_NUM_THREADS, QG_NUM_INTEROP_THREADS and QG_CPU_AFFINITY environment variables, or
+    to torch's own defaults, which use every core.
+
+    If micro_batch_wait is set, one generator shared by concurrent threads (e.g. the requests of
+    a web server) combines their inputs into shared batches (see qg_scheduler.MicroBatcher).
+    Inputs wait for up to micro_batch_wait seconds for others to batch with, and at most
+    micro_batch_queue_size inputs can be waiting at once. Shared batches hold up to
+    micro_batch_size inputs (defaults to batch_size). Each request already submits its inputs
+    in batches of batch_size, so with the default, only requests with fewer inputs than that
+    (short texts) share batches.
+
+    Named entities are extracted with spaCy in batches of ner_batch_size sentences. For long
+    texts, ner_n_process worker processes are used (-1 uses every core). Set seed to make the
+    choice and order of multiple-choice answers reproducible.
+
+    If a qg_cache.ResultCache is given as result_cache, the QA pairs generated for an article are
+    cached, and generating questions for the same article with the same options again returns
+    the cached pairs.
+
+    If a qg_cache.LRUCache is given as question_memo, the question generated for each individual
+    model input is memoized, so that texts which share sentences only pay for the new ones.
+    score_memo does the same for the evaluator scores of QA pairs. Both caches can be shared by
+    several threads, but not by generators which use different models or decoding presets.
+
+    Long texts are split into segments of at most MAX_SEGMENT_TOKENS tokens, which are used as
+    the context of sentence answers. Paragraphs too long for one segment are split into windows
+    which overlap by segment_overlap tokens.
+
+    Every sentence of a segment is given the same segment as its context. With
+    context_encoding="shared", inputs which share a context are generated together: the context
+    is run through the encoder once, and its encoding is reused for each of their answers. This
+    is much faster for long texts, but the answer and context are then encoded separately rather
+    than attending to each other, so the questions are not identical to those generated with the
+    default context_encoding="full".
+
+    decoding is the name of the decoding preset used by default, which trades the quality of the
+    questions for the speed of generating them (see DECODING_PRESETS). It can be overridden for
+    each call to generate. decoding_presets adds presets or replaces the built-in ones. The
+    latency and number of generated tokens of each preset are recorded in decoding_stats.
+
+    Inputs are tokenized with the fast (Rust) tokenizer when it gives the same ids as the slow
+    SentencePiece tokenizer (see load_qg_tokenizer), or always with the slow one if
+    use_fast_tokenizer is False.
+
+    The time taken by each stage of the pipeline, and counts of inputs, generated tokens, batch
+    sizes and cache hits, are reported to instrumentation (see qg_metrics), which discards them
+    by default.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        model_dir: str = None,
+        device: str = None,
+        dtype: str = None,
+        batch_size: int = 16,
+        pad_to_multiple_of: int = None,
+        ner_batch_size: int = 256,
+        ner_n_process: int = 1,
+        seed: int = None,
+        result_cache: Any = None,
+        question_memo: Any = None,
+        score_memo: Any = None,
+        segment_overlap: int = 0,
+        context_encoding: str = "full",
+        decoding: str = "default",
+        decoding_presets: Mapping[str, Mapping[str, Any]] = None,
+        backend: str = "torch",
+        backend_options: Mapping[str, Any] = None,
+        evaluator_dir: str = None,
+        num_threads: int = None,
+        num_interop_threads: int = None,
+        cpu_affinity: Sequence[int] = None,
+        micro_batch_wait: float = None,
+        micro_batch_queue_size: int = 1024,
+        micro_batch_size: int = None,
+        use_fast_tokenizer: bool = True,
+        instrumentation: Instrumentation = None
+    ) -> None:
+
+        VALID_CONTEXT_ENCODINGS = ["full", "shared"]
+
+        if context_encoding not in VALID_CONTEXT_ENCODINGS:
+            raise ValueError(
+                "Invalid context encoding {}. Please choose from {}".format(
+                    context_encoding, VALID_CONTEXT_ENCODINGS
+                )
+            )
+
+        self.decoding_presets = {**DECODING_PRESETS, **(decoding_presets or {})}
+        self.decoding = self._check_decoding(decoding)
+        self.decoding_stats = DecodingStats()
+        self.instrumentation = instrumentation or Instrumentation()
+
+        self.question_batcher = None
+        if micro_batch_wait is not None:
+            self.question_batcher = MicroBatcher(
+                self._generate_question_batch,
+                max_batch_size=micro_batch_size or batch_size,
+                max_wait=micro_batch_wait,
+                max_queue_size=micro_batch_queue_size,
+                name="questions",
+            )
 
-        QG_PRETRAINED = "iarfmoose/t5-base-question-generator"
         self.ANSWER_TOKEN = "<answer>"
         self.CONTEXT_TOKEN = "<context>"
         self.SEQ_LENGTH = 512
+        self.MAX_SEGMENT_TOKENS = 490
+        self.EARLY_EXIT_OVERSAMPLING = 2
+        self.EVALUATOR_PASS_PROBABILITY = 0.5
+        self.MIN_ANSWER_WORDS = 6
+        self.MAX_ANSWER_WORDS = 30
+        self.batch_size = batch_size
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.ner_batch_size = ner_batch_size
+        self.ner_n_process = ner_n_process
+        self.seed = seed
+        self.result_cache = result_cache
+        self.question_memo = question_memo
+        self.segment_overlap = segment_overlap
+        self.context_encoding = context_encoding
+
+        self.device = get_device(device)
+        configure_threads(num_threads, num_interop_threads, cpu_affinity)
+
+        self.qg_tokenizer = load_qg_tokenizer(model_dir or QG_PRETRAINED, use_fast_tokenizer)
+        self.segment_tokenizer = self.qg_tokenizer
+        # a fast tokenizer's settings (e.g. truncation) are changed by the calls which use them,
+        # and it raises "Already borrowed" if two threads use it at once, so every call to the
+        # tokenizers holds this lock
+        self._tokenizer_lock = threading.Lock()
+        if not self.qg_tokenizer.is_fast:
+            # segments only need offsets, not ids identical to the slow tokenizer's
+            self.segment_tokenizer = _load_fast_tokenizer(
+                model_dir or QG_PRETRAINED, self.qg_tokenizer)
+        self.qg_model = load_model(
+            AutoModelForSeq2SeqLM,
+            model_dir or QG_PRETRAINED,
+            self.device,
+            dtype,
+            backend,
+            **(backend_options or {})
+        )
 
-        self.device = torch.device(
-            "cuda" if torch.cuda.is_available() else "cpu")
-
-        self.qg_tokenizer = AutoTokenizer.from_pretrained(
-            QG_PRETRAINED, use_fast=False)
-        self.qg_model = AutoModelForSeq2SeqLM.from_pretrained(QG_PRETRAINED)
-        self.qg_model.to(self.device)
-        self.qg_model.eval()
-
-        self.qa_evaluator = QAEvaluator()
+        self.qa_evaluator = QAEvaluator(
+            model_dir=evaluator_dir,
+            device=device,
+            dtype=dtype,
+            pad_to_multiple_of=pad_to_multiple_of,
+            score_memo=score_memo,
+            backend=backend,
+            backend_options=backend_options,
+            micro_batch_wait=micro_batch_wait,
+            micro_batch_queue_size=micro_batch_queue_size,
+            micro_batch_size=micro_batch_size,
+            instrumentation=self.instrumentation,
+        )
 
     def generate(
         self,
         article: str,
         use_evaluator: bool = True,
         num_questions: bool = None,
-        answer_style: str = "all"
+        answer_style: str = "all",
+        early_exit: bool = False,
+        decoding: str = None
     ) -> List:
         """Takes an article and generates a set of question and answer pairs. If use_evaluator
         is True then QA pairs will be ranked and filtered based on their quality. answer_style
         should selected from ["all", "sentences", "multiple_choice"].
+
+        If early_exit is True, candidate answers are first ordered using cheap heuristics, and
+        questions are only generated for as many of them as are needed to get num_questions QA
+        pairs that pass the evaluator.
+
+        decoding is the name of the decoding preset to generate questions with, and defaults to
+        the generator's decoding preset.
         """
+        qa_list = []
 
-        print("Generating questions...\n")
+        for event in self.generate_stream(
+            article, use_evaluator, num_questions, answer_style, early_exit, decoding
+        ):
+            if event["event"] == "final":
+                qa_list = event["qa_pairs"]
 
-        qg_inputs, qg_answers = self.generate_qg_inputs(article, answer_style)
-        generated_questions = self.generate_questions_from_inputs(qg_inputs)
+        return qa_list
 
-        message = "{} questions doesn't match {} answers".format(
-            len(generated_questions), len(qg_answers)
+    def generate_stream(
+        self,
+        article: str,
+        use_evaluator: bool = True,
+        num_questions: int = None,
+        answer_style: str = "all",
+        early_exit: bool = False,
+        decoding: str = None
+    ) -> Iterator[Mapping[str, Any]]:
+        """Same as generate, but yields QA pairs as soon as they have been generated. Yields a
+        {"event": "batch", "qa_pairs": [...], "completed": n, "total": m} event for each batch of
+        unranked QA pairs, where completed is the number of questions generated so far out of at
+        most total. The last event is {"event": "final", "qa_pairs": [...]}, which holds the same
+        QA pairs that generate would return.
+        """
+        decoding = self._check_decoding(decoding or self.decoding)
+        self.instrumentation.count("requests", answer_style=answer_style, decoding=decoding)
+
+        if self.result_cache is not None:
+            cache_key = self.result_cache.make_key(
+                article,
+                answer_style=answer_style,
+                num_questions=num_questions,
+                use_evaluator=use_evaluator,
+                early_exit=early_exit,
+                seed=self.seed,
+                context_encoding=self.context_encoding,
+                decoding=self.decoding_presets[decoding],
+                models=self._get_model_revisions(),
+            )
+            qa_list = self.result_cache.get(cache_key)
+            if qa_list is not None:
+                self.instrumentation.count("result_cache_hits")
+                yield {"event": "final", "qa_pairs": qa_list}
+                return
+            self.instrumentation.count("result_cache_misses")
+
+        logger.info("Generating questions for %d characters", len(article))
+
+        qg_inputs, qg_answers, answer_labels, qg_input_ids = self._generate_qg_candidates(
+            article, answer_style
         )
-        assert len(generated_questions) == len(qg_answers), message
+        self.instrumentation.count("candidates", len(qg_inputs), answer_style=answer_style)
+
+        if early_exit:
+            order = self._prerank_candidates(qg_answers, answer_labels)
+            if not use_evaluator and num_questions:
+                order = order[:num_questions]
+        else:
+            order = list(range(len(qg_inputs)))
+
+        if early_exit and use_evaluator:
+            round_size = max((num_questions or 10) * self.EARLY_EXIT_OVERSAMPLING, self.batch_size)
+        else:
+            round_size = max(len(order), 1)
+
+        generated_questions = []
+        answers = []
+        scores = []
+        num_completed = 0
+        num_passed = 0
+
+        for start in range(0, len(order), round_size):
+            round_inputs = [qg_inputs[i] for i in order[start:start + round_size]]
+            round_answers = [qg_answers[i] for i in order[start:start + round_size]]
+            round_input_ids = [qg_input_ids[i] for i in order[start:start + round_size]]
+            round_questions = [None] * len(round_inputs)
+
+            for batch_indices, batch_questions in self._generate_question_batches(
+                round_inputs, decoding=decoding, input_ids=round_input_ids
+            ):
+                for index, question in zip(batch_indices, batch_questions):
+                    round_questions[index] = question
+                num_completed += len(batch_indices)
+                yield {
+                    "event": "batch",
+                    "qa_pairs": self._get_all_qa_pairs(
+                        batch_questions, [round_answers[i] for i in batch_indices]
+                    ),
+                    "completed": num_completed,
+                    "total": len(order),
+                }
+
+            generated_questions.extend(round_questions)
+            answers.extend(round_answers)
+
+            if use_evaluator:
+                logger.debug("Evaluating %d QA pairs", len(round_questions))
+                with self.instrumentation.span("evaluation"):
+                    round_logits = self.qa_evaluator.get_logits(round_questions, round_answers)
+                # ranked by the same scores with or without early exit
+                scores.append(_get_scores(round_logits))
+
+                if early_exit:
+                    round_probabilities = _get_scores(round_logits, probabilities=True)
+                    num_passed += int(
+                        (round_probabilities >= self.EVALUATOR_PASS_PROBABILITY).sum()
+                    )
+                    if num_passed >= (num_questions or 10):
+                        break
 
         if use_evaluator:
-            print("Evaluating QA pairs...\n")
-            encoded_qa_pairs = self.qa_evaluator.encode_qa_pairs(
-                generated_questions, qg_answers
-            )
-            scores = self.qa_evaluator.get_scores(encoded_qa_pairs)
+            with self.instrumentation.span("ranking"):
+                scores = np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+                ranking = self.qa_evaluator.rank_scores(scores)
 
-            if num_questions:
-                qa_list = self._get_ranked_qa_pairs(
-                    generated_questions, qg_answers, scores, num_questions
-                )
-            else:
-                qa_list = self._get_ranked_qa_pairs(
-                    generated_questions, qg_answers, scores
-                )
+                if num_questions:
+                    qa_list = self._get_ranked_qa_pairs(
+                        generated_questions, answers, ranking, num_questions
+                    )
+                else:
+                    qa_list = self._get_ranked_qa_pairs(
+                        generated_questions, answers, ranking
+                    )
 
         else:
-            print("Skipping evaluation step.\n")
-            qa_list = self._get_all_qa_pairs(generated_questions, qg_answers)
+            logger.debug("Skipping evaluation step")
+            qa_list = self._get_all_qa_pairs(generated_questions, answers)
 
-        return qa_list
+        if self.result_cache is not None:
+            self.result_cache.put(cache_key, qa_list)
+
+        yield {"event": "final", "qa_pairs": qa_list}
+
+    def _get_model_revisions(self) -> List[str]:
+        """Returns the names, revisions and dtypes of the generator and evaluator checkpoints."""
+        return [
+            _get_model_revision(self.qg_model),
+            _get_model_revision(self.qa_evaluator.qae_model),
+        ]
 
     def generate_qg_inputs(self, text: str, answer_style: str) -> Tuple[List[str], List[str]]:
         """Given a text, returns a list of model inputs and a list of corresponding answers.
@@ -91,6 +442,18 @@ class QuestionGenerator:
         the answer is a string extracted from the text, and the context is the wider text surrounding
         the context.
         """
+        inputs, answers, _, _ = self._generate_qg_candidates(text, answer_style)
+        return inputs, answers
+
+    def _generate_qg_candidates(
+        self,
+        text: str,
+        answer_style: str
+    ) -> Tuple[List[str], List[Any], List[str], List[Optional[List[int]]]]:
+        """Same as generate_qg_inputs, but also returns the kind of each answer (SENTENCE_LABEL
+        for sentence answers, or the NER label of multiple-choice answers) and the token ids of
+        each input, or None for inputs which still have to be tokenized.
+        """
 
         VALID_ANSWER_STYLES = ["all", "sentences", "multiple_choice"]
 
@@ -103,77 +466,292 @@ class QuestionGenerator:
 
         inputs = []
         answers = []
+        labels = []
+        input_ids = []
 
         if answer_style == "sentences" or answer_style == "all":
-            segments = self._split_into_segments(text)
+            with self.instrumentation.span("split_into_segments"):
+                segments = self._get_segments(text)
 
-            for segment in segments:
-                sentences = self._split_text(segment)
-                prepped_inputs, prepped_answers = self._prepare_qg_inputs(
-                    sentences, segment
-                )
-                inputs.extend(prepped_inputs)
-                answers.extend(prepped_answers)
+            with self.instrumentation.span("split_sentences"):
+                segment_sentences = [self._split_text(segment.text) for segment in segments]
+
+            with self.instrumentation.span("sentence_inputs"):
+                for segment, sentences in zip(segments, segment_sentences):
+                    prepped_inputs, prepped_answers = self._prepare_qg_inputs(
+                        sentences, segment.text
+                    )
+                    inputs.extend(prepped_inputs)
+                    answers.extend(prepped_answers)
+                    labels.extend([SENTENCE_LABEL] * len(prepped_answers))
+                    input_ids.extend(self._encode_sentence_inputs(sentences, segment))
 
         if answer_style == "multiple_choice" or answer_style == "all":
-            sentences = self._split_text(text)
-            prepped_inputs, prepped_answers = self._prepare_qg_inputs_MC(
+            with self.instrumentation.span("split_text"):
+                # fragments of long sentences would only repeat their sentence's entities
+                sentences = self._split_text(text, split_long=False)
+            prepped_inputs, prepped_answers, prepped_labels = self._prepare_qg_inputs_MC(
                 sentences
             )
             inputs.extend(prepped_inputs)
             answers.extend(prepped_answers)
+            labels.extend(prepped_labels)
+            input_ids.extend([None] * len(prepped_inputs))
 
-        return inputs, answers
+        return inputs, answers, labels, input_ids
+
+    def _prerank_candidates(self, qg_answers: List[Any], answer_labels: List[str]) -> List[int]:
+        """Orders candidate answers by how likely they are to make good questions, without running
+        any model. Sentence answers are preferred when they are of a moderate length, entity
+        answers according to their NER label, and earlier answers over later ones. Only the first
+        occurrence of a repeated answer is kept. Returns the indices of the remaining candidates,
+        best first.
+        """
+        seen = set()
+        priorities = {}
+
+        for position, (answer, label) in enumerate(zip(qg_answers, answer_labels)):
+            answer_text = self.qa_evaluator._get_correct_answer(answer)
+            key = (label == SENTENCE_LABEL, answer_text.strip().lower())
+            if key in seen:
+                continue
+            seen.add(key)
+
+            if label == SENTENCE_LABEL:
+                num_words = len(answer_text.split())
+                priority = 1.0 if self.MIN_ANSWER_WORDS <= num_words <= self.MAX_ANSWER_WORDS else 0.5
+            else:
+                priority = ENTITY_LABEL_PRIORITIES.get(label, 0.6)
 
-    def generate_questions_from_inputs(self, qg_inputs: List) -> List[str]:
+            # prefer answers from earlier in the text when priorities are otherwise equal
+            priorities[position] = priority - 0.1 * position / len(qg_answers)
+
+        return sorted(priorities, key=lambda i: priorities[i], reverse=True)
+
+    def generate_questions_from_inputs(
+        self, qg_inputs: List, batch_size: int = None, decoding: str = None
+    ) -> List[str]:
         """Given a list of concatenated answers and contexts, with the form:
         "answer_token <answer text> context_token <context text>", generates a list of 
-        questions.
+        questions. Questions are returned in the same order as qg_inputs.
         """
-        generated_questions = []
+        generated_questions = [None] * len(qg_inputs)
 
-        for qg_input in qg_inputs:
-            question = self._generate_question(qg_input)
-            generated_questions.append(question)
+        for indices, questions in self._generate_question_batches(
+            qg_inputs, batch_size, decoding
+        ):
+            for index, question in zip(indices, questions):
+                generated_questions[index] = question
 
         return generated_questions
 
-    def _split_text(self, text: str) -> List[str]:
-        """Splits the text into sentences, and attempts to split or truncate long sentences."""
-        MAX_SENTENCE_LEN = 128
-        sentences = re.findall(".*?[.!\?]", text)
-        cut_sentences = []
+    def _generate_question_batches(
+        self,
+        qg_inputs: List[str],
+        batch_size: int = None,
+        decoding: str = None,
+        input_ids: List[Optional[List[int]]] = None
+    ) -> Iterator[Tuple[List[int], List[str]]]:
+        """Tokenizes all of the inputs once, groups them into batches of similar length and
+        generates the questions for one batch at a time. Yields tuples of (indices of the inputs
+        in qg_inputs, generated questions). Memoized questions are yielded first, as one batch.
+
+        input_ids optionally holds the token ids of each input, as from _encode_sentence_inputs.
+        Only the inputs whose ids are None (or all of them, without input_ids) are tokenized.
+        """
+        if batch_size is None:
+            batch_size = self.batch_size
 
-        for sentence in sentences:
-            if len(sentence) > MAX_SENTENCE_LEN:
-                cut_sentences.extend(re.split("[,;:)]", sentence))
+        decoding = self._check_decoding(decoding or self.decoding)
+
+        uncached_indices = list(range(len(qg_inputs)))
 
-        # remove useless post-quote sentence fragments
-        cut_sentences = [s for s in sentences if len(s.split(" ")) > 5]
-        sentences = sentences + cut_sentences
+        if self.question_memo is not None:
+            cached_indices = []
+            cached_questions = []
+            uncached_indices = []
 
-        return list(set([s.strip(" ") for s in sentences]))
+            for i, qg_input in enumerate(qg_inputs):
+                question = self.question_memo.get((decoding, qg_input))
+                if question is None:
+                    uncached_indices.append(i)
+                else:
+                    cached_indices.append(i)
+                    cached_questions.append(question)
+
+            self.instrumentation.count("question_memo_hits", len(cached_indices))
+            self.instrumentation.count("question_memo_misses", len(uncached_indices))
+
+            if cached_indices:
+                yield cached_indices, cached_questions
+
+        if self.context_encoding == "shared":
+            uncached_indices = yield from self._generate_shared_context_batches(
+                qg_inputs, uncached_indices, batch_size, decoding
+            )
 
-    def _split_into_segments(self, text: str) -> List[str]:
-        """Splits a long text into segments short enough to be input into the transformer network.
-        Segments are used as context for question generation.
+        if len(uncached_indices) == 0:
+            return
+
+        if input_ids is None:
+            input_ids = [None] * len(qg_inputs)
+        untokenized_indices = [i for i in uncached_indices if input_ids[i] is None]
+
+        if untokenized_indices:
+            with self.instrumentation.span("tokenization"), self._tokenizer_lock:
+                tokenized_ids = self.qg_tokenizer(
+                    [qg_inputs[i] for i in untokenized_indices],
+                    max_length=self.SEQ_LENGTH,
+                    truncation=True,
+                )["input_ids"]
+            input_ids = list(input_ids)
+            for i, ids in zip(untokenized_indices, tokenized_ids):
+                input_ids[i] = ids
+
+        uncached_input_ids = [input_ids[i] for i in uncached_indices]
+
+        for batch in _get_length_buckets(uncached_input_ids, batch_size):
+            batch_input_ids = [uncached_input_ids[i] for i in batch]
+            self.instrumentation.observe("question_batch_size", len(batch))
+            with self.instrumentation.span("generation", decoding=decoding):
+                if self.question_batcher is not None:
+                    questions = self.question_batcher.submit(batch_input_ids, key=decoding)
+                else:
+                    questions = self._generate_question_batch(batch_input_ids, decoding)
+            batch_indices = [uncached_indices[i] for i in batch]
+
+            if self.question_memo is not None:
+                for index, question in zip(batch_indices, questions):
+                    self.question_memo.put((decoding, qg_inputs[index]), question)
+
+            yield batch_indices, questions
+
+    def _split_text(self, text: str, split_long: bool = True) -> List[str]:
+        """Splits the text into sentences. With split_long, long sentences are followed by their
+        fragments, as in split_sentences.
         """
-        MAX_TOKENS = 490
-        paragraphs = text.split("\n")
-        tokenized_paragraphs = [
-            self.qg_tokenizer(p)["input_ids"] for p in paragraphs if len(p) > 0
-        ]
+        return [sentence for sentence, _, _ in split_sentences(text, split_long)]
+
+    def _get_segments(self, text: str) -> List[Segment]:
+        """Splits a text into segments of at most MAX_SEGMENT_TOKENS tokens. Paragraphs are packed
+        into a segment whole for as long as they fit, and a paragraph which is too long for one
+        segment is split into windows, at the end of a sentence where possible.
+
+        The text is tokenized once, and segments are sliced out of it using the character offsets
+        of their tokens, so their text never has to be decoded from token ids.
+        """
+        if not self.segment_tokenizer.is_fast:
+            return self._get_segments_without_offsets(text)
+
+        # newlines separate paragraphs, but contexts are passed to the model as one line
+        flat_text = text.replace("\n", " ")
+        with self._tokenizer_lock:
+            encoded_text = self.segment_tokenizer(
+                flat_text,
+                add_special_tokens=False,
+                return_offsets_mapping=True,
+                verbose=False,
+            )
+        input_ids = encoded_text["input_ids"]
+        offsets = encoded_text["offset_mapping"]
+        token_starts = [start for start, _ in offsets]
+        windows = []
+
+        for paragraph_start, paragraph_end in _get_paragraph_spans(text):
+            # the offsets of some tokenizers include the space (here, the newline) before a word
+            first = bisect_left(token_starts, max(paragraph_start - 1, 0))
+            last = bisect_left(token_starts, paragraph_end)
+            if last > first:
+                windows.extend(self._split_token_span(first, last, offsets, flat_text))
+
+        # the ids of a separate segment tokenizer may not match the model's slow tokenizer
+        reuse_ids = self.segment_tokenizer is self.qg_tokenizer
         segments = []
+        for first, last in _pack_spans(windows, self.MAX_SEGMENT_TOKENS):
+            start = offsets[first][0]
+            end = max(offsets[i][1] for i in range(first, last))
+            # words are tokenized separately, so a segment which starts and ends between words
+            # has the same ids as its text tokenized on its own
+            between_words = _is_word_start(flat_text, start) and _is_word_start(flat_text, end)
+            segment_ids = input_ids[first:last] if reuse_ids and between_words else None
+            segments.append(Segment(flat_text[start:end].strip(), start, end, segment_ids))
+
+        return segments
+
+    def _split_token_span(
+        self,
+        first: int,
+        last: int,
+        offsets: List[Tuple[int, int]],
+        text: str
+    ) -> List[Tuple[int, int]]:
+        """Splits the tokens first to last of a paragraph into windows of at most
+        MAX_SEGMENT_TOKENS tokens. Each window ends after the last sentence in it, unless that
+        would make it less than half full, in which case it ends between words. Consecutive
+        windows overlap by about segment_overlap tokens, starting at the beginning of a word.
+        """
+        def starts_word(i: int) -> bool:
+            return _is_word_start(text, offsets[i][0])
+
+        windows = []
+        start = first
+
+        while last - start > self.MAX_SEGMENT_TOKENS:
+            end = start + self.MAX_SEGMENT_TOKENS
+            half = start + self.MAX_SEGMENT_TOKENS // 2
+            cut = end
+
+            for i in range(end, half, -1):
+                token_end = offsets[i - 1][1]
+                if token_end > 0 and text[token_end - 1] in ".!?":
+                    cut = i
+                    break
+            else:
+                cut = next((i for i in range(end, half, -1) if starts_word(i)), end)
 
-        while len(tokenized_paragraphs) > 0:
-            segment = []
+            windows.append((start, cut))
+            next_start = max(cut - self.segment_overlap, start + 1)
+            while next_start > start + 1 and not starts_word(next_start):
+                next_start -= 1
+            start = next_start
 
-            while len(segment) < MAX_TOKENS and len(tokenized_paragraphs) > 0:
-                paragraph = tokenized_paragraphs.pop(0)
-                segment.extend(paragraph)
-            segments.append(segment)
+        windows.append((start, last))
+        return windows
 
-        return [self.qg_tokenizer.decode(s, skip_special_tokens=True) for s in segments]
+    def _get_segments_without_offsets(self, text: str) -> List[Segment]:
+        """Splits a text into segments like _get_segments, for tokenizers which can't return
+        character offsets. Paragraphs are tokenized in one call, and segments are decoded from
+        their token ids.
+        """
+        paragraphs = [p for p in text.split("\n") if len(p) > 0]
+        if len(paragraphs) == 0:
+            return []
+
+        with self._tokenizer_lock:
+            tokenized_paragraphs = self.qg_tokenizer(
+                paragraphs, add_special_tokens=False
+            )["input_ids"]
+        step = max(self.MAX_SEGMENT_TOKENS - self.segment_overlap, 1)
+        input_ids = []
+        windows = []
+
+        for paragraph_ids in tokenized_paragraphs:
+            start = len(input_ids)
+            input_ids.extend(paragraph_ids)
+
+            while len(input_ids) - start > self.MAX_SEGMENT_TOKENS:
+                windows.append((start, start + self.MAX_SEGMENT_TOKENS))
+                start += step
+            windows.append((start, len(input_ids)))
+
+        segments = []
+        for first, last in _pack_spans(windows, self.MAX_SEGMENT_TOKENS):
+            segment_ids = input_ids[first:last]
+            with self._tokenizer_lock:
+                segment_text = self.qg_tokenizer.decode(segment_ids, skip_special_tokens=True)
+            segments.append(Segment(segment_text, None, None, segment_ids))
+
+        return segments
 
     def _prepare_qg_inputs(
         self,
@@ -193,115 +771,263 @@ class QuestionGenerator:
 
         return inputs, answers
 
-    def _prepare_qg_inputs_MC(self, sentences: List[str]) -> Tuple[List[str], List[str]]:
+    def _encode_sentence_inputs(
+        self,
+        sentences: List[str],
+        segment: Segment
+    ) -> List[Optional[List[int]]]:
+        """Returns the token ids of the inputs of _prepare_qg_inputs for sentences and the text
+        of segment, truncated to SEQ_LENGTH tokens. Only "answer_token <answer text>
+        context_token" is tokenized, and the segment's own ids are appended to it, so the context
+        isn't tokenized again for every sentence. Returns Nones if the segment has no ids.
+        """
+        if segment.input_ids is None or not sentences:
+            return [None] * len(sentences)
+
+        with self._tokenizer_lock:
+            answer_ids = self.qg_tokenizer(
+                [f"{self.ANSWER_TOKEN} {sentence} {self.CONTEXT_TOKEN}" for sentence in sentences],
+                add_special_tokens=False,
+            )["input_ids"]
+            max_length = self.SEQ_LENGTH - self.qg_tokenizer.num_special_tokens_to_add()
+
+            return [
+                self.qg_tokenizer.build_inputs_with_special_tokens(
+                    (ids + segment.input_ids)[:max_length]
+                )
+                for ids in answer_ids
+            ]
+
+    def _prepare_qg_inputs_MC(self, sentences: List[str]) -> Tuple[List[str], List[Any], List[str]]:
         """Performs NER on the text, and uses extracted entities are candidate answers for multiple-choice
-        questions. Sentences are used as context, and entities as answers. Returns a tuple of (model inputs, answers). 
-        Model inputs are "answer_token <answer text> context_token <context text>"
+        questions. Sentences are used as context, and entities as answers. Returns a tuple of (model inputs, answers,
+        NER labels of the answers). Model inputs are "answer_token <answer text> context_token <context text>"
         """
-        spacy_nlp = en_core_web_sm.load()
-        docs = list(spacy_nlp.pipe(sentences, disable=["parser"]))
+        spacy_nlp = get_spacy_nlp()
+        with self.instrumentation.span("ner"):
+            docs = list(spacy_nlp.pipe(
+                sentences,
+                batch_size=self.ner_batch_size,
+                n_process=self._get_ner_n_process(len(sentences)),
+            ))
         inputs_from_text = []
         answers_from_text = []
+        labels_from_text = []
 
-        for doc, sentence in zip(docs, sentences):
-            entities = doc.ents
-            if entities:
+        with self.instrumentation.span("mc_answers"):
+            distractor_index = DistractorIndex(docs, rng=random.Random(self.seed))
 
-                for entity in entities:
-                    qg_input = f"{self.ANSWER_TOKEN} {entity} {self.CONTEXT_TOKEN} {sentence}"
-                    answers = self._get_MC_answers(entity, docs)
-                    inputs_from_text.append(qg_input)
-                    answers_from_text.append(answers)
+            for doc, sentence in zip(docs, sentences):
+                entities = doc.ents
+                if entities:
 
-        return inputs_from_text, answers_from_text
+                    for entity in entities:
+                        qg_input = f"{self.ANSWER_TOKEN} {entity} {self.CONTEXT_TOKEN} {sentence}"
+                        answers = self._get_MC_answers(entity, distractor_index)
+                        inputs_from_text.append(qg_input)
+                        answers_from_text.append(answers)
+                        labels_from_text.append(entity.label_)
 
-    def _get_MC_answers(self, correct_answer: Any, docs: Any) -> List[Mapping[str, Any]]:
-        """Finds a set of alternative answers for a multiple-choice question. Will attempt to find
-        alternatives of the same entity type as correct_answer if possible.
+        return inputs_from_text, answers_from_text, labels_from_text
+
+    def _get_ner_n_process(self, num_sentences: int) -> int:
+        """Returns the number of processes to run NER with. Short texts are always processed in
+        the current process, since starting the workers would take longer than the NER itself.
         """
-        entities = []
+        if num_sentences < NER_PARALLEL_MIN_SENTENCES:
+            return 1
 
-        for doc in docs:
-            entities.extend([{"text": e.text, "label_": e.label_}
-                            for e in doc.ents])
+        if self.ner_n_process == -1:
+            return os.cpu_count() or 1
+
+        return self.ner_n_process
 
-        # remove duplicate elements
-        entities_json = [json.dumps(kv) for kv in entities]
-        pool = set(entities_json)
+    def _get_MC_answers(
+        self,
+        correct_answer: Any,
+        distractor_index: "DistractorIndex"
+    ) -> List[Mapping[str, Any]]:
+        """Finds a set of alternative answers for a multiple-choice question. Will attempt to find
+        alternatives of the same entity type as correct_answer if possible.
+        """
         num_choices = (
-            min(4, len(pool)) - 1
+            min(4, len(distractor_index)) - 1
         )  # -1 because we already have the correct answer
 
-        # add the correct answer
-        final_choices = []
-        correct_label = correct_answer.label_
-        final_choices.append({"answer": correct_answer.text, "correct": True})
-        pool.remove(
-            json.dumps({"text": correct_answer.text,
-                       "label_": correct_answer.label_})
+        final_choices = [{"answer": correct_answer.text, "correct": True}]
+        choices = distractor_index.sample(
+            correct_answer.text, correct_answer.label_, num_choices
         )
 
-        # find answers with the same NER label
-        matches = [e for e in pool if correct_label in e]
+        for choice in choices:
+            final_choices.append({"answer": choice, "correct": False})
 
-        # if we don't have enough then add some other random answers
-        if len(matches) < num_choices:
-            choices = matches
-            pool = pool.difference(set(choices))
-            choices.extend(random.sample(list(pool), num_choices - len(choices)))
+        distractor_index.rng.shuffle(final_choices)
+        return final_choices
 
-        else:
-            choices = random.sample(matches, num_choices)
+    @torch.no_grad()
+    def _generate_shared_context_batches(
+        self,
+        qg_inputs: List[str],
+        indices: List[int],
+        batch_size: int,
+        decoding: str = None
+    ) -> Iterator[Tuple[List[int], List[str]]]:
+        """Groups the inputs at indices by their context, and generates the questions of every
+        group with more than one input using a single encoding of the context. Yields tuples of
+        (indices of the inputs in qg_inputs, generated questions), and returns the indices of the
+        inputs which don't share their context and still need to be generated.
+        """
+        groups = {}
+
+        for i in indices:
+            answer, context_token, context = qg_inputs[i].partition(self.CONTEXT_TOKEN)
+            groups.setdefault(context_token + context, []).append((i, answer))
+
+        remaining_indices = []
+
+        for context, group in groups.items():
+            if len(group) == 1:
+                remaining_indices.append(group[0][0])
+                continue
+
+            with self._tokenizer_lock:
+                context_ids = self.qg_tokenizer(
+                    context, max_length=self.SEQ_LENGTH, truncation=True
+                )["input_ids"]
+                answer_ids = self.qg_tokenizer(
+                    [answer for _, answer in group],
+                    add_special_tokens=False,
+                    max_length=self.SEQ_LENGTH,
+                    truncation=True,
+                )["input_ids"]
+
+            for start in range(0, len(group), batch_size):
+                batch_indices = [i for i, _ in group[start:start + batch_size]]
+                self.instrumentation.observe("question_batch_size", len(batch_indices))
+                with self.instrumentation.span("generation", decoding=decoding):
+                    questions = self._generate_shared_context_batch(
+                        answer_ids[start:start + batch_size], context_ids, decoding
+                    )
 
-        choices = [json.loads(s) for s in choices]
+                if self.question_memo is not None:
+                    for index, question in zip(batch_indices, questions):
+                        self.question_memo.put((decoding, qg_inputs[index]), question)
 
-        for choice in choices:
-            final_choices.append({"answer": choice["text"], "correct": False})
+                yield batch_indices, questions
 
-        random.shuffle(final_choices)
-        return final_choices
+        return sorted(remaining_indices)
 
     @torch.no_grad()
-    def _generate_question(self, qg_input: str) -> str:
-        """Takes qg_input which is the concatenated answer and context, and uses it to generate
-        a question sentence. The generated question is decoded and then returned.
-        """
-        encoded_input = self._encode_qg_input(qg_input)
-        output = self.qg_model.generate(input_ids=encoded_input["input_ids"])
-        question = self.qg_tokenizer.decode(
-            output[0],
-            skip_special_tokens=True
+    def _generate_shared_context_batch(
+        self,
+        batch_answer_ids: List[List[int]],
+        context_ids: List[int],
+        decoding: str = None
+    ) -> List[str]:
+        """Generates questions for a batch of answers which share the same context. The context is
+        encoded once, and its encoding is appended to the encoding of each answer.
+        """
+        encoder = self.qg_model.get_encoder()
+        context = torch.tensor([context_ids], device=self.device)
+        context_states = encoder(
+            input_ids=context, attention_mask=torch.ones_like(context)
+        ).last_hidden_state
+
+        answers = self._pad_qg_batch(batch_answer_ids)
+        answer_states = encoder(
+            input_ids=answers["input_ids"],
+            attention_mask=answers["attention_mask"],
+        ).last_hidden_state
+
+        batch_size = len(batch_answer_ids)
+        encoder_states = torch.cat(
+            [answer_states, context_states.expand(batch_size, -1, -1)], dim=1
+        )
+        attention_mask = torch.cat(
+            [answers["attention_mask"], torch.ones_like(context).expand(batch_size, -1)], dim=1
+        )
+        output = self._decode(
+            decoding,
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_states),
+            attention_mask=attention_mask,
+        )
+        with self._tokenizer_lock:
+            return self.qg_tokenizer.batch_decode(output, skip_special_tokens=True)
+
+    @torch.no_grad()
+    def _generate_question_batch(
+        self, batch_input_ids: List[List[int]], decoding: str = None
+    ) -> List[str]:
+        """Pads a batch of tokenized inputs to the length of its longest member and generates a
+        question for each input in a single call to the model.
+        """
+        encoded_batch = self._pad_qg_batch(batch_input_ids)
+        output = self._decode(
+            decoding,
+            input_ids=encoded_batch["input_ids"],
+            attention_mask=encoded_batch["attention_mask"],
+        )
+        with self._tokenizer_lock:
+            return self.qg_tokenizer.batch_decode(output, skip_special_tokens=True)
+
+    def _decode(self, decoding: str, **model_inputs: Any) -> torch.Tensor:
+        """Calls qg_model.generate with the keyword arguments of a decoding preset, and records
+        how long it took and how many tokens it generated.
+        """
+        decoding = decoding or self.decoding
+        start = time.perf_counter()
+        output = self.qg_model.generate(**model_inputs, **self.decoding_presets[decoding])
+        # each output starts with the decoder start token, and is padded after its end token
+        generated = output[:, 1:]
+        is_end = generated == self.qg_tokenizer.eos_token_id
+        num_tokens = int(((is_end.cumsum(dim=1) - is_end.int()) == 0).sum())
+        self.decoding_stats.record(
+            decoding, len(output), num_tokens, time.perf_counter() - start
         )
-        return question
+        self.instrumentation.count("questions_generated", len(output), decoding=decoding)
+        self.instrumentation.count("generated_tokens", num_tokens, decoding=decoding)
+        return output
+
+    def _check_decoding(self, decoding: str) -> str:
+        if decoding not in self.decoding_presets:
+            raise ValueError(
+                "Invalid decoding preset {}. Please choose from {}".format(
+                    decoding, list(self.decoding_presets)
+                )
+            )
+        return decoding
 
-    def _encode_qg_input(self, qg_input: str) -> torch.tensor:
-        """Tokenizes a string and returns a tensor of input ids corresponding to indices of tokens in 
-        the vocab.
+    def _pad_qg_batch(self, batch_input_ids: List[List[int]]) -> Mapping[str, torch.Tensor]:
+        """Pads a batch of tokenized inputs to the length of its longest member (rounded up to
+        pad_to_multiple_of if set). Returns tensors of input ids and attention masks.
         """
-        return self.qg_tokenizer(
-            qg_input,
-            padding='max_length',
-            max_length=self.SEQ_LENGTH,
-            truncation=True,
-            return_tensors="pt",
-        ).to(self.device)
+        with self._tokenizer_lock:
+            encoded_batch = self.qg_tokenizer.pad(
+                {"input_ids": batch_input_ids},
+                padding="longest",
+                pad_to_multiple_of=self.pad_to_multiple_of,
+                return_tensors="pt",
+            )
+        return encoded_batch.to(self.device)
 
     def _get_ranked_qa_pairs(
-        self, generated_questions: List[str], qg_answers: List[str], scores, num_questions: int = 10
+        self, generated_questions: List[str], qg_answers: List[str], ranking, num_questions: int = 10
     ) -> List[Mapping[str, str]]:
-        """Ranks generated questions according to scores, and returns the top num_questions examples.
+        """Orders generated questions according to ranking (indices of the QA pairs from best to
+        worst), and returns the top num_questions examples.
         """
-        if num_questions > len(scores):
-            num_questions = len(scores)
-            print((
-                f"\nWas only able to generate {num_questions} questions.",
-                "For more questions, please input a longer text.")
+        if num_questions > len(ranking):
+            num_questions = len(ranking)
+            logger.info(
+                "Was only able to generate %d questions. For more questions, please input a "
+                "longer text.", num_questions
             )
 
         qa_list = []
 
         for i in range(num_questions):
-            index = scores[i]
+            index = ranking[i]
             qa = {
                 "question": generated_questions[index].split("?")[0] + "?",
                 "answer": qg_answers[index]
@@ -324,51 +1050,289 @@ class QuestionGenerator:
         return qa_list
 
 
+class DistractorIndex:
+    """The pool of alternative answers for the multiple-choice questions of one text. The named
+    entities found in the text are deduplicated and grouped by NER label once, so that picking
+    the alternatives for a question doesn't require scanning the whole pool.
+    """
+
+    def __init__(self, docs: Iterable[Any], rng: random.Random = None) -> None:
+        self.rng = rng or random.Random()
+        self.texts: List[str] = []
+        self.labels: List[str] = []
+        self.by_label: Dict[str, List[int]] = {}
+        self._positions: Dict[Tuple[str, str], int] = {}
+
+        for doc in docs:
+            for entity in doc.ents:
+                key = (entity.text, entity.label_)
+                if key not in self._positions:
+                    self._positions[key] = len(self.texts)
+                    self.by_label.setdefault(entity.label_, []).append(len(self.texts))
+                    self.texts.append(entity.text)
+                    self.labels.append(entity.label_)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def sample(self, text: str, label: str, k: int) -> List[str]:
+        """Returns up to k distinct entities other than (text, label). Entities with the same
+        label are chosen first, and any remaining places are filled with random other entities.
+        """
+        exclude = {self._positions.get((text, label))}
+        same_label = self.by_label.get(label, [])
+        choices = self._sample_excluding(same_label, k, exclude)
+
+        if len(choices) < k:
+            # every entity with this label has been used, so they are all few enough to exclude
+            exclude.update(same_label)
+            choices.extend(
+                self._sample_excluding(range(len(self.texts)), k - len(choices), exclude)
+            )
+
+        return [self.texts[i] for i in choices]
+
+    def _sample_excluding(self, population: Any, k: int, exclude: Set[int]) -> List[int]:
+        """Samples k positions from population which are not in exclude. Only k + len(exclude)
+        positions are drawn, so the cost doesn't depend on the size of the population.
+        """
+        num_samples = min(len(population), k + len(exclude))
+        sampled = self.rng.sample(population, num_samples)
+        return [i for i in sampled if i not in exclude][:k]
+
+
+class DecodingStats:
+    """Thread-safe running totals of the questions generated with each decoding preset: the
+    number of calls to the model, the number of questions, the number of generated tokens and
+    the time spent generating them.
+    """
+
+    def __init__(self) -> None:
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, decoding: str, num_questions: int, num_tokens: int, seconds: float) -> None:
+        with self._lock:
+            totals = self._totals.setdefault(
+                decoding, {"calls": 0, "questions": 0, "tokens": 0, "seconds": 0.0}
+            )
+            totals["calls"] += 1
+            totals["questions"] += num_questions
+            totals["tokens"] += num_tokens
+            totals["seconds"] += seconds
+
+    def clear(self) -> None:
+        with self._lock:
+            self._totals.clear()
+
+    def stats(self) -> Mapping[str, Mapping[str, float]]:
+        """Returns the totals of each preset, with the mean latency per question, the mean
+        number of tokens per question and the number of tokens generated per second.
+        """
+        with self._lock:
+            totals = {decoding: dict(values) for decoding, values in self._totals.items()}
+
+        for values in totals.values():
+            values["seconds_per_question"] = values["seconds"] / values["questions"]
+            values["tokens_per_question"] = values["tokens"] / values["questions"]
+            values["tokens_per_second"] = (
+                values["tokens"] / values["seconds"] if values["seconds"] else None
+            )
+
+        return totals
+
+
 class QAEvaluator:
     """Wrapper for a transformer model which evaluates the quality of question-answer pairs.
     Given a QA pair, the model will generate a score. Scores can be used to rank and filter
     QA pairs.
+
+    If a qg_cache.LRUCache is given as score_memo, the score of each (question, answer) pair is
+    memoized and reused when the same pair is scored again. backend, backend_options, the
+    micro-batching options and instrumentation are the same as those of QuestionGenerator.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        model_dir: str = None,
+        device: str = None,
+        dtype: str = None,
+        batch_size: int = 32,
+        pad_to_multiple_of: int = None,
+        score_memo: Any = None,
+        backend: str = "torch",
+        backend_options: Mapping[str, Any] = None,
+        micro_batch_wait: float = None,
+        micro_batch_queue_size: int = 1024,
+        micro_batch_size: int = None,
+        instrumentation: Instrumentation = None
+    ) -> None:
 
-        QAE_PRETRAINED = "iarfmoose/bert-base-cased-qa-evaluator"
         self.SEQ_LENGTH = 512
+        self.batch_size = batch_size
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.score_memo = score_memo
+        self.instrumentation = instrumentation or Instrumentation()
+
+        self.batcher = None
+        if micro_batch_wait is not None:
+            self.batcher = MicroBatcher(
+                self._evaluate_qa_pairs,
+                max_batch_size=micro_batch_size or batch_size,
+                max_wait=micro_batch_wait,
+                max_queue_size=micro_batch_queue_size,
+                name="scores",
+            )
 
-        self.device = torch.device(
-            "cuda" if torch.cuda.is_available() else "cpu")
-
-        self.qae_tokenizer = AutoTokenizer.from_pretrained(QAE_PRETRAINED)
-        self.qae_model = AutoModelForSequenceClassification.from_pretrained(
-            QAE_PRETRAINED
+        self.device = get_device(device)
+
+        self.qae_tokenizer = AutoTokenizer.from_pretrained(model_dir or QAE_PRETRAINED)
+        # see QuestionGenerator._tokenizer_lock
+        self._tokenizer_lock = threading.Lock()
+        self.qae_model = load_model(
+            AutoModelForSequenceClassification,
+            model_dir or QAE_PRETRAINED,
+            self.device,
+            dtype,
+            backend,
+            **(backend_options or {})
         )
-        self.qae_model.to(self.device)
-        self.qae_model.eval()
 
-    def encode_qa_pairs(self, questions: List[str], answers: List[str]) -> List[torch.tensor]:
-        """Takes a list of questions and a list of answers and encodes them as a list of tensors."""
-        encoded_pairs = []
+    def score_qa_pairs(
+        self,
+        questions: List[str],
+        answers: List[Any],
+        batch_size: int = None,
+        probabilities: bool = False
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Scores a list of QA pairs in batches. Returns an array of scores, and an array of the
+        indices of the pairs ordered from the highest to the lowest score.
+
+        Scores are the model's logits for each pair being a good one, or the probability of it
+        being a good one if probabilities is True.
+        """
+        scores = _get_scores(self.get_logits(questions, answers, batch_size), probabilities)
+        return scores, self.rank_scores(scores)
 
-        for question, answer in zip(questions, answers):
-            encoded_qa = self._encode_qa(question, answer)
-            encoded_pairs.append(encoded_qa.to(self.device))
+    def get_logits(
+        self,
+        questions: List[str],
+        answers: List[Any],
+        batch_size: int = None
+    ) -> np.ndarray:
+        """Runs a list of QA pairs through the model in batches, and returns its logits for each
+        pair being a bad and a good one, as an array of shape (number of pairs, 2). Both the
+        scores and the probabilities of the pairs are derived from them.
+        """
+        logits = np.zeros((len(questions), 2), dtype=np.float32)
+        keys = [
+            (question, self._get_correct_answer(answer))
+            for question, answer in zip(questions, answers)
+        ]
+        unscored_indices = list(range(len(questions)))
 
-        return encoded_pairs
+        if self.score_memo is not None:
+            unscored_indices = []
 
-    def get_scores(self, encoded_qa_pairs: List[torch.tensor]) -> List[float]:
-        """Generates scores for a list of encoded QA pairs."""
-        scores = {}
+            for i, key in enumerate(keys):
+                pair_logits = self.score_memo.get(key)
+                if pair_logits is None:
+                    unscored_indices.append(i)
+                else:
+                    logits[i] = pair_logits
 
-        for i in range(len(encoded_qa_pairs)):
-            scores[i] = self._evaluate_qa(encoded_qa_pairs[i])
+            self.instrumentation.count("score_memo_hits", len(questions) - len(unscored_indices))
+            self.instrumentation.count("score_memo_misses", len(unscored_indices))
 
-        return [
-            k for k, v in sorted(scores.items(), key=lambda item: item[1], reverse=True)
-        ]
+        if unscored_indices:
+            encoded_qa_pairs = self.encode_qa_pairs(
+                [questions[i] for i in unscored_indices],
+                [answers[i] for i in unscored_indices],
+            )
+            new_logits = self._get_encoded_logits(encoded_qa_pairs, batch_size)
+            logits[unscored_indices] = new_logits
+
+            if self.score_memo is not None:
+                for i, pair_logits in zip(unscored_indices, new_logits):
+                    self.score_memo.put(keys[i], tuple(float(logit) for logit in pair_logits))
+
+        return logits
 
-    def _encode_qa(self, question: str, answer: str) -> torch.tensor:
-        """Concatenates a question and answer, and then tokenizes them. Returns a tensor of 
-        input ids corresponding to indices in the vocab.
+    def encode_qa_pairs(self, questions: List[str], answers: List[Any]) -> Mapping[str, List[List[int]]]:
+        """Takes a list of questions and a list of answers and tokenizes all of the pairs at once.
+        The pairs are not padded here; padding is applied to each batch when it is scored.
+        """
+        correct_answers = [self._get_correct_answer(answer) for answer in answers]
+
+        with self._tokenizer_lock:
+            return self.qae_tokenizer(
+                text=questions,
+                text_pair=correct_answers,
+                max_length=self.SEQ_LENGTH,
+                truncation=True,
+            )
+
+    def get_scores(
+        self,
+        encoded_qa_pairs: Mapping[str, List[List[int]]],
+        batch_size: int = None
+    ) -> List[int]:
+        """Scores the encoded QA pairs, and returns their indices ordered from the best to the
+        worst pair.
+        """
+        return self.rank_scores(self.score_encoded_qa_pairs(encoded_qa_pairs, batch_size)).tolist()
+
+    def score_encoded_qa_pairs(
+        self,
+        encoded_qa_pairs: Mapping[str, List[List[int]]],
+        batch_size: int = None,
+        probabilities: bool = False
+    ) -> np.ndarray:
+        """Generates a score for each of the encoded QA pairs. Pairs of a similar length are run
+        through the model together, batch_size pairs at a time, so that memory use is bounded by
+        the batch size rather than by the number of pairs.
+
+        Scores are the model's logits for the pair being a good one, or the probability of it
+        being a good one if probabilities is True.
+        """
+        return _get_scores(self._get_encoded_logits(encoded_qa_pairs, batch_size), probabilities)
+
+    def _get_encoded_logits(
+        self,
+        encoded_qa_pairs: Mapping[str, List[List[int]]],
+        batch_size: int = None
+    ) -> np.ndarray:
+        """Returns the logits of each of the encoded QA pairs, as in get_logits."""
+        if batch_size is None:
+            batch_size = self.batch_size
+
+        input_ids = encoded_qa_pairs["input_ids"]
+        logits = np.zeros((len(input_ids), 2), dtype=np.float32)
+
+        for batch_indices in _get_length_buckets(input_ids, batch_size):
+            batch = {
+                key: [values[i] for i in batch_indices]
+                for key, values in encoded_qa_pairs.items()
+            }
+            self.instrumentation.observe("evaluator_batch_size", len(batch_indices))
+            self.instrumentation.count("qa_pairs_scored", len(batch_indices))
+            if self.batcher is not None:
+                pairs = [dict(zip(batch, values)) for values in zip(*batch.values())]
+                logits[batch_indices] = np.array(self.batcher.submit(pairs))
+            else:
+                logits[batch_indices] = self._evaluate_qa_batch(batch)
+
+        return logits
+
+    def rank_scores(self, scores: np.ndarray) -> np.ndarray:
+        """Returns the indices of scores ordered from the highest to the lowest score. Pairs with
+        equal scores keep their original order.
+        """
+        return np.argsort(-scores, kind="stable")
+
+    def _get_correct_answer(self, answer: Any) -> str:
+        """Returns the answer text of a QA pair. For multiple-choice answers this is the text of
+        the correct choice.
         """
         if type(answer) is list:
             for a in answer:
@@ -377,20 +1341,235 @@ class QAEvaluator:
         else:
             correct_answer = answer
 
-        return self.qae_tokenizer(
-            text=question,
-            text_pair=correct_answer,
-            padding="max_length",
-            max_length=self.SEQ_LENGTH,
-            truncation=True,
-            return_tensors="pt",
-        )
+        return correct_answer
+
+    def _evaluate_qa_pairs(
+        self,
+        pairs: List[Mapping[str, List[int]]],
+        key: Any = None
+    ) -> np.ndarray:
+        """Returns the logits of a list of individually tokenized QA pairs, from a single
+        forward pass. key is the (unused) key of the micro-batch.
+        """
+        batch = {name: [pair[name] for pair in pairs] for name in pairs[0]}
+        return self._evaluate_qa_batch(batch)
 
     @torch.no_grad()
-    def _evaluate_qa(self, encoded_qa_pair: torch.tensor) -> float:
-        """Takes an encoded QA pair and returns a score."""
-        output = self.qae_model(**encoded_qa_pair)
-        return output[0][0][1]
+    def _evaluate_qa_batch(self, batch: Mapping[str, List[List[int]]]) -> np.ndarray:
+        """Pads a batch of tokenized QA pairs and returns their logits from a single forward
+        pass.
+        """
+        with self._tokenizer_lock:
+            encoded_batch = self.qae_tokenizer.pad(
+                batch,
+                padding="longest",
+                pad_to_multiple_of=self.pad_to_multiple_of,
+                return_tensors="pt",
+            )
+        encoded_batch = encoded_batch.to(self.device)
+        return self.qae_model(**encoded_batch)[0].float().cpu().numpy()
+
+
+def _get_scores(logits: np.ndarray, probabilities: bool = False) -> np.ndarray:
+    """Returns the scores of QA pairs from the evaluator's logits: the logits of the pairs being
+    good ones, or the softmax probabilities of that if probabilities is True.
+    """
+    if not probabilities:
+        return logits[:, 1]
+
+    exp_logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return exp_logits[:, 1] / exp_logits.sum(axis=1)
+
+
+def get_spacy_nlp() -> Any:
+    """Returns the spaCy pipeline used for NER. It is loaded once, the first time it is needed,
+    with only the components that NER depends on, and then shared by every QuestionGenerator.
+    """
+    global _spacy_nlp
+
+    if _spacy_nlp is None:
+        with _spacy_lock:
+            if _spacy_nlp is None:
+                # imported here, since loading spaCy and its model takes a while
+                import en_core_web_sm
+                _spacy_nlp = en_core_web_sm.load(exclude=SPACY_EXCLUDE)
+
+    return _spacy_nlp
+
+
+def split_sentences(text: str, split_long: bool = True) -> List[Tuple[str, int, int]]:
+    """Splits a text into sentences in a single pass, and returns (sentence, start, end) tuples
+    where start and end are the character offsets of the sentence in the text. Text which isn't
+    terminated by a full stop, question mark or exclamation mark is not a sentence.
+
+    With split_long, each sentence longer than MAX_SENTENCE_LEN characters is followed by its
+    fragments between commas, semicolons, colons and closing brackets which have at least
+    MIN_FRAGMENT_WORDS words, as shorter answers. Repeated sentences and fragments are only
+    returned the first time they occur, and the order of the text is kept.
+    """
+    sentences = {}
+
+    for match in SENTENCE_PATTERN.finditer(text):
+        if match.group()[-1] not in ".!?":
+            continue
+
+        spans = [(match.start(), match.end())]
+        if split_long and match.end() - match.start() > MAX_SENTENCE_LEN:
+            spans.extend(_get_fragments(text, match.start(), match.end()))
+
+        for start, end in spans:
+            sentence = text[start:end]
+            stripped = sentence.strip(" ")
+            if stripped and stripped not in sentences:
+                start += len(sentence) - len(sentence.lstrip(" "))
+                sentences[stripped] = (stripped, start, start + len(stripped))
+
+    return list(sentences.values())
+
+
+def _get_fragments(text: str, start: int, end: int) -> List[Tuple[int, int]]:
+    """Returns the (start, end) offsets of the fragments of the sentence text[start:end] between
+    its separators which have at least MIN_FRAGMENT_WORDS words.
+    """
+    fragments = []
+    fragment_start = start
+
+    for separator in FRAGMENT_SEPARATOR_PATTERN.finditer(text, start, end):
+        fragments.append((fragment_start, separator.start()))
+        fragment_start = separator.end()
+    fragments.append((fragment_start, end))
+
+    return [
+        (fragment_start, fragment_end) for fragment_start, fragment_end in fragments
+        if len(text[fragment_start:fragment_end].split()) >= MIN_FRAGMENT_WORDS
+    ]
+
+
+def load_qg_tokenizer(model_dir: str, use_fast: bool = True) -> Any:
+    """Loads the tokenizer of a question generation model. The fast (Rust) tokenizer is used if
+    the model has one and it encodes and decodes TOKENIZER_PARITY_TEXTS, including the <answer>
+    and <context> tokens, exactly like the slow tokenizer. Otherwise, or with use_fast=False,
+    the slow tokenizer is used.
+    """
+    slow_tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=False)
+    if not use_fast:
+        return slow_tokenizer
+
+    fast_tokenizer = _load_fast_tokenizer(model_dir, None)
+    if fast_tokenizer is None:
+        return slow_tokenizer
+
+    mismatches = get_tokenizer_mismatches(slow_tokenizer, fast_tokenizer)
+    if mismatches:
+        warnings.warn(
+            "The fast tokenizer of {} doesn't match its slow tokenizer on {!r}, so the slow "
+            "tokenizer will be used".format(model_dir, mismatches[0])
+        )
+        return slow_tokenizer
+
+    return fast_tokenizer
+
+
+def get_tokenizer_mismatches(
+    slow_tokenizer: Any,
+    fast_tokenizer: Any,
+    texts: List[str] = TOKENIZER_PARITY_TEXTS
+) -> List[str]:
+    """Returns the texts which fast_tokenizer encodes differently from slow_tokenizer, with or
+    without special tokens, or whose ids it decodes to different text.
+    """
+    mismatches = []
+
+    for text in texts:
+        for add_special_tokens in [True, False]:
+            slow_ids = slow_tokenizer(text, add_special_tokens=add_special_tokens)["input_ids"]
+            fast_ids = fast_tokenizer(text, add_special_tokens=add_special_tokens)["input_ids"]
+            if fast_ids != slow_ids or fast_tokenizer.decode(
+                slow_ids, skip_special_tokens=True
+            ) != slow_tokenizer.decode(slow_ids, skip_special_tokens=True):
+                mismatches.append(text)
+                break
+
+    return mismatches
+
+
+def _load_fast_tokenizer(model_dir: str, default: Any) -> Any:
+    """Loads the fast (Rust) version of a tokenizer, which can return the character offsets of
+    tokens. Returns default if there is no fast version of the tokenizer.
+    """
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
+    except (ImportError, OSError, ValueError):
+        return default
+
+    return tokenizer if tokenizer.is_fast else default
+
+
+def _get_paragraph_spans(text: str) -> List[Tuple[int, int]]:
+    """Returns the (start, end) character offsets of the non-empty lines of a text."""
+    spans = []
+    start = 0
+
+    for line in text.split("\n"):
+        end = start + len(line)
+        if len(line.strip()) > 0:
+            spans.append((start, end))
+        start = end + 1
+
+    return spans
+
+
+def _is_word_start(text: str, position: int) -> bool:
+    """Whether a token starting at a character position starts a word, for offsets which either
+    include or exclude the space before the word.
+    """
+    if position <= 0 or position >= len(text):
+        return True
+    return text[position].isspace() or text[position - 1].isspace()
+
+
+def _pack_spans(spans: List[Tuple[int, int]], max_tokens: int) -> List[Tuple[int, int]]:
+    """Merges consecutive (first, last) token spans for as long as the merged span is at most
+    max_tokens long.
+    """
+    packed = []
+
+    for first, last in spans:
+        if packed and last - packed[-1][0] <= max_tokens:
+            packed[-1] = (packed[-1][0], last)
+        else:
+            packed.append((first, last))
+
+    return packed
+
+
+def _get_model_revision(model: Any) -> str:
+    """Identifies the checkpoint a model was loaded from, including its hub commit if known."""
+    config = model.config
+    return "{}@{}:{}:{}{}".format(
+        config._name_or_path,
+        getattr(config, "_commit_hash", None),
+        type(model).__name__,
+        model.dtype,
+        "+int8" if getattr(model, "is_quantized_int8", False) else "",
+    )
+
+
+def get_device(device: str = None) -> torch.device:
+    """Returns the torch device with the given name, or CUDA if it is available and no device
+    is given.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+def _get_length_buckets(input_ids: List[List[int]], batch_size: int) -> List[List[int]]:
+    """Sorts the indices of tokenized inputs by length and splits them into batches, so that
+    inputs of a similar length are padded together.
+    """
+    order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
 
 
 def print_qa(qa_list: List[Mapping[str, str]], show_answers: bool = True) -> None:
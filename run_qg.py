@@ -1,7 +1,9 @@
 #run_qg.py
 import argparse
-from questiongenerator import QuestionGenerator
-from questiongenerator import print_qa
+import logging
+from qg_cache import ResultCache
+from qg_metrics import Metrics
+from qg_registry import get_question_generator
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
@@ -11,9 +13,43 @@ def parse_args() -> argparse.Namespace:
         type=str,
         help="The desired type of answers. Choose from ['all', 'sentences', 'multiple_choice']",
     )
+    parser.add_argument(
+        "--backend",
+        default="torch",
+        type=str,
+        help="How to run the models. Choose from ['torch', 'onnx']",
+    )
+    parser.add_argument("--cache_path", type=str, default=None)
+    parser.add_argument(
+        "--decoding",
+        default=None,
+        type=str,
+        help="The decoding preset. Choose from ['default', 'fast', 'balanced', 'quality']",
+    )
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument(
+        "--dtype",
+        default=None,
+        type=str,
+        help="The dtype of the models, e.g. 'float32' or 'bfloat16', or 'int8' to quantize them on CPU",
+    )
+    parser.add_argument("--early_exit", dest="early_exit", action="store_true", default=False)
+    parser.add_argument("--evaluator_dir", type=str, default=None)
+    parser.add_argument(
+        "--graph_optimization_level",
+        default="all",
+        type=str,
+        help="ONNX Runtime graph optimizations. Choose from ['disable', 'basic', 'extended', 'all']",
+    )
+    parser.add_argument("--inter_op_num_threads", type=int, default=None)
+    parser.add_argument("--intra_op_num_threads", type=int, default=None)
     parser.add_argument("--model_dir", type=str, default=None)
+    parser.add_argument("--num_interop_threads", type=int, default=None)
     parser.add_argument("--num_questions", type=int, default=10)
+    parser.add_argument("--num_threads", type=int, default=None)
     parser.add_argument("--show_answers", dest="show_answers", action="store_true", default=True)
+    parser.add_argument("--show_stats", dest="show_stats", action="store_true", default=False)
+    parser.add_argument("--stream", dest="stream", action="store_true", default=False)
     parser.add_argument("--text_file", type=str, required=True)
     parser.add_argument("--use_qa_eval", dest="use_qa_eval", action="store_true", default=True)
     return parser.parse_args()
@@ -21,13 +57,60 @@ def parse_args() -> argparse.Namespace:
 
 if __name__ == "__main__":
     args = parse_args()
+    # imported after parsing the arguments, so that --help doesn't wait for torch to load
+    from questiongenerator import print_qa
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    metrics = Metrics()
     with open(args.text_file, 'r') as file:
         text_file = file.read()
-    qg = QuestionGenerator()
-    qa_list = qg.generate(
-        text_file,
-        num_questions=int(args.num_questions),
-        answer_style=args.answer_style,
-        use_evaluator=args.use_qa_eval
+    qg = get_question_generator(
+        model_dir=args.model_dir,
+        device=args.device,
+        dtype=args.dtype,
+        backend=args.backend,
+        backend_options={
+            "graph_optimization_level": args.graph_optimization_level,
+            "intra_op_num_threads": args.intra_op_num_threads,
+            "inter_op_num_threads": args.inter_op_num_threads,
+        } if args.backend == "onnx" else None,
+        evaluator_dir=args.evaluator_dir,
+        num_threads=args.num_threads,
+        num_interop_threads=args.num_interop_threads,
+        result_cache=ResultCache(path=args.cache_path) if args.cache_path else None,
+        instrumentation=metrics
     )
-    print_qa(qa_list, show_answers=args.show_answers)
\ No newline at end of file
+    if args.stream:
+        for event in qg.generate_stream(
+            text_file,
+            num_questions=int(args.num_questions),
+            answer_style=args.answer_style,
+            use_evaluator=args.use_qa_eval,
+            early_exit=args.early_exit,
+            decoding=args.decoding
+        ):
+            if event["event"] == "batch":
+                print(f"Generated {event['completed']}/{event['total']} questions")
+                for qa in event["qa_pairs"]:
+                    print(f"   Q: {qa['question']}")
+            else:
+                qa_list = event["qa_pairs"]
+    else:
+        qa_list = qg.generate(
+            text_file,
+            num_questions=int(args.num_questions),
+            answer_style=args.answer_style,
+            use_evaluator=args.use_qa_eval,
+            early_exit=args.early_exit,
+            decoding=args.decoding
+        )
+    print_qa(qa_list, show_answers=args.show_answers)
+    if args.show_stats:
+        for decoding, stats in qg.decoding_stats.stats().items():
+            print(
+                f"{decoding}: {stats['questions']} questions in {stats['seconds']:.2f}s, "
+                f"{stats['tokens_per_question']:.1f} tokens per question, "
+                f"{stats['tokens_per_second']:.1f} tokens/s"
+            )
+        for name, summary in metrics.snapshot()["summaries"].items():
+            if name.startswith("stage_seconds"):
+                print(f"{name}: {summary['sum']:.3f}s in {summary['count']} runs")
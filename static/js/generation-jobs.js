@@ -0,0 +1,101 @@
+// Submits the question generation form as a background job, then polls the job until its
+// questions are ready. Without JavaScript, the form is posted and rendered by the server.
+(function () {
+    var form = document.getElementById('generate-questions-form');
+    if (!form || !window.fetch || !window.FormData) {
+        return;
+    }
+
+    var status = document.getElementById('generation-job-status');
+    var results = document.getElementById('generation-job-results');
+    var questionType = 'with_answers';
+    var pollInterval = 1000;
+
+    form.querySelectorAll('button[name="question_type"]').forEach(function (button) {
+        button.addEventListener('click', function () {
+            questionType = button.value;
+        });
+    });
+
+    form.addEventListener('submit', function (event) {
+        event.preventDefault();
+        results.innerHTML = '';
+        status.textContent = 'Submitting...';
+
+        fetch(form.dataset.jobUrl, { method: 'POST', body: new FormData(form), credentials: 'same-origin' })
+            .then(function (response) {
+                return response.json().then(function (job) {
+                    if (!response.ok) {
+                        throw new Error(job.errors ? JSON.stringify(job.errors) : response.statusText);
+                    }
+                    poll(job.url, questionType);
+                });
+            })
+            .catch(showError);
+    });
+
+    function poll(url, type) {
+        fetch(url, { credentials: 'same-origin' })
+            .then(function (response) { return response.json(); })
+            .then(function (job) {
+                if (job.status === 'succeeded') {
+                    status.textContent = '';
+                    render(job.result, type);
+                } else if (job.status === 'failed') {
+                    showError(new Error(job.error));
+                } else {
+                    status.textContent = job.status === 'queued'
+                        ? 'Waiting for a free worker...'
+                        : 'Generating questions... ' + Math.round(job.progress * 100) + '%';
+                    setTimeout(function () { poll(url, type); }, pollInterval);
+                }
+            })
+            .catch(showError);
+    }
+
+    function showError(error) {
+        status.textContent = 'Could not generate questions: ' + error.message;
+    }
+
+    // splits the QA pairs the same way as generate_questions_view
+    function render(qaList, type) {
+        var multipleChoice = type !== 'with_answers';
+        var questions = qaList.filter(function (qa) {
+            return 'answer' in qa && Array.isArray(qa.answer) === multipleChoice;
+        });
+
+        if (!questions.length) {
+            status.textContent = 'No questions were generated.';
+            return;
+        }
+
+        results.appendChild(element('h2', 'Generated Questions'));
+        results.appendChild(element('h3', multipleChoice ? 'Multiple Choice Questions' : 'Questions with Simple Answers'));
+
+        var list = element('ul');
+        questions.forEach(function (qa) {
+            var item = element('li', qa.question);
+            var answers = element('ul');
+
+            if (multipleChoice) {
+                qa.answer.forEach(function (option) {
+                    answers.appendChild(element('li', option.answer + (option.correct ? ' (Correct)' : '')));
+                });
+            } else {
+                answers.appendChild(element('li', 'Answer: ' + qa.answer));
+            }
+
+            item.appendChild(answers);
+            list.appendChild(item);
+        });
+        results.appendChild(list);
+    }
+
+    function element(tag, text) {
+        var node = document.createElement(tag);
+        if (text !== undefined) {
+            node.textContent = text;
+        }
+        return node;
+    }
+})();